@@ -0,0 +1,59 @@
+#!/usr/bin/python
+
+'''Timer wheel used to age out FDB entries'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+DEFAULT_TICK = 1.0
+DEFAULT_SLOTS = 512
+
+
+class TimerWheel(object):
+    '''Hashed timer wheel. An item is filed in the slot of the tick in
+       which it expires and every tick looks only at its own slot.
+       Deadlines are not updated in place - an item whose deadline has
+       moved (refreshed) or which is further away than one revolution
+       is simply filed again when its slot comes up, so schedule and
+       refresh are O(1) and a tick costs O(items in the slot).'''
+
+    def __init__(self, now, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        self._tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._current = int(now / tick)
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+    def schedule(self, item, when):
+        '''File an item to fire at time when'''
+        tick = max(int(when / self._tick), self._current + 1)
+        self._slots[tick % len(self._slots)].append(item)
+
+    def advance(self, now, deadline_of):
+        '''Advance the wheel to now and return the items which are due.
+           deadline_of(item) returns the current deadline of an item or
+           None if it has been cancelled in the meantime.'''
+        target = int(now / self._tick)
+        if target - self._current > len(self._slots):
+            # we have been away for more than a revolution, visiting
+            # each slot once is enough
+            self._current = target - len(self._slots)
+        due = []
+        while self._current < target:
+            self._current += 1
+            index = self._current % len(self._slots)
+            slot = self._slots[index]
+            if not slot:
+                continue
+            self._slots[index] = []
+            for item in slot:
+                when = deadline_of(item)
+                if when is None:
+                    continue
+                if when <= now:
+                    due.append(item)
+                else:
+                    self.schedule(item, when)
+        return due
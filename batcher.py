@@ -0,0 +1,132 @@
+#!/usr/bin/python
+
+'''Rule batching between the FDB and the BESS forwarders'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import logging
+import time
+from fanout import FanOut, report
+from metrics import FLUSHES, PROGRAMMED
+
+DEFAULT_MAX_ENTRIES = 4096
+DEFAULT_DEADLINE = 0.05
+# rule batches on their way to one forwarder when pipelined
+DEFAULT_INFLIGHT = 2
+
+
+class Batcher(object):
+    '''Collects the L2Forward rule changes produced while the switch
+       processes one main loop wakeup. Ports queue their changes
+       locally and register here, a flush pushes one delete and one
+       add command per forwarder, fanned out across forwarders.
+
+       When pipelined the batcher only keeps track of what is queued,
+       the asyncio runtime takes the ports and sends their batches
+       without waiting for them.'''
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, deadline=DEFAULT_DEADLINE, fanout=None):
+        self.max_entries = max_entries
+        self.deadline = deadline
+        self.inflight = DEFAULT_INFLIGHT
+        self.pipelined = False
+        self._full = False
+        if fanout is None:
+            fanout = FanOut()
+        self.fanout = fanout
+        self._dirty = {}
+        self._opened = None
+        # receipt time of the event being handled and of the handled
+        # events whose rules are waiting for the next flush
+        self._event = None
+        self._stamps = []
+
+    def deserialize(self, config):
+        '''Digest batch settings read from JSON'''
+        self.max_entries = config.get("batch_size", self.max_entries)
+        self.deadline = config.get("batch_deadline", self.deadline)
+        self.inflight = config.get("bess_inflight", self.inflight)
+        self.fanout.workers = config.get("fanout_workers", self.fanout.workers)
+
+    @property
+    def pending(self):
+        '''Number of ports with queued changes'''
+        return len(self._dirty)
+
+    def event(self, stamp):
+        '''Note the time the event being handled was read, the time
+           until its rules are flushed is recorded if it queues any'''
+        self._event = stamp
+
+    def mark(self, port):
+        '''Register a port which has queued changes. A port which has
+           hit the size cap is flushed straight away, or makes the batch
+           due when pipelined.'''
+        if self._opened is None:
+            self._opened = time.time()
+        if self._event is not None:
+            self._stamps.append(self._event)
+            self._event = None
+        if port.pending >= self.max_entries and self.pipelined:
+            self._full = True
+            self._dirty[port] = True
+        elif port.pending >= self.max_entries:
+            failed = port.flush()
+            if failed:
+                report({port:failed}, "Rule update")
+            self._dirty.pop(port, None)
+        else:
+            self._dirty[port] = True
+
+    def due(self):
+        '''Have the oldest queued changes waited longer than the deadline'''
+        if self._full:
+            return True
+        return self._opened is not None and time.time() - self._opened >= self.deadline
+
+    def take(self, ready):
+        '''Hand out the ports with queued changes for which ready(port)
+           holds, the others stay registered. Returns the ports and the
+           receipt times of the events queued so far, which are kept
+           back until the last port has been taken.'''
+        ports = [port for port in self._dirty if ready(port)]
+        for port in ports:
+            del self._dirty[port]
+        self._full = False
+        self._event = None
+        if self._dirty:
+            return (ports, [])
+        stamps = self._stamps
+        self._stamps = []
+        self._opened = None
+        return (ports, stamps)
+
+    def flush(self):
+        '''Push all queued changes to BESS. Returns a dict of the ports
+           where something failed to what failed'''
+        dirty = self._dirty
+        stamps = self._stamps
+        self._dirty = {}
+        self._stamps = []
+        self._event = None
+        self._opened = None
+        self._full = False
+        if not dirty:
+            return {}
+        failures = self.fanout.run(dirty, lambda port: port.flush())
+        report(failures, "Rule update")
+        logging.debug("Flushed rule batches for %d ports", len(dirty))
+        FLUSHES.inc()
+        done = time.time()
+        PROGRAMMED.observe_many([done - stamp for stamp in stamps])
+        return failures
+
+
+def chunks(items, size):
+    '''Split a list into chunks of at most size items'''
+    if not size:
+        size = len(items) or 1
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -0,0 +1,498 @@
+#!/usr/bin/python
+
+'''Control plane benchmarks for the BESS switch'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import struct
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from batcher import Batcher
+from fake_bess import FakeBESS
+from fake_feeds import FakeFeed, FakeNetlinkFeed
+from fanout import FanOut
+from fdb import FDB, FDBEntry, DEFAULT_AGE
+
+
+class _BenchVlan(object):
+    '''Minimal vlan which only counts the calls made by the FDB'''
+    def __init__(self, vlan_no):
+        self.vlan_no = vlan_no
+        self.calls = 0
+
+    def add(self, entry):
+        '''Count an add'''
+        self.calls += 1
+
+    def refresh(self, entry):
+        '''Count a refresh'''
+        self.calls += 1
+
+    def move(self, old, new):
+        '''Count a move'''
+        self.calls += 1
+
+    def replace(self, old, new):
+        '''Count a replace'''
+        self.calls += 1
+
+    def delete(self, entry):
+        '''Count a delete'''
+        self.calls += 1
+
+
+class _LegacyFDBEntry(object):
+    '''The FDB entry layout prior to the integer keyed FDB'''
+    # pylint: disable=too-few-public-methods
+    def __init__(self, mac, vlan, source, dst_ports=None, age=DEFAULT_AGE):
+        # pylint: disable=too-many-arguments
+        self._mac = mac
+        self._source = source
+        self._dst_ports = dst_ports
+        self._is_broadcast = _legacy_is_bmcast(mac)
+        self._vlan = vlan
+        self._age = age
+        self.last_seen = time.time()
+        self._expiry = self.last_seen + self._age
+
+
+def _legacy_is_bmcast(mac):
+    '''is_bmcast() prior to the integer keyed FDB'''
+    digits = mac.split(":")
+    if len(digits) != 6:
+        raise ValueError
+    for digit in digits:
+        hex_form = int(digit, 16)
+        if hex_form < 0 or hex_form > 0xff:
+            raise ValueError
+    return (int(digits[0], 16) & 1) == 1
+
+
+def _macs(count):
+    '''Generate count distinct unicast macs'''
+    return ["02:00:{:02x}:{:02x}:{:02x}:{:02x}".format(
+        (i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff) for i in range(count)]
+
+
+def _measure(build):
+    '''Run build under tracemalloc, return (result, bytes, seconds)'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def _best_of(run, repeat=3):
+    '''Best wall clock time out of repeat runs'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_fdb(count):
+    '''Compare memory and lookup cost of the legacy and current FDB layouts'''
+    macs = _macs(count)
+    vlan = _BenchVlan(3)
+    port = object()
+
+    def legacy_build():
+        records = {}
+        for mac in macs:
+            records["{}-{}".format(vlan, mac)] = _LegacyFDBEntry(mac, vlan, port)
+        return records
+
+    def current_build():
+        fdb = FDB()
+        for mac in macs:
+            fdb.learn(mac, vlan, port)
+        return fdb
+
+    def legacy_lookup():
+        for mac in macs:
+            # pylint: disable=pointless-statement
+            legacy["{}-{}".format(vlan, mac)]
+
+    def current_lookup():
+        for mac in macs:
+            current.get_entry(mac, vlan)
+
+    legacy, legacy_mem, legacy_build_time = _measure(legacy_build)
+    legacy_lookup_time = _best_of(legacy_lookup)
+    del legacy
+
+    current, current_mem, current_build_time = _measure(current_build)
+    current_lookup_time = _best_of(current_lookup)
+
+    return {
+        "macs": count,
+        "legacy": {
+            "bytes": legacy_mem, "bytes_per_mac": float(legacy_mem) / count,
+            "build_s": legacy_build_time, "lookup_ns": legacy_lookup_time * 1e9 / count},
+        "current": {
+            "bytes": current_mem, "bytes_per_mac": float(current_mem) / count,
+            "build_s": current_build_time, "lookup_ns": current_lookup_time * 1e9 / count,
+            "entry_slots": len(FDBEntry.__slots__)},
+    }
+
+
+def _fake_vlan(bess, ports, batcher, vlan_no=3):
+    '''Build a vlan with ports and their pipelines on a fake BESS. The
+       linux bridge is not touched.'''
+    # imported here so that the fdb benchmark does not need the snoop deps
+    # pylint: disable=import-outside-toplevel
+    from pipeline import PipelineBuilder
+    from vlan import Vlan
+    vlan = Vlan(bess, {"vlan_id":vlan_no, "ports":[
+        {"pci":"00:00.{}".format(number), "port_no":number}
+        for number in range(1, ports + 1)]}, batcher)
+    PipelineBuilder(bess, batcher.fanout).build(vlan.pipelines())
+    for port in vlan.ports:
+        port.attach()
+    return vlan
+
+
+def bench_fanout(port_counts, macs, workers, rtt, service):
+    '''Time pushing a burst of learned macs to every forwarder of a vlan
+       sequentially and through the fan-out pool'''
+    # pylint: disable=too-many-locals
+    results = []
+    for ports in port_counts:
+        result = {"ports":ports, "macs":macs, "workers":workers, "rtt":rtt}
+        for (mode, pool_size) in (("sequential", 1), ("fanout", workers)):
+            bess = FakeBESS()
+            batcher = Batcher(fanout=FanOut(pool_size))
+            vlan = _fake_vlan(bess, ports, batcher)
+            members = list(vlan.ports)
+            fdb = FDB()
+            bess.rtt = rtt
+            bess.service = service
+            start = time.perf_counter()
+            for (index, mac) in enumerate(_macs(macs)):
+                fdb.learn(mac, vlan, members[index % ports])
+            # learning queues the rules, the only calls made so far wire
+            # up forwarder gates on first use
+            learned = time.perf_counter()
+            calls = bess.total_calls
+            batcher.flush()
+            flushed = time.perf_counter()
+            batcher.fanout.shutdown()
+            result[mode] = {"learn_s":learned - start, "flush_s":flushed - learned,
+                            "flush_calls":bess.total_calls - calls}
+            bess.reset_all()
+        result["flush_speedup"] = result["sequential"]["flush_s"] / result["fanout"]["flush_s"]
+        results.append(result)
+    return results
+
+
+STORMS = ("learn", "move", "expire", "age", "mcast", "flap")
+STORM_VLAN = 3
+# fdb_age used by the aging storm, the rest never age anything out
+STORM_AGE = 1
+
+
+def _neigh(kind, macs, bridge, ports, shift=0):
+    '''Netlink messages for a list of macs spread over ports'''
+    return [{"type":kind, "bridge_name":bridge, "mac":mac,
+             "port_name":ports[(index + shift) % len(ports)]}
+            for (index, mac) in enumerate(macs)]
+
+
+def _mcast_churn(count, bridge, ports, seed=1):
+    '''Random joins and leaves over count / 8 groups'''
+    rand = random.Random(seed)
+    groups = ["01:00:5e:{:02x}:{:02x}:{:02x}".format(
+        (i >> 16) & 0x7f, (i >> 8) & 0xff, i & 0xff) for i in range(max(1, count // 8))]
+    return [{"type":rand.choice(("MCAST_JOIN", "MCAST_LEAVE")), "bridge_name":bridge,
+             "mac":rand.choice(groups), "port_name":rand.choice(ports)}
+            for _ in range(count)]
+
+
+def _flaps(count, bridge, ports):
+    '''count updates of count / 100 macs each hopping over all ports'''
+    macs = _macs(max(1, count // 100))
+    return [{"type":"RTM_NEWNEIGH", "bridge_name":bridge, "mac":macs[index % len(macs)],
+             "port_name":ports[(index // len(macs)) % len(ports)]}
+            for index in range(count)]
+
+
+def _drainer(switch, feeds, pipelined):
+    '''Function running the main loop until all feeds are empty and
+       everything is in BESS, on asyncio if pipelined'''
+    if not pipelined:
+        def drain():
+            '''epoll main loop'''
+            while True:
+                switch.poll(0)
+                if not any(feed.pending for feed in feeds) and not switch.pending:
+                    return
+        return drain
+    # pylint: disable=import-outside-toplevel
+    import asyncio
+    from runtime import AsyncRuntime
+    runtime = AsyncRuntime(switch)
+    loop = asyncio.new_event_loop()
+
+    def done():
+        '''Nothing left to read, queued or in flight'''
+        return not any(feed.pending for feed in feeds) and not switch.pending and \
+            not runtime.inflight
+
+    def drain():
+        '''asyncio runtime'''
+        loop.run_until_complete(runtime.run(done))
+    return drain
+
+
+def _storm(bess, drain, feed, messages):
+    '''Push messages into a feed and time the switch working through them'''
+    calls = bess.total_calls
+    start = time.perf_counter()
+    feed.push(messages)
+    drain()
+    elapsed = time.perf_counter() - start
+    events = len(messages)
+    calls = bess.total_calls - calls
+    return {"events":events, "seconds":elapsed, "events_per_s":events / elapsed,
+            "bess_calls":calls, "calls_per_event":float(calls) / events}
+
+
+def _storm_case(case):
+    '''Run one storm on a freshly built switch. Runs in its own process
+       so that the peak RSS is that of this case only.'''
+    # imported here so that the other benchmarks do not need pyroute2
+    # pylint: disable=import-outside-toplevel
+    from switch import Switch
+    bess = FakeBESS(rtt=case["rtt"], unbounded=True)
+    netlink = FakeNetlinkFeed(case["budget"])
+    igmp = FakeFeed(case["budget"])
+    feeds = (netlink, igmp)
+    switch = Switch(bess, netlink=netlink)
+    switch.deserialize({
+        "fanout_workers":case["workers"],
+        "learn_rate":case["learn_rate"],
+        "fdb_age":STORM_AGE if case["storm"] == "age" else 3600,
+        "vlans":[{"vlan_id":STORM_VLAN, "ports":[
+            {"pci":"00:00.{}".format(number), "port_no":number}
+            for number in range(1, case["ports"] + 1)]}]})
+    switch.initialize()
+    switch.add_feed(igmp)
+    switch.start(register=not case["asyncio"])
+    drain = _drainer(switch, feeds, case["asyncio"])
+    provisioner = netlink.provisioner()
+    bridge = provisioner.index("bvlan{}".format(STORM_VLAN))
+    ports = [provisioner.index("bv{}p{}".format(STORM_VLAN, number))
+             for number in range(1, case["ports"] + 1)]
+    macs = _macs(case["macs"])
+    storm = case["storm"]
+    if storm == "mcast":
+        result = _storm(bess, drain, igmp, _mcast_churn(case["macs"], bridge, ports))
+    elif storm == "learn":
+        result = _storm(bess, drain, netlink, _neigh("RTM_NEWNEIGH", macs, bridge, ports))
+    elif storm == "flap":
+        result = _storm(bess, drain, netlink, _flaps(case["macs"], bridge, ports))
+    else:
+        netlink.push(_neigh("RTM_NEWNEIGH", macs, bridge, ports))
+        drain()
+        if storm == "move":
+            result = _storm(bess, drain, netlink,
+                            _neigh("RTM_NEWNEIGH", macs, bridge, ports, shift=1))
+        elif storm == "expire":
+            result = _storm(bess, drain, netlink,
+                            _neigh("RTM_DELNEIGH", macs, bridge, ports))
+        else:
+            # the kernel dropped everything without telling us, aging
+            # in the next wakeup has to clear the lot
+            netlink.forget()
+            time.sleep(STORM_AGE + 1.1)
+            calls = bess.total_calls
+            start = time.perf_counter()
+            drain()
+            elapsed = time.perf_counter() - start
+            calls = bess.total_calls - calls
+            result = {"events":len(macs), "seconds":elapsed, "events_per_s":len(macs) / elapsed,
+                      "bess_calls":calls, "calls_per_event":float(calls) / len(macs)}
+    result.update(case)
+    # kilobytes on linux
+    result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    bess.reset_all()
+    return result
+
+
+def bench_storms(storms, mac_counts, port_counts, workers, budget, rtt, learn_rate,
+                 pipelined=False):
+    '''Drive Switch through learn, move, expire, aging, multicast and
+       MAC flap storms against the fake BESS and synthetic feeds'''
+    # pylint: disable=too-many-arguments
+    cases = [{"storm":storm, "macs":macs, "ports":ports, "workers":workers,
+              "budget":budget, "rtt":rtt, "learn_rate":learn_rate, "asyncio":pipelined}
+             for storm in storms for macs in mac_counts for ports in port_counts]
+    # a fresh process per case
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        results = list(pool.imap(_storm_case, cases, 1))
+    finally:
+        pool.close()
+        pool.join()
+    return {"python":platform.python_version(), "started":time.time(), "cases":results}
+
+
+PCAP_MAGIC = {0xa1b2c3d4:"<", 0xd4c3b2a1:">", 0xa1b23c4d:"<", 0x4d3cb2a1:">"}
+
+
+def read_pcap(path):
+    '''Read the packets out of a classic (not pcapng) pcap file'''
+    packets = []
+    with open(path, "rb") as pcap:
+        data = pcap.read()
+    endian = PCAP_MAGIC[struct.unpack_from("<I", data, 0)[0]]
+    record = struct.Struct(endian + "IIII")
+    offset = 24
+    while offset + record.size <= len(data):
+        caplen = record.unpack_from(data, offset)[2]
+        offset += record.size
+        packets.append(data[offset:offset + caplen])
+        offset += caplen
+    return packets
+
+
+def _igmp_packet(payload, vlan=None):
+    '''Wrap an IGMP payload into IPv4 with router alert and Ethernet'''
+    eth = b"\x01\x00\x5e\x00\x00\x16" + b"\x02\x00\x00\x00\x00\x01"
+    if vlan is not None:
+        eth += struct.pack("!HH", 0x8100, vlan)
+    eth += struct.pack("!H", 0x0800)
+    ip_hdr = struct.pack("!BBHHHBBH4s4s", 0x46, 0xc0, 24 + len(payload), 0, 0, 1, 2, 0,
+                         b"\x0a\x00\x00\x01", b"\xe0\x00\x00\x16")
+    return eth + ip_hdr + b"\x94\x04\x00\x00" + payload
+
+
+def synthetic_igmp(count):
+    '''A mix of IGMPv2 joins/leaves and multi record IGMPv3 reports'''
+    packets = []
+    for index in range(count):
+        group = struct.pack("!BBBB", 239, (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+        kind = index % 4
+        if kind == 0:
+            payload = struct.pack("!BBH4s", 0x16, 0, 0, group)
+        elif kind == 1:
+            payload = struct.pack("!BBH4s", 0x17, 0, 0, group)
+        else:
+            records = b""
+            for rtype in (4, 3, 5, 1):
+                numsrc = 1 if rtype == 5 else 0
+                records += struct.pack("!BBH4s", rtype, 0, numsrc, group) + b"\x0a\x00\x00\x02" * numsrc
+            payload = struct.pack("!BBHHH", 0x22, 0, 0, 0, 4) + records
+        packets.append(_igmp_packet(payload, vlan=(index % 8 if kind == 3 else None)))
+    return packets
+
+
+def bench_igmp(pcaps, count, repeat):
+    '''Packets per second of the struct and scapy IGMP parsers'''
+    # pylint: disable=import-outside-toplevel
+    from igmp_listener import IGMPFeed, scapy
+    packets = []
+    for path in pcaps:
+        packets.extend(read_pcap(path))
+    if not packets:
+        packets = synthetic_igmp(count)
+    # parse without a socket behind the feed
+    feed = IGMPFeed.__new__(IGMPFeed)
+    feed.iface = "bench"
+    # pylint: disable=protected-access
+    feed._bridge = None
+    result = {"packets":len(packets)}
+
+    def run_raw():
+        return [feed._parse_raw(data) for data in packets]
+
+    elapsed = _best_of(run_raw, repeat)
+    raw_events = run_raw()
+    result["struct"] = {"pps":len(packets) / elapsed,
+                        "events":sum(len(events) for events in raw_events)}
+    if scapy is not None:
+        from scapy.layers.l2 import Ether
+        scapy.load_contrib('igmpv3')
+        scapy.load_contrib('igmp')
+
+        def run_scapy():
+            return [feed._parse(Ether(data)) for data in packets]
+
+        elapsed = _best_of(run_scapy, repeat)
+        result["scapy"] = {"pps":len(packets) / elapsed}
+        result["outputs_match"] = run_scapy() == raw_events
+    return result
+
+
+def main():
+    '''Run the control plane benchmarks'''
+    aparser = ArgumentParser(description=main.__doc__)
+    subparsers = aparser.add_subparsers(dest="bench")
+    fdb_parser = subparsers.add_parser("fdb", help="FDB memory and lookup cost")
+    fdb_parser.add_argument('--macs', help='number of macs', type=int, default=100000)
+    fanout_parser = subparsers.add_parser(
+        "fanout", help="sequential vs concurrent forwarder updates on a fake BESS")
+    fanout_parser.add_argument(
+        '--ports', help='ports per vlan', type=int, nargs='+', default=[8, 32, 128])
+    fanout_parser.add_argument('--macs', help='number of macs', type=int, default=1000)
+    fanout_parser.add_argument('--workers', help='fan-out pool size', type=int, default=8)
+    fanout_parser.add_argument(
+        '--rtt', help='simulated grpc round trip in seconds', type=float, default=0.0005)
+    fanout_parser.add_argument(
+        '--service', help='simulated bessd time per entry in seconds', type=float,
+        default=0.000001)
+    storm_parser = subparsers.add_parser(
+        "storms", help="event storms through the whole switch on a fake BESS")
+    storm_parser.add_argument(
+        '--storms', help='storms to run', nargs='+', choices=STORMS, default=list(STORMS))
+    storm_parser.add_argument(
+        '--macs', help='macs (events) per storm', type=int, nargs='+', default=[1000, 10000])
+    storm_parser.add_argument(
+        '--ports', help='ports per vlan', type=int, nargs='+', default=[2, 16, 128])
+    storm_parser.add_argument('--workers', help='fan-out pool size', type=int, default=8)
+    storm_parser.add_argument(
+        '--budget', help='messages handed out per feed wakeup', type=int, default=64)
+    storm_parser.add_argument(
+        '--rtt', help='simulated grpc round trip in seconds', type=float, default=0.0)
+    storm_parser.add_argument(
+        '--learn-rate', help='per port learn rate limit, 0 for none', type=int, default=0)
+    storm_parser.add_argument(
+        '--asyncio', help='drive the switch with the asyncio runtime', action='store_true')
+    igmp_parser = subparsers.add_parser("igmp", help="IGMP parser packets per second")
+    igmp_parser.add_argument('--pcap', help='capture(s) to parse', nargs='*', default=[])
+    igmp_parser.add_argument(
+        '--packets', help='synthetic packets if no capture is given', type=int, default=10000)
+    igmp_parser.add_argument('--repeat', help='runs to take the best of', type=int, default=3)
+    args = aparser.parse_args()
+    if args.bench == "fdb":
+        result = bench_fdb(args.macs)
+    elif args.bench == "igmp":
+        result = bench_igmp(args.pcap, args.packets, args.repeat)
+    elif args.bench == "storms":
+        result = bench_storms(
+            args.storms, args.macs, args.ports, args.workers, args.budget, args.rtt,
+            args.learn_rate, args.asyncio)
+    elif args.bench == "fanout":
+        result = bench_fanout(args.ports, args.macs, args.workers, args.rtt, args.service)
+    else:
+        aparser.print_help()
+        return
+    print(json.dumps(result, indent=4, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
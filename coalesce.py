@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+'''Coalescing and rate limiting of FDB updates ahead of the FDB'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import collections
+import logging
+from metrics import COALESCED, FLAPS, THROTTLED
+
+DEFAULT_WINDOW = 0.01
+# learns are not limited unless a rate is configured
+DEFAULT_RATE = 0
+DEFAULT_BURST = 10000
+# transitions of one MAC within a window which get it reported as flapping
+FLAP_WARN = 16
+
+
+class TokenBucket(object):
+    '''Token bucket, rate tokens per second up to burst'''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = now
+
+    def take(self, now):
+        '''Take a token if there is one'''
+        if self._tokens < 1:
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens < 1:
+                return False
+        self._tokens -= 1
+        return True
+
+
+class Coalescer(object):
+    '''Holds kernel FDB updates for a short window so that the
+       transitions of a MAC inside the window collapse to its final
+       state. Learns which cost forwarder updates are paid for from a
+       per port token bucket, the learns of a port out of tokens wait in
+       its own queue without holding up anybody else. Removals are never
+       limited. A removal which replaces a learn still waiting here is
+       marked "cancels", if the FDB never heard of the MAC it has
+       nothing to remove.'''
+
+    def __init__(self, window=DEFAULT_WINDOW, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        # latest message per (vlan, mac)
+        self._latest = {}
+        # keys waiting per port, None for removals
+        self._queues = {}
+        self._buckets = {}
+        self._transitions = {}
+        self._opened = None
+        self.flaps = {}
+
+    def deserialize(self, config):
+        '''Digest coalescing settings read from JSON'''
+        self.window = config.get("coalesce_window", self.window)
+        self.rate = config.get("learn_rate", self.rate)
+        self.burst = config.get("learn_burst", self.burst)
+
+    def __len__(self):
+        return len(self._latest)
+
+    @staticmethod
+    def _queue_of(mess):
+        '''Queue a message waits in'''
+        if mess["type"] == "RTM_NEWNEIGH":
+            return mess["port"]
+        return None
+
+    def push(self, mess, now):
+        '''Take an update, it replaces any update for the same MAC which
+           has not been handed out yet'''
+        key = (mess["bridge"], mess["mac"])
+        old = self._latest.get(key)
+        if old is not None and old["type"] == "RTM_NEWNEIGH" and \
+                mess["type"] == "RTM_DELNEIGH":
+            mess["cancels"] = True
+        self._latest[key] = mess
+        queue = self._queue_of(mess)
+        if old is not None:
+            COALESCED.inc()
+            if self._queue_of(old) is queue:
+                # still queued where it should be
+                return
+            if queue is not None and old["type"] == "RTM_NEWNEIGH":
+                self._flap(key, queue)
+        if self._opened is None:
+            self._opened = now
+        self._queues.setdefault(queue, collections.deque()).append(key)
+
+    def _flap(self, key, port):
+        '''Account for a MAC moving to a port within the window'''
+        self.flaps[port] = self.flaps.get(port, 0) + 1
+        FLAPS.inc((port.ifname,))
+        count = self._transitions.get(key, 0) + 1
+        self._transitions[key] = count
+        if count == FLAP_WARN:
+            logging.warning("MAC %s on vlan %s is flapping, now on %s",
+                            key[1], key[0].vlan_no, port.ifname)
+
+    def due(self, now):
+        '''Has the window of the oldest waiting update closed'''
+        return self._opened is not None and now - self._opened >= self.window
+
+    def timeout(self, timeout, now):
+        '''Poll timeout which does not sleep through the window'''
+        if self._opened is None:
+            return timeout
+        return max(0, min(timeout, self._opened + self.window - now))
+
+    def _bucket(self, port, now):
+        '''Token bucket of a port'''
+        try:
+            return self._buckets[port]
+        except KeyError:
+            bucket = TokenBucket(self.rate, self.burst, now)
+            self._buckets[port] = bucket
+            return bucket
+
+    def drain(self, now, charge):
+        '''Hand out the final state of every MAC which may go. charge(mess)
+           tells whether a learn costs a token - refreshes of what the
+           FDB already has are free. Whatever is held back by a rate
+           limit is retried after another window.'''
+        ready = []
+        for (port, queue) in self._queues.items():
+            bucket = None
+            if port is not None and self.rate:
+                bucket = self._bucket(port, now)
+            while queue:
+                key = queue[0]
+                mess = self._latest.get(key)
+                if mess is None or self._queue_of(mess) is not port:
+                    # superseded, it has been or will be handed out elsewhere
+                    queue.popleft()
+                    continue
+                if bucket is not None and charge(mess) and not bucket.take(now):
+                    THROTTLED.inc((port.ifname,))
+                    break
+                queue.popleft()
+                del self._latest[key]
+                ready.append(mess)
+        self._transitions = {}
+        if self._latest:
+            self._opened = now
+        else:
+            self._opened = None
+            self._queues = {}
+        return ready
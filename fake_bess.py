@@ -0,0 +1,247 @@
+#!/usr/bin/python
+
+'''In-process stand-in for pybess.bess.BESS used by the benchmarks'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import errno
+import os
+import socket
+import threading
+import time
+
+
+class FakeObject(object):
+    '''Response carrying the fields the switch looks at'''
+    # pylint: disable=too-few-public-methods
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeBESS(object):
+    '''Emulates the subset of the pybess API used by the switch. It
+       keeps the pipeline graph and the L2Forward tables, returns the
+       same errors as bessd for duplicate and missing entries and counts
+       calls. Each call costs rtt seconds outside of any lock (the grpc
+       round trip) plus service seconds per entry under a global lock,
+       as bessd serializes all commands. Forwarder tables fill up at
+       their configured size unless unbounded is set.'''
+
+    class Error(Exception):
+        '''Same shape as pybess BESS.Error'''
+        def __init__(self, code, errmsg, **kwargs):
+            Exception.__init__(self, code, errmsg)
+            self.code = code
+            self.errmsg = errmsg
+            self.info = kwargs
+
+    def __init__(self, rtt=0.0, service=0.0, unbounded=False):
+        self.rtt = rtt
+        self.service = service
+        self.unbounded = unbounded
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.ports = {}
+        self.modules = {}
+        self.links = {}
+        self.tables = {}
+        self.workers = {}
+        self.running = False
+        self._sockets = {}
+
+    def _call(self, what, entries=1):
+        '''Account for and pay for a call'''
+        if self.rtt:
+            time.sleep(self.rtt)
+        with self._lock:
+            self.calls[what] = self.calls.get(what, 0) + 1
+            if self.service:
+                time.sleep(self.service * entries)
+
+    @property
+    def total_calls(self):
+        '''Number of calls made so far'''
+        return sum(self.calls.values())
+
+    def connect(self, *args, **kwargs):
+        '''Connect to the fake daemon'''
+        pass
+
+    def pause_all(self):
+        '''Pause all workers'''
+        self._call("pause_all")
+        self.running = False
+
+    def resume_all(self):
+        '''Resume all workers'''
+        self._call("resume_all")
+        self.running = True
+
+    def reset_all(self):
+        '''Drop the whole pipeline'''
+        self._call("reset_all")
+        self.modules = {}
+        self.links = {}
+        self.tables = {}
+        self.workers = {}
+        self.reset_ports()
+
+    def reset_ports(self):
+        '''Drop all ports'''
+        self._call("reset_ports")
+        for (path, sock) in self._sockets.items():
+            sock.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        self._sockets = {}
+        self.ports = {}
+
+    def add_worker(self, wid, core, scheduler=''):
+        '''Add a worker'''
+        # pylint: disable=unused-argument
+        self._call("add_worker")
+        self.workers[wid] = core
+
+    def attach_task(self, module_name, wid=None, **kwargs):
+        '''Attach a module task to a worker'''
+        # pylint: disable=unused-argument
+        self._call("attach_task")
+        self.modules[module_name]["wid"] = wid
+
+    def list_workers(self):
+        '''List workers'''
+        self._call("list_workers")
+        return FakeObject(workers_status=[
+            FakeObject(wid=wid, core=core) for (wid, core) in sorted(self.workers.items())])
+
+    def create_port(self, driver, name, arg):
+        '''Create a port. UnixSocketPort listens on its path like bessd
+           does so that snoop feeds can connect'''
+        self._call("create_port")
+        if name in self.ports:
+            raise self.Error(errno.EEXIST, "Port {} already exists".format(name))
+        if driver == "UnixSocketPort":
+            path = arg["path"]
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            sock.bind(path)
+            sock.listen(1)
+            self._sockets[path] = sock
+        self.ports[name] = {"driver":driver, "arg":arg}
+        return FakeObject(name=name)
+
+    def create_module(self, mclass, name, arg):
+        '''Create a module'''
+        self._call("create_module")
+        if name in self.modules:
+            raise self.Error(errno.EEXIST, "Module {} already exists".format(name))
+        self.modules[name] = {"mclass":mclass, "arg":arg, "gates":{}}
+        if mclass == "L2Forward":
+            self.tables[name] = {}
+        return FakeObject(name=name)
+
+    def destroy_module(self, name):
+        '''Destroy a module and everything connected to it'''
+        self._call("destroy_module")
+        self._module(name)
+        del self.modules[name]
+        self.tables.pop(name, None)
+        for (src, ogate) in list(self.links):
+            if src == name or self.links[(src, ogate)][0] == name:
+                del self.links[(src, ogate)]
+
+    def _module(self, name):
+        '''Lookup a module'''
+        try:
+            return self.modules[name]
+        except KeyError:
+            raise self.Error(errno.ENOENT, "No module '{}' found".format(name))
+
+    def connect_modules(self, m1, m2, ogate=0, igate=0):
+        '''Connect two modules'''
+        self._call("connect_modules")
+        self._module(m1)
+        self._module(m2)
+        if (m1, ogate) in self.links:
+            raise self.Error(errno.EBUSY, "Output gate {} of {} is busy".format(ogate, m1))
+        self.links[(m1, ogate)] = (m2, igate)
+
+    def disconnect_modules(self, name, ogate=0):
+        '''Disconnect an output gate'''
+        self._call("disconnect_modules")
+        self._module(name)
+        try:
+            del self.links[(name, ogate)]
+        except KeyError:
+            raise self.Error(errno.ENOENT, "Output gate {} of {} is not connected".format(
+                ogate, name))
+
+    def list_modules(self):
+        '''List modules'''
+        self._call("list_modules")
+        return FakeObject(modules=[
+            FakeObject(name=name, mclass=module["mclass"])
+            for (name, module) in self.modules.items()])
+
+    def run_module_command(self, name, cmd, arg_type, arg):
+        '''Run a module command'''
+        # pylint: disable=unused-argument
+        entries = len(arg.get("entries", arg.get("addrs", [None])))
+        self._call(cmd, entries)
+        module = self._module(name)
+        handler = getattr(self, "_{}_{}".format(module["mclass"].lower(), cmd), None)
+        if handler is None:
+            raise self.Error(errno.ENOTSUP, "Unknown command {}".format(cmd))
+        return handler(name, arg)
+
+    def _l2forward_add(self, name, arg):
+        '''L2Forward add - stops at the first failing entry'''
+        table = self.tables[name]
+        size = self.modules[name]["arg"].get("size", 1024)
+        bucket = self.modules[name]["arg"].get("bucket", 4)
+        for entry in arg["entries"]:
+            if entry["addr"] in table:
+                raise self.Error(errno.EEXIST, "MAC address '{}' already exist".format(
+                    entry["addr"]))
+            if not self.unbounded and len(table) >= size * bucket:
+                raise self.Error(errno.ENOMEM, "Not enough space")
+            table[entry["addr"]] = entry["gate"]
+        return FakeObject()
+
+    def _l2forward_delete(self, name, arg):
+        '''L2Forward delete - stops at the first failing entry'''
+        table = self.tables[name]
+        for addr in arg["addrs"]:
+            try:
+                del table[addr]
+            except KeyError:
+                raise self.Error(errno.ENOENT, "MAC address '{}' does not exist".format(addr))
+        return FakeObject()
+
+    def _l2forward_lookup(self, name, arg):
+        '''L2Forward lookup'''
+        table = self.tables[name]
+        gates = []
+        for addr in arg["addrs"]:
+            try:
+                gates.append(table[addr])
+            except KeyError:
+                raise self.Error(errno.ENOENT, "MAC address '{}' does not exist".format(addr))
+        return FakeObject(gates=gates)
+
+    def _l2forward_set_default_gate(self, name, arg):
+        '''L2Forward set_default_gate'''
+        self.modules[name]["default_gate"] = arg["gate"]
+        return FakeObject()
+
+    def _replicate_set_gates(self, name, arg):
+        '''Replicate set_gates'''
+        self.modules[name]["gates"] = list(arg["gates"])
+        return FakeObject()
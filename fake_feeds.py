@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+'''Synthetic event feeds for driving the switch in the benchmarks'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import collections
+import socket
+import zlib
+
+DEFAULT_BUDGET = 64
+
+
+class FakeProvisioner(object):
+    '''LinkProvisioner which does not touch the host, it only hands out
+       interface indexes. These are derived from the name so that all
+       processes agree on them.'''
+
+    @staticmethod
+    def index(name):
+        '''Index of an interface'''
+        return zlib.crc32(name.encode()) & 0x7fffffff
+
+    def resolve(self, names):
+        '''Indexes of a list of interfaces'''
+        return dict((name, self.index(name)) for name in names)
+
+    def create_bridge(self, name):
+        '''Pretend to create a linux bridge'''
+        pass
+
+    def enslave(self, bridge, names):
+        '''Pretend to add interfaces to a bridge'''
+        pass
+
+    def set_isolated(self, names, isolated):
+        '''Pretend to set bridge port isolation'''
+        pass
+
+    def set_querier(self, bridge, interval, response):
+        '''Pretend to turn on the IGMP querier of a bridge'''
+        pass
+
+    def set_state(self, names, state):
+        '''Pretend to set link state'''
+        pass
+
+
+class FakeFeed(object):
+    '''A feed producing queued messages. A socketpair provides the file
+       descriptor for epoll, it is kept readable while messages are
+       waiting. Each iteration hands out at most budget messages, like
+       the real feeds do.'''
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self._queue = collections.deque()
+        (self._reader, self._writer) = socket.socketpair()
+        self._reader.setblocking(0)
+        self._signalled = False
+
+    @property
+    def pending(self):
+        '''Messages waiting to be read'''
+        return len(self._queue)
+
+    def push(self, messages):
+        '''Queue messages for the main loop'''
+        self._queue.extend(messages)
+        if self._queue and not self._signalled:
+            self._writer.send(b"x")
+            self._signalled = True
+
+    def fileno(self):
+        '''File descriptor for epoll loop'''
+        return self._reader.fileno()
+
+    def setblocking(self, arg):
+        '''The wakeup socket is always non-blocking'''
+        pass
+
+    def initial_read(self):
+        '''No state at start'''
+        return []
+
+    def iteration(self):
+        '''Hand out up to budget messages'''
+        execute = []
+        for _ in range(min(self.budget, len(self._queue))):
+            execute.append(self._queue.popleft())
+        if not self._queue and self._signalled:
+            self._reader.recv(1)
+            self._signalled = False
+        return execute
+
+
+class FakeNetlinkFeed(FakeFeed):
+    '''Stands in for NetlinkFeed. Keeps track of what the kernel FDB
+       would hold after the messages pushed so far so that dumps are
+       answered correctly.'''
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        FakeFeed.__init__(self, budget)
+        self._provisioner = FakeProvisioner()
+        self._kernel = {}
+
+    def push(self, messages):
+        '''Queue netlink messages for the main loop'''
+        messages = list(messages)
+        for mess in messages:
+            key = (mess["bridge_name"], mess["mac"])
+            if mess["type"] == "RTM_NEWNEIGH":
+                self._kernel[key] = mess
+            else:
+                self._kernel.pop(key, None)
+        FakeFeed.push(self, messages)
+
+    def forget(self):
+        '''Drop the kernel state without telling anyone, as if the
+           notifications had been lost'''
+        self._kernel = {}
+
+    def dump(self):
+        '''The kernel FDB'''
+        return [dict(mess) for mess in self._kernel.values()]
+
+    def initial_read(self):
+        '''The kernel FDB at start, like NetlinkFeed'''
+        return self.dump()
+
+    def provisioner(self):
+        '''Provisioner handing out the indexes used in our messages'''
+        return self._provisioner
+
+    def lookup_by_name(self, name):
+        '''Lookup the index of an interface'''
+        return self._provisioner.index(name)
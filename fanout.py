@@ -0,0 +1,74 @@
+#!/usr/bin/python
+
+'''Concurrent fan-out of per forwarder BESS commands'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WORKERS = 8
+
+
+class FanOut(object):
+    '''Runs a piece of work for each of a set of ports on a bounded
+       thread pool. A port gets exactly one job per run and run() waits
+       for all of them, so commands sent to any one forwarder stay in
+       order while different forwarders proceed in parallel. The grpc
+       stub used by pybess is thread safe, the round trips overlap.'''
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self._pool = None
+
+    def executor(self):
+        '''The thread pool, created on first use'''
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def run(self, ports, work):
+        '''Run work(port) for every port. Returns a dict of port to
+           whatever work returned for it if that is not empty, or to the
+           exception it raised'''
+        ports = list(ports)
+        results = {}
+        if self.workers <= 1 or len(ports) <= 1:
+            for port in ports:
+                try:
+                    results[port] = work(port)
+                # pylint: disable=broad-except
+                except Exception as err:
+                    results[port] = err
+        else:
+            pool = self.executor()
+            futures = [(port, pool.submit(work, port)) for port in ports]
+            for (port, future) in futures:
+                try:
+                    results[port] = future.result()
+                # pylint: disable=broad-except
+                except Exception as err:
+                    results[port] = err
+        failures = {}
+        for (port, result) in results.items():
+            if result:
+                failures[port] = result
+        return failures
+
+    def shutdown(self):
+        '''Stop the worker threads'''
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def report(failures, what):
+    '''Log the per port failures returned by FanOut.run()'''
+    for (port, failure) in failures.items():
+        if isinstance(failure, list):
+            logging.error("%s failed on %s for %d entries, first %s",
+                          what, port, len(failure), failure[0])
+        else:
+            logging.error("%s failed on %s: %s", what, port, failure)
@@ -8,19 +8,25 @@
 
 import logging
 import time
+from aging import TimerWheel
+from metrics import FDB_AGED
 
 DEFAULT_AGE = 300
 
 
 class FDBEntry(object):
     '''FDB Entry'''
-    def __init__(self, mac, vlan, source, dst_ports=None, age=DEFAULT_AGE):
-    # pylint: disable=too-many-instance-attributes
+    __slots__ = ("_mac", "_mac_int", "_source", "_dst_ports", "_vlan", "_age",
+                 "last_seen", "_expiry")
+
+    def __init__(self, mac, vlan, source, dst_ports=None, age=DEFAULT_AGE, mac_int=None):
     # pylint: disable=too-many-arguments
+        if mac_int is None:
+            mac_int = mac_to_int(mac)
         self._mac = mac
+        self._mac_int = mac_int
         self._source = source
         self._dst_ports = dst_ports
-        self._is_broadcast = is_bmcast(mac)
         self._vlan = vlan
         self._age = age
         self.last_seen = 0 # this one needs to be public for testing
@@ -36,10 +42,25 @@ class FDBEntry(object):
         '''MAC for this fdb entry'''
         return self._mac
 
+    @property
+    def mac_int(self):
+        '''MAC for this fdb entry in integer form'''
+        return self._mac_int
+
+    @property
+    def key(self):
+        '''FDB key for this entry'''
+        return (self._vlan.vlan_no, self._mac_int)
+
     @property
     def is_broadcast(self):
         '''Is this Broadcast or Multicast'''
-        return self._is_broadcast
+        return (self._mac_int >> 40) & 1 == 1
+
+    @property
+    def expiry(self):
+        '''Time at which this entry expires unless refreshed'''
+        return self._expiry
 
     @property
     def vlan(self):
@@ -75,97 +96,195 @@ class FDB(object):
     '''A python representation of the linux bridge forwarding
        database. By default reads from sysfs and expects a linux
        bridge instance. Read methods can be overriden to support
-       other backends.'''
-    def __init__(self):
+       other backends. Entries are keyed on (vlan number, mac as int)
+       as a mac can be present on any number of vlans.'''
+    def __init__(self, max_age=DEFAULT_AGE):
         self._records = {}
+        self.max_age = max_age
+        self._wheel = TimerWheel(time.time())
+
+    def __len__(self):
+        return len(self._records)
+
+    def entries(self, vlan):
+        '''All entries on a vlan'''
+        return [entry for entry in self._records.values() if entry.vlan is vlan]
+
+    def source(self, mac, vlan):
+        '''Port a mac has been learned on, None if it is not known'''
+        try:
+            return self._records[fdb_key(mac, vlan)].source
+        except KeyError:
+            return None
 
     def get_entry(self, mac, vlan):
-        '''Get entry from fdb for this mac - note that a mac can be
-           present on any number of vlans, thus you need to hash
-           on mac + vlan'''
-        return self._records["{}-{}".format(vlan, mac)]
+        '''Get entry from fdb for this mac on this vlan'''
+        return self._records[fdb_key(mac, vlan)]
 
     def add_entry(self, entry):
-        '''Add entry from fdb for this mac - note that a mac can be
-           present on any number of vlans, thus you need to hash
-           on mac + vlan'''
-        self._records["{}-{}".format(entry.vlan, entry.mac)] = entry
+        '''Add entry to the fdb. Learned (unicast) entries are
+           scheduled for aging, multicast ones live until they are
+           explicitly removed'''
+        self._records[entry.key] = entry
+        if entry.source is not None:
+            self._wheel.schedule(entry, entry.expiry)
 
     def delete_entry(self, entry):
-        '''Delete entry from fdb for this mac - note that a mac can be
-           present on any number of vlans, thus you need to hash
-           on mac + vlan'''
-        del self._records["{}-{}".format(entry.vlan, entry.mac)]
+        '''Delete entry from the fdb'''
+        del self._records[entry.key]
 
     def del_mcast(self, mac, vlan, port):
-        '''Remove a Multicast fdb entry'''
+        '''Remove a port from a Multicast fdb entry, the entry goes
+           with its last port'''
+        self.prune_mcast(mac, vlan, [port])
+
+    def prune_mcast(self, mac, vlan, ports):
+        '''Remove a list of ports from a Multicast fdb entry, the vlan
+           is told once'''
         try:
-            old = self.get_entry(mac, vlan)
-            try:
-                new = FDBEntry(mac, vlan, None, dst_ports=old.ports)
-                new.ports.remove(port)
-                self.delete_entry(old)
-                self.add_entry(new)
-                vlan.replace(old, new)
-            except ValueError:
-                return
+            entry = self._records[fdb_key(mac, vlan)]
         except KeyError:
-            pass
+            return
+        gone = [port for port in ports if port in entry.ports]
+        if not gone:
+            return
+        for port in gone:
+            entry.del_port(port)
+        if entry.ports:
+            vlan.prune(entry, gone)
+        else:
+            self.delete_entry(entry)
+            vlan.delete(entry)
 
     def add_mcast(self, mac, vlan, port):
-        '''Add a Multicast fdb entry'''
+        '''Add a port to a Multicast fdb entry, creating it if needed'''
+        key = fdb_key(mac, vlan)
         try:
-            old = self.get_entry(mac, vlan)
-            try:
-                old.ports.index(port)
-                return
-            except ValueError:
-                new = FDBEntry(mac, vlan, None, dst_ports=old.ports + port)
-                self.delete_entry(old)
-                self.add_entry(new)
-                vlan.replace(old, new)
+            entry = self._records[key]
         except KeyError:
-            entry = FDBEntry(mac, vlan, None, dst_ports=[port])
+            entry = FDBEntry(mac, vlan, None, dst_ports=[port], mac_int=key[1])
             self.add_entry(entry)
             vlan.add(entry)
+            return
+        if port in entry.ports:
+            return
+        entry.add_port(port)
+        vlan.join(entry, port)
 
     def learn(self, mac, vlan, source_port):
         '''Add or refresh a mac'''
+        key = fdb_key(mac, vlan)
         try:
-            old = self.get_entry(mac, vlan)
+            old = self._records[key]
             if old.source == source_port:
                 old.refresh()
                 vlan.refresh(old)
             else:
                 self.delete_entry(old)
-                new = FDBEntry(mac, vlan, source_port)
+                new = FDBEntry(mac, vlan, source_port, age=self.max_age, mac_int=key[1])
                 self.add_entry(new)
-                vlan.replace(old, new)
+                vlan.move(old, new)
         except KeyError:
-            entry = FDBEntry(mac, vlan, source_port)
+            entry = FDBEntry(mac, vlan, source_port, age=self.max_age, mac_int=key[1])
             self.add_entry(entry)
             vlan.add(entry)
 
+    def load(self, mac, vlan, source_port):
+        '''Add a mac without telling the vlan, used to bulk load the
+           initial state. Returns the new entry or None if the mac was
+           already known'''
+        key = fdb_key(mac, vlan)
+        if key in self._records:
+            return None
+        entry = FDBEntry(mac, vlan, source_port, age=self.max_age, mac_int=key[1])
+        self.add_entry(entry)
+        return entry
+
+    def load_mcast(self, mac, vlan, ports):
+        '''Add a Multicast entry without telling the vlan, used to
+           restore groups at start. Returns the new entry or None if the
+           mac was already known'''
+        key = fdb_key(mac, vlan)
+        if key in self._records:
+            return None
+        entry = FDBEntry(mac, vlan, None, dst_ports=list(ports), mac_int=key[1])
+        self.add_entry(entry)
+        return entry
+
     def expire(self, mac, vlan):
         '''Delete Mac'''
         try:
-            entry = self.get_entry(mac, vlan)
+            entry = self._records[fdb_key(mac, vlan)]
             if entry.vlan is not None:
                 vlan.delete(entry)
                 self.delete_entry(entry)
         except KeyError:
             logging.error("tried to delete inexistent mac %s on vlan %s", mac, vlan)
 
+    def _deadline(self, entry):
+        '''Current expiry of an entry queued for aging, None if the
+           entry has been deleted or replaced since'''
+        if self._records.get(entry.key) is not entry:
+            return None
+        return entry.expiry
+
+    def age(self, now=None, alive=None):
+        '''Expire the entries which have not been refreshed for their age.
+           alive, if supplied, is called with the list of candidates and
+           returns the keys of those which are still present elsewhere,
+           f.e. in the kernel FDB - these are refreshed instead. Deletes
+           go through Vlan.delete and are batched with everything else.'''
+        if now is None:
+            now = time.time()
+        candidates = self._wheel.advance(now, self._deadline)
+        if not candidates:
+            return 0
+        keep = ()
+        if alive is not None:
+            keep = alive(candidates)
+        expired = 0
+        for entry in candidates:
+            if entry.key in keep:
+                entry.refresh()
+                self._wheel.schedule(entry, entry.expiry)
+            else:
+                logging.debug("Aging out %s on vlan %s", entry.mac, entry.vlan.vlan_no)
+                entry.vlan.delete(entry)
+                self.delete_entry(entry)
+                expired += 1
+        if expired:
+            logging.info("Aged out %d fdb entries", expired)
+            FDB_AGED.inc(amount=expired)
+        return expired
 
-def is_bmcast(mac):
-    '''Is the mac broadcast or multicast. As a
-       side effect, validates and parses the mac'''
 
+def mac_to_int(mac):
+    '''Validate and parse a mac into its integer form'''
+    if len(mac) == 17 and mac[2::3] == ":::::":
+        # canonical form, int() rejects anything but hex once signs,
+        # underscores, whitespace and non-ascii digits are ruled out
+        digits = mac.replace(":", "")
+        if digits.isalnum() and digits.isascii():
+            return int(digits, 16)
+        raise ValueError
     digits = mac.split(":")
     if len(digits) != 6:
         raise ValueError
+    result = 0
     for digit in digits:
         hex_form = int(digit, 16)
         if hex_form < 0 or hex_form > 0xff:
             raise ValueError
-    return (int(digits[0], 16) & 1) == 1
+        result = (result << 8) | hex_form
+    return result
+
+
+def fdb_key(mac, vlan):
+    '''FDB key for a mac on a vlan'''
+    return (vlan.vlan_no, mac_to_int(mac))
+
+
+def is_bmcast(mac):
+    '''Is the mac broadcast or multicast. As a
+       side effect, validates and parses the mac'''
+    return (mac_to_int(mac) >> 40) & 1 == 1
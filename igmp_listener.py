@@ -9,27 +9,79 @@
 
 import socket
 import logging
-import scapy.all as scapy
-from scapy.layers.l2 import Ether
+import struct
+from metrics import FEED_MESSAGES, FEED_ERRORS
+from pipeline import PortPipeline
+try:
+    import scapy.all as scapy
+    from scapy.layers.l2 import Ether
+except ImportError:
+    scapy = None
 
 
 MAXPACKET = 1500
+# room for the Ethernet header and a couple of tags on top of the MTU
+SNAPLEN = 2048
 MAX_COUNT = 128
+# shared snoop port of the tee transport
+SNOOP_NAME = "snoop"
+IGMP_IS_INCLUDE = 1
+IGMP_IS_EXCLUDE = 2
 IGMP_CH_INCLUDE = 3 # equivalent of LEAVE if SRC == 0
 IGMP_CH_EXCLUDE = 4 # equivalent of JOIN  if SRC == 0
+IGMP_ALLOW = 5
+IGMP_BLOCK = 6
+
+IGMP_V1_REPORT = 0x12
+IGMP_V2_REPORT = 0x16
+IGMP_V2_LEAVE = 0x17
+IGMP_V3_REPORT = 0x22
+
+ETH_P_IP = 0x0800
+ETH_P_8021Q = 0x8100
+ETH_P_8021AD = 0x88a8
+IPPROTO_IGMP = 2
+
+ETH_HDR = struct.Struct("!6s6sH")
+# destination and source, where a tag goes
+ETH_ADDRS = 12
+VLAN_HDR = struct.Struct("!HH")
+IP_HDR = struct.Struct("!B8xB")
+IGMP_HDR = struct.Struct("!B3x4s")
+IGMP_V3_HDR = struct.Struct("!B5xH")
+IGMP_V3_REC = struct.Struct("!BBH4s")
 
 
 class IGMPFeed(object):
     '''IGMP Listener'''
 
-    def __init__(self, upath, iface, bridge=None):
+    # debug only - parse with scapy instead of parse_igmp()
+    use_scapy = False
+
+    def __init__(self, upath, iface, bridge=None, budget=MAX_COUNT):
         self.iface = iface
         self._bridge = bridge
+        self._socket = None
+        # BESS has closed the socket, the feed is of no further use
+        self.closed = False
+        self._connect(upath)
+        self._buffer(budget)
+
+    def _connect(self, upath):
+        '''Connect to the UnixSocketPort of BESS'''
         self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
         self._socket.connect(upath)
         self._socket.setblocking(0)
-        scapy.load_contrib('igmpv3')
-        scapy.load_contrib('igmp')
+
+    def _buffer(self, budget):
+        '''Set up the receive buffers'''
+        # packets read in one iteration, preallocated and reused
+        self.budget = budget
+        self._buffers = [bytearray(SNAPLEN) for _ in range(budget)]
+        self._views = [memoryview(buf) for buf in self._buffers]
+        if self.use_scapy:
+            scapy.load_contrib('igmpv3')
+            scapy.load_contrib('igmp')
 
     def fileno(self):
         '''Underlying socket fileno'''
@@ -39,66 +91,272 @@ class IGMPFeed(object):
         '''Underlying socket fileno'''
         return self._socket.setblocking(arg)
 
+    def close(self):
+        '''Close the socket, the owner has to stop polling it first'''
+        self._socket.close()
+
+    def _event(self, kind, group, src):
+        '''Build an event for the switch main loop'''
+        return {
+            "type":kind,
+            "port":self.iface,
+            "mac":convert_to_mac(group),
+            "group":group,
+            "src":src, "bridge":self._bridge}
+
+    def _parse_raw(self, data):
+        '''Parse a snooped packet straight from the wire format'''
+        return [self._event(kind, group, src) for (kind, group, src) in parse_igmp(data)]
+
     def _parse(self, packet):
         '''Parse IGMP and other packets we track via pcap. Returns a mix of "learn" events which are the same
-           as in normal MAC learning and events for IGMP groups'''
+           as in normal MAC learning and events for IGMP groups. Uses scapy, kept for debugging
+           parse_igmp() which produces the same output.'''
+        # pylint: disable=import-outside-toplevel
+        from scapy.contrib.igmp import IGMP
+        from scapy.contrib.igmpv3 import IGMPv3mr
         result = []
 
         igmp = packet.getlayer(IGMPv3mr)
         if igmp is not None:
-            try:
-                for rec in igmp.fields['records']:
-                    for subrec in rec:
-                        if subrec.numsrc == 0 and subrec.rtype == IGMP_CH_INCLUDE:
-                                result.append({
-                                    "type":"MCAST_JOIN",
-                                    "port":self.iface,
-                                    "mac":convert_to_mac(subrec.maddr),
-                                    "group":subrec.maddr,
-                                    "src":packet.src, "bridge":self._bridge})
-                        else:
-                                result.append({
-                                    "type":"MCAST_LEAVE",
-                                    "port":self.iface,
-                                    "mac":convert_to_mac(subrec.maddr),
-                                    "group":subrec.maddr,
-                                    "src":packet.src, "bridge":self._bridge})
-                            
-            except TypeError: 
-                pass
+            for rec in igmp.records:
+                kind = record_event(rec.rtype, rec.numsrc)
+                if kind is not None:
+                    result.append(self._event(kind, rec.maddr, packet.src))
+            return result
+        igmp = packet.getlayer(IGMP)
+        if igmp is not None:
+            if igmp.type in (IGMP_V1_REPORT, IGMP_V2_REPORT):
+                result.append(self._event("MCAST_JOIN", igmp.gaddr, packet.src))
+            elif igmp.type == IGMP_V2_LEAVE:
+                result.append(self._event("MCAST_LEAVE", igmp.gaddr, packet.src))
         return result
+
     def initial_read(self):
         '''We have no means to read multicast state at start, we can only build it as we go along'''
         return []
 
+    def _receive(self):
+        '''Read up to budget packets into the preallocated buffers.
+           Returns views of the packets read.'''
+        packets = []
+        for _ in range(self.budget):
+            index = len(packets)
+            try:
+                (size, _, flags, _) = self._socket.recvmsg_into([self._buffers[index]])
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error as err:
+                logging.error("Snoop socket read failed on %s: %s", self.iface, err)
+                FEED_ERRORS.inc(("igmp", "read"))
+                break
+            if size == 0:
+                logging.error("Snoop socket closed on %s", self.iface)
+                self.closed = True
+                break
+            if flags & socket.MSG_TRUNC:
+                # cannot be reinjected either, there is nothing we can do with it
+                logging.error("Oversized snooped packet dropped on %s", self.iface)
+                FEED_ERRORS.inc(("igmp", "truncated"))
+                continue
+            packets.append(self._views[index][:size])
+        return packets
+
+    def _reinject(self, packets):
+        '''Send the snooped packets back to BESS in one go'''
+        for (index, packet) in enumerate(packets):
+            try:
+                self._socket.send(packet)
+            except (BlockingIOError, InterruptedError):
+                logging.error("Snoop socket full on %s, %d packets not reinjected",
+                              self.iface, len(packets) - index)
+                FEED_ERRORS.inc(("igmp", "reinject"))
+                return
+            except socket.error as err:
+                logging.error("Snoop socket write failed on %s: %s", self.iface, err)
+                FEED_ERRORS.inc(("igmp", "reinject"))
+                return
+
     def iteration(self):
-        '''Handle BESS Socket reads'''
+        '''Handle BESS Socket reads. At most budget packets are handled
+           per call so that a busy port cannot starve the other feeds,
+           anything left over is picked up on the next epoll wakeup'''
         execute = []
-        packets = []
+        packets = self._receive()
+        FEED_MESSAGES.inc(("igmp",), len(packets))
+        self._reinject(packets)
+        for data in packets:
+            execute.extend(self._parse_packet(data))
+        return execute
+
+    def _parse_packet(self, data):
+        '''Events of a snooped packet'''
         try:
-            count = 0
-            while count < MAX_COUNT:
-                data = self._socket.recv(65535)
-                packets.append(Ether(data))
-                self._socket.send(data)
-        except TypeError:
-            pass
-        except :
-            pass
-
-        for packet in packets:
+            if self.use_scapy:
+                return self._parse(Ether(data.tobytes()))
+            return self._parse_raw(data)
+        except KeyError:
+            return []
+
+
+class SnoopMux(IGMPFeed):
+    '''Snooped packets of all ports on one socket. Each port tees what
+       its snoop filter matches - the packet goes on to the linux bridge
+       as it is and a copy is tagged with the id of the port and sent to
+       a UnixSocketPort shared by all ports. The copies are only read,
+       nothing is written back to BESS.'''
+
+    def __init__(self, name=SNOOP_NAME, budget=MAX_COUNT):
+        # pylint: disable=super-init-not-called
+        self.name = name
+        self.iface = name
+        self._bridge = None
+        self._socket = None
+        self.closed = False
+        # tag to (port, vlan) and port name to tag
+        self._ports = {}
+        self._tags = {}
+        self._buffer(budget)
+
+    @property
+    def path(self):
+        '''Socket path of the shared port'''
+        return "/var/tmp/bess-{}".format(self.name)
+
+    @property
+    def out(self):
+        '''PortOut module the tagged copies of all ports go to'''
+        return "{}out".format(self.name)
+
+    def add(self, port, bridge):
+        '''Give a port a tag'''
+        tag = len(self._tags) + 1
+        self._tags[port.ifname] = tag
+        self._ports[tag] = (port, bridge)
+
+    def tag(self, port):
+        '''VLAN TCI marking the packets snooped on a port'''
+        return self._tags[port.ifname]
+
+    def snapshot(self):
+        '''Tags of the ports, BESS keeps pushing them over a warm restart'''
+        return dict(self._tags)
+
+    def restore(self, state):
+        '''Take the tags saved by snapshot()'''
+        ports = dict((port.ifname, (port, bridge)) for (port, bridge) in self._ports.values())
+        self._tags = dict(state)
+        self._ports = dict((tag, ports[name]) for (name, tag) in self._tags.items())
+
+    def pipeline(self):
+        '''Describe the shared snoop port'''
+        pipe = PortPipeline(self.name)
+        pipe.port("UnixSocketPort", self.name, {"path":self.path})
+        pipe.module("PortOut", self.out, {"port":self.name})
+        return pipe
+
+    def modules(self):
+        '''Names of the BESS modules of the shared snoop port'''
+        return [name for (_, name, _) in self.pipeline().modules]
+
+    def connect(self):
+        '''Connect once BESS has created the shared port'''
+        self._connect(self.path)
+
+    def iteration(self):
+        '''Handle up to budget snooped packets of any port. The events
+           carry the port a packet was tagged with.'''
+        execute = []
+        packets = self._receive()
+        FEED_MESSAGES.inc(("igmp",), len(packets))
+        for data in packets:
             try:
-                execute = execute + self._parse(packet)
-            except KeyError:
-                pass
+                (tpid, tag) = VLAN_HDR.unpack_from(data, ETH_ADDRS)
+                if tpid != ETH_P_8021Q:
+                    raise KeyError(tpid)
+                (self.iface, self._bridge) = self._ports[tag]
+            except (struct.error, KeyError):
+                logging.error("Snooped packet without a port tag dropped")
+                FEED_ERRORS.inc(("igmp", "untagged"))
+                continue
+            execute.extend(self._parse_packet(data))
+        (self.iface, self._bridge) = (self.name, None)
         return execute
 
+
+def record_event(rtype, numsrc):
+    '''Map an IGMPv3 group record to a JOIN/LEAVE event or None. We
+       switch on MAC, so any record which leaves the host receiving some
+       traffic for the group is a join - EXCLUDE of anything, INCLUDE or
+       ALLOW with sources. INCLUDE of nothing is a leave. BLOCK does not
+       change L2 membership.'''
+    if rtype in (IGMP_IS_EXCLUDE, IGMP_CH_EXCLUDE):
+        return "MCAST_JOIN"
+    if rtype in (IGMP_IS_INCLUDE, IGMP_CH_INCLUDE):
+        if numsrc == 0:
+            return "MCAST_LEAVE"
+        return "MCAST_JOIN"
+    if rtype == IGMP_ALLOW and numsrc != 0:
+        return "MCAST_JOIN"
+    return None
+
+
+def _dotted(raw):
+    '''IPv4 address bytes to dotted quad'''
+    return "{}.{}.{}.{}".format(raw[0], raw[1], raw[2], raw[3])
+
+
+def _mac(raw):
+    '''MAC bytes to string'''
+    return "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(
+        raw[0], raw[1], raw[2], raw[3], raw[4], raw[5])
+
+
+def parse_igmp(data):
+    '''Parse Ethernet, optional 802.1Q/802.1ad tags, IPv4 and IGMP
+       v1/v2/v3 headers in place. Returns a list of (event type, group,
+       source mac) tuples, empty for anything which is not a membership
+       report or leave. Truncated packets yield what could be parsed.'''
+    buf = memoryview(data)
+    result = []
+    try:
+        (_, src, ethertype) = ETH_HDR.unpack_from(buf, 0)
+        offset = ETH_HDR.size
+        while ethertype in (ETH_P_8021Q, ETH_P_8021AD):
+            ethertype = VLAN_HDR.unpack_from(buf, offset)[1]
+            offset += VLAN_HDR.size
+        if ethertype != ETH_P_IP:
+            return result
+        (ver_ihl, proto) = IP_HDR.unpack_from(buf, offset)
+        if ver_ihl >> 4 != 4 or proto != IPPROTO_IGMP:
+            return result
+        offset += (ver_ihl & 0xf) * 4
+        src = _mac(src)
+        igmp_type = buf[offset]
+        if igmp_type == IGMP_V3_REPORT:
+            records = IGMP_V3_HDR.unpack_from(buf, offset)[1]
+            offset += IGMP_V3_HDR.size
+            for _ in range(records):
+                (rtype, auxlen, numsrc, group) = IGMP_V3_REC.unpack_from(buf, offset)
+                offset += IGMP_V3_REC.size + (numsrc + auxlen) * 4
+                kind = record_event(rtype, numsrc)
+                if kind is not None:
+                    result.append((kind, _dotted(group), src))
+        elif igmp_type in (IGMP_V1_REPORT, IGMP_V2_REPORT):
+            result.append(("MCAST_JOIN", _dotted(IGMP_HDR.unpack_from(buf, offset)[1]), src))
+        elif igmp_type == IGMP_V2_LEAVE:
+            result.append(("MCAST_LEAVE", _dotted(IGMP_HDR.unpack_from(buf, offset)[1]), src))
+    except (struct.error, IndexError):
+        logging.debug("Truncated IGMP packet")
+    return result
+
+
 MCAST_OID = "01:00:5e"
 
 def convert_to_mac(ip):
     '''Convert an IP MCAST group address to its corresponding
        mac address'''
     digits = ip.split(".")
-    upper = int(digits[1], 16) & 0x7f
-    return "{}:{:x}:{:x}:{:x}".format(MCAST_OID, upper, 
+    upper = int(digits[1]) & 0x7f
+    return "{}:{:02x}:{:02x}:{:02x}".format(MCAST_OID, upper,
         int(digits[2]), int(digits[3]))
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+'''IGMP group membership timers'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import logging
+from aging import TimerWheel
+from metrics import MCAST_EXPIRED
+
+# RFC 3376 defaults, seconds
+DEFAULT_ROBUSTNESS = 2
+DEFAULT_QUERY_INTERVAL = 125
+DEFAULT_RESPONSE_INTERVAL = 10
+
+# per vlan settings and their defaults, igmp_expiry follows
+# igmp_querier unless it is set
+IGMP_DEFAULTS = {
+    "igmp_expiry":None,
+    "igmp_querier":False,
+    "igmp_robustness":DEFAULT_ROBUSTNESS,
+    "igmp_query_interval":DEFAULT_QUERY_INTERVAL,
+    "igmp_response_interval":DEFAULT_RESPONSE_INTERVAL,
+}
+
+
+def igmp_settings(config):
+    '''IGMP settings of a vlan config, defaults filled in. Memberships
+       only expire by default where we run the querier, without queries
+       hosts need not report again and would be dropped.'''
+    settings = dict((key, config.get(key, value)) for (key, value) in IGMP_DEFAULTS.items())
+    if settings["igmp_expiry"] is None:
+        settings["igmp_expiry"] = bool(settings["igmp_querier"])
+    return settings
+
+
+def membership_interval(settings):
+    '''Time after which a port which has not reported for a group is
+       no longer a member, the group membership interval of RFC 3376'''
+    return (settings["igmp_robustness"] * settings["igmp_query_interval"] +
+            settings["igmp_response_interval"])
+
+
+class _Member(object):
+    '''Timer of a port in a group'''
+    # pylint: disable=too-few-public-methods
+    __slots__ = ("key", "deadline")
+
+    def __init__(self, key, deadline):
+        self.key = key
+        self.deadline = deadline
+
+
+class Membership(object):
+    '''Membership timers of the ports in the multicast groups of all
+       vlans. A report restarts the timer of the reporting port for the
+       group, a port which has not reported for the membership interval
+       of its vlan is dropped from the group and the group goes with its
+       last port. Like FDB aging the timers sit on a timer wheel, a
+       refresh only moves the deadline. The ports of a group which
+       expire in the same tick leave it in one go.'''
+
+    def __init__(self, fdb, now):
+        self._fdb = fdb
+        # (vlan, mac, port) to its timer
+        self._members = {}
+        self._wheel = TimerWheel(now)
+
+    def __len__(self):
+        return len(self._members)
+
+    def report(self, mac, vlan, port, now):
+        '''A port reported membership of a group'''
+        if not vlan.igmp["igmp_expiry"]:
+            return
+        key = (vlan, mac, port)
+        deadline = now + membership_interval(vlan.igmp)
+        try:
+            self._members[key].deadline = deadline
+        except KeyError:
+            member = _Member(key, deadline)
+            self._members[key] = member
+            self._wheel.schedule(member, deadline)
+
+    def leave(self, mac, vlan, port):
+        '''A port left a group'''
+        self._members.pop((vlan, mac, port), None)
+
+    def _deadline(self, member):
+        '''Current deadline of a timer, None if it has been cancelled
+           or replaced since'''
+        if self._members.get(member.key) is not member:
+            return None
+        return member.deadline
+
+    def expire(self, now):
+        '''Drop the ports whose membership has run out. Returns the
+           number of memberships expired.'''
+        due = self._wheel.advance(now, self._deadline)
+        if not due:
+            return 0
+        groups = {}
+        expired = 0
+        for member in due:
+            if self._members.pop(member.key, None) is None:
+                continue
+            (vlan, mac, port) = member.key
+            groups.setdefault((vlan, mac), []).append(port)
+            expired += 1
+        for ((vlan, mac), ports) in groups.items():
+            logging.debug("Membership of %s on vlan %s expired for %s",
+                          mac, vlan.vlan_no, ", ".join(port.ifname for port in ports))
+            self._fdb.prune_mcast(mac, vlan, ports)
+        if expired:
+            logging.info("Expired %d multicast memberships", expired)
+            MCAST_EXPIRED.inc(amount=expired)
+        return expired
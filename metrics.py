@@ -0,0 +1,322 @@
+#!/usr/bin/python
+
+'''Control plane metrics for a BESS switch'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import bisect
+import logging
+import os
+import socket
+import threading
+
+# seconds, from well under a grpc round trip to a stalled main loop
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384, 65536)
+
+SCRAPE_TIMEOUT = 0.5
+# scrapers being answered at once, more are turned away
+MAX_SCRAPES = 4
+
+
+def _labels(names, values):
+    '''Prometheus label set'''
+    if not names:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, value) for (name, value) in zip(names, values)) + "}"
+
+
+class Counter(object):
+    '''Monotonic counter, optionally split by one or more labels'''
+
+    kind = "counter"
+
+    def __init__(self, registry, name, doc, labels=()):
+        self._registry = registry
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        '''Add to the counter'''
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        '''Current value'''
+        return self._values.get(labels, 0)
+
+    def render(self):
+        '''Sample lines'''
+        with self._lock:
+            values = list(self._values.items())
+        return ["{}{} {}".format(self.name, _labels(self.labels, labels), value)
+                for (labels, value) in sorted(values)]
+
+
+class Gauge(object):
+    '''Value read through a callback at scrape time, free otherwise. With
+       labels the callback returns a dict of label values to values.'''
+
+    kind = "gauge"
+
+    def __init__(self, name, doc, read, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        # public so that the owner of the value can hook itself in later
+        self.read = read
+
+    def render(self):
+        '''Sample lines'''
+        if not self.labels:
+            return ["{} {}".format(self.name, self.read())]
+        return ["{}{} {}".format(self.name, _labels(self.labels, labels), value)
+                for (labels, value) in sorted(self.read().items())]
+
+
+class Histogram(object):
+    '''Cumulative histogram with fixed buckets, optionally split by labels'''
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, doc, buckets, labels=()):
+        # pylint: disable=too-many-arguments
+        self._registry = registry
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # per label set: [counts per bucket + overflow, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        '''Record a sample'''
+        if not self._registry.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                (counts, total) = self._values[labels]
+            except KeyError:
+                counts = [0] * (len(self.buckets) + 1)
+                total = 0
+            counts[index] += 1
+            self._values[labels] = (counts, total + value)
+
+    def observe_many(self, values, labels=()):
+        '''Record a batch of samples under one lock'''
+        if not self._registry.enabled or not values:
+            return
+        indexes = [bisect.bisect_left(self.buckets, value) for value in values]
+        with self._lock:
+            try:
+                (counts, total) = self._values[labels]
+            except KeyError:
+                counts = [0] * (len(self.buckets) + 1)
+                total = 0
+            for index in indexes:
+                counts[index] += 1
+            self._values[labels] = (counts, total + sum(values))
+
+    def count(self, labels=()):
+        '''Number of samples'''
+        try:
+            return sum(self._values[labels][0])
+        except KeyError:
+            return 0
+
+    def render(self):
+        '''Sample lines'''
+        lines = []
+        with self._lock:
+            values = [(labels, list(counts), total)
+                      for (labels, (counts, total)) in self._values.items()]
+        for (labels, counts, total) in sorted(values):
+            names = self.labels + ("le",)
+            running = 0
+            for (bound, count) in zip(self.buckets + ("+Inf",), counts):
+                running += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, _labels(names, labels + (bound,)), running))
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.labels, labels), total))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.labels, labels), running))
+        return lines
+
+
+class Registry(object):
+    '''All metrics of the switch. Recording is a no-op until enable()
+       is called, which the switch only does when an endpoint has been
+       configured. Nothing is formatted until a scrape asks for it.'''
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = []
+
+    def enable(self, enabled=True):
+        '''Start or stop recording'''
+        self.enabled = enabled
+
+    def counter(self, name, doc, labels=()):
+        '''Register a counter'''
+        metric = Counter(self, name, doc, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, doc, read, labels=()):
+        '''Register a gauge read at scrape time'''
+        metric = Gauge(name, doc, read, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, doc, buckets=LATENCY_BUCKETS, labels=()):
+        '''Register a histogram'''
+        metric = Histogram(self, name, doc, buckets, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        '''All metrics in Prometheus text exposition format'''
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.doc))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            try:
+                lines.extend(metric.render())
+            # a broken gauge callback must not take the scrape down
+            # pylint: disable=broad-except
+            except Exception as err:
+                logging.error("Failed to render metric %s: %s", metric.name, err)
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Registry()
+
+EVENTS = METRICS.counter(
+    "bess_switch_events_total", "FDB and multicast events handled by type", ("type",))
+FEED_MESSAGES = METRICS.counter(
+    "bess_switch_feed_messages_total", "Messages read from the event feeds", ("feed",))
+FEED_ERRORS = METRICS.counter(
+    "bess_switch_feed_errors_total", "Event feed read and write failures", ("feed", "error"))
+BESS_CALLS = METRICS.counter(
+    "bess_switch_bess_calls_total", "Forwarder rule commands sent to BESS", ("command", "result"))
+BESS_LATENCY = METRICS.histogram(
+    "bess_switch_bess_call_seconds", "Forwarder rule command round trip time",
+    labels=("command",))
+BATCH_ENTRIES = METRICS.histogram(
+    "bess_switch_batch_entries", "Entries per forwarder rule command", SIZE_BUCKETS,
+    labels=("command",))
+FLUSHES = METRICS.counter(
+    "bess_switch_flushes_total", "Batched rule flushes")
+FDB_AGED = METRICS.counter(
+    "bess_switch_fdb_aged_total", "FDB entries removed by aging")
+MCAST_EXPIRED = METRICS.counter(
+    "bess_switch_mcast_expired_total", "Multicast memberships timed out without a leave")
+FDB_SIZE = METRICS.gauge(
+    "bess_switch_fdb_entries", "Entries in the FDB", lambda: 0)
+COALESCED = METRICS.counter(
+    "bess_switch_coalesced_total", "FDB updates superseded within the coalescing window")
+FLAPS = METRICS.counter(
+    "bess_switch_mac_flaps_total", "MACs moving to a port within the coalescing window",
+    ("port",))
+THROTTLED = METRICS.counter(
+    "bess_switch_learn_throttled_total", "Times a port ran out of learning tokens", ("port",))
+FWD_ENTRIES = METRICS.gauge(
+    "bess_switch_forwarder_entries", "Entries in the forwarder table of a port",
+    dict, ("port",))
+FWD_CAPACITY = METRICS.gauge(
+    "bess_switch_forwarder_capacity", "Size times bucket of the forwarder table of a port",
+    dict, ("port",))
+FWD_REBUILDS = METRICS.counter(
+    "bess_switch_forwarder_rebuilds_total", "Forwarders rebuilt with a larger table")
+PROGRAMMED = METRICS.histogram(
+    "bess_switch_event_programmed_seconds",
+    "Time from reading an event off a feed to its rules being in BESS")
+
+
+class MetricsServer(object):
+    '''Serves the registry on a unix stream socket. It sits in the main
+       loop epoll set like the other feeds - each wakeup accepts one
+       scraper and renders the current metrics, so gauges are read from
+       the main loop. Talking to the scraper is left to a thread, a slow
+       or stuck client must not hold up the switch. Plain HTTP/1.0 so
+       that curl --unix-socket or a proxy can scrape it.'''
+
+    def __init__(self, path, registry=METRICS):
+        self._path = path
+        self._registry = registry
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen(4)
+        self._socket.setblocking(0)
+        self._scrapes = threading.BoundedSemaphore(MAX_SCRAPES)
+        registry.enable()
+
+    def fileno(self):
+        '''Listening socket fileno'''
+        return self._socket.fileno()
+
+    def setblocking(self, arg):
+        '''Set blocking/non-blocking'''
+        return self._socket.setblocking(arg)
+
+    def initial_read(self):
+        '''There is no state to load'''
+        return []
+
+    def iteration(self):
+        '''Answer a scrape. Never produces events.'''
+        try:
+            (client, _) = self._socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return []
+        if not self._scrapes.acquire(False):
+            logging.error("Too many metrics scrapes in progress, dropping one")
+            client.close()
+            return []
+        body = self._registry.render().encode()
+        thread = threading.Thread(target=self._answer, args=(client, body))
+        thread.daemon = True
+        thread.start()
+        return []
+
+    def _answer(self, client, body):
+        '''Send a rendered scrape, runs in its own thread'''
+        try:
+            client.settimeout(SCRAPE_TIMEOUT)
+            try:
+                # the request itself is of no interest, read it so that
+                # closing does not reset the connection under the client
+                client.recv(4096)
+            except socket.timeout:
+                pass
+            client.sendall(
+                "HTTP/1.0 200 OK\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                "Content-Length: {}\r\n\r\n".format(len(body)).encode() + body)
+        except socket.error as err:
+            logging.error("Metrics scrape failed: %s", err)
+        finally:
+            client.close()
+            self._scrapes.release()
+
+    def close(self):
+        '''Stop serving'''
+        self._socket.close()
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
@@ -9,8 +9,11 @@
 import logging
 import time
 import socket
+import struct
 from pyroute2 import IPRoute
 from pyroute2.config import AF_BRIDGE
+from metrics import FEED_MESSAGES, FEED_ERRORS
+from provision import LinkProvisioner
 
 NUD_REACHABLE = 0x2
 NUD_STALE = 0x4
@@ -19,11 +22,126 @@ NUD_MASK = (NUD_REACHABLE | NUD_STALE)
 
 DEFAULT_AGE = 300
 
+NETLINK_ROUTE = 0
+SO_RCVBUFFORCE = 33
+RTMGRP_NEIGH = 0x4
+NLMSG_ERROR = 0x2
+NLMSG_OVERRUN = 0x4
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+NDA_LLADDR = 2
+NDA_MASTER = 9
+NLA_TYPE_MASK = 0x3fff
+
+NLMSG_HDR = struct.Struct("=IHHII")
+NDMSG = struct.Struct("=BxxxiHBB")
+RTATTR = struct.Struct("=HH")
+U32 = struct.Struct("=I")
+
+RAW_BUFFER = 1 << 16
+RAW_RCVBUF = 1 << 22
+RAW_BUDGET = 64
+
+
+class RawNeighbourSocket(object):
+    '''Bare rtnetlink socket subscribed to the neighbour group only.
+       Messages are decoded in place from a reused buffer and anything
+       which is not a bridge FDB update is dropped after looking at the
+       ndmsg header, without touching the attributes.'''
+    def __init__(self, budget=RAW_BUDGET):
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        try:
+            # we run as root, force a buffer which can take a MAC flood
+            self._socket.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, RAW_RCVBUF)
+        except socket.error:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RAW_RCVBUF)
+        self._socket.bind((0, RTMGRP_NEIGH))
+        self._buffer = bytearray(RAW_BUFFER)
+        self._view = memoryview(self._buffer)
+        self.budget = budget
+
+    def fileno(self):
+        '''File descriptor for epoll loop'''
+        return self._socket.fileno()
+
+    def setblocking(self, arg):
+        '''Set blocking/non-blocking'''
+        return self._socket.setblocking(arg)
+
+    def read(self):
+        '''Read up to budget datagrams, returns the decoded bridge FDB
+           events. Raises socket.error if there was nothing to read.'''
+        execute = []
+        for count in range(self.budget):
+            try:
+                size = self._socket.recv_into(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                if count == 0:
+                    raise
+                break
+            except socket.error as err:
+                # ENOBUFS - we have lost messages, aging will catch up
+                logging.error("Netlink socket error: %s", err)
+                FEED_ERRORS.inc(("netlink", "read"))
+                break
+            decode_neighbours(self._view[:size], execute)
+        return execute
+
+
+def decode_neighbours(buf, execute):
+    '''Decode the bridge FDB updates in a netlink datagram, appending
+       them to execute in the same form as NetlinkFeed._parse()'''
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(buf):
+        (length, mtype, _, _, _) = NLMSG_HDR.unpack_from(buf, offset)
+        if length < NLMSG_HDR.size:
+            break
+        end = offset + length
+        body = offset + NLMSG_HDR.size
+        offset = (end + 3) & ~3
+        if mtype not in (RTM_NEWNEIGH, RTM_DELNEIGH):
+            if mtype in (NLMSG_ERROR, NLMSG_OVERRUN):
+                logging.error("Netlink error message type %d", mtype)
+            continue
+        (family, ifindex, state, _, _) = NDMSG.unpack_from(buf, body)
+        if family != AF_BRIDGE or not state & NUD_MASK or state & NUD_PERMANENT:
+            continue
+        mac = None
+        bridge = None
+        attr = body + NDMSG.size
+        while attr + RTATTR.size <= end:
+            (alen, atype) = RTATTR.unpack_from(buf, attr)
+            if alen < RTATTR.size:
+                break
+            atype &= NLA_TYPE_MASK
+            if atype == NDA_LLADDR and alen == RTATTR.size + 6:
+                mac = ":".join("{:02x}".format(octet) for octet in
+                               buf[attr + RTATTR.size:attr + alen])
+            elif atype == NDA_MASTER:
+                bridge = U32.unpack_from(buf, attr + RTATTR.size)[0]
+            attr += (alen + 3) & ~3
+        if bridge is None or mac is None:
+            logging.error("Failed to parse neighbour message for ifindex %d", ifindex)
+            continue
+        if mtype == RTM_NEWNEIGH:
+            kind = "RTM_NEWNEIGH"
+        else:
+            kind = "RTM_DELNEIGH"
+        execute.append({"type":kind, "bridge_name":bridge, "mac":mac, "port_name":ifindex})
+
 
 class NetlinkFeed(object):
-    def __init__(self):
+    '''Bridge FDB updates from the kernel. Uses pyroute2 for everything,
+       or only for dumps and lookups if raw is set, with updates read
+       by a RawNeighbourSocket. With listen unset it does not subscribe
+       to updates at all and only serves dumps, lookups and provisioning.'''
+    def __init__(self, raw=False, listen=True):
         self._ipr = IPRoute()
-        self._ipr.bind()
+        self._raw = None
+        if listen and raw:
+            self._raw = RawNeighbourSocket()
+        elif listen:
+            self._ipr.bind()
         self._index_to_name = {}
         self.rebuild_index()
 
@@ -39,10 +157,14 @@ class NetlinkFeed(object):
 
     def fileno(self):
         '''File descriptor for epoll loop'''
+        if self._raw is not None:
+            return self._raw.fileno()
         return self._ipr.fileno()
-        
+
     def setblocking(self, arg):
         '''Set blocking/non-blocking'''
+        if self._raw is not None:
+            return self._raw.setblocking(arg)
         return self._ipr.setblocking(arg)
 
     def _parse(self, mess):
@@ -74,13 +196,31 @@ class NetlinkFeed(object):
                 pass
         return execute
 
+    def dump(self):
+        '''Read the FDB state while the feed is in use by the main loop'''
+        if self._raw is not None:
+            return self.initial_read()
+        self._ipr.setblocking(1)
+        try:
+            return self.initial_read()
+        finally:
+            self._ipr.setblocking(0)
+
     def iteration(self):
         '''Handle Netlink messages'''
+        if self._raw is not None:
+            try:
+                execute = self._raw.read()
+            except socket.error:
+                return
+            FEED_MESSAGES.inc(("netlink",), len(execute))
+            return execute
         execute = []
         try:
             messages = self._ipr.get()
         except socket.error:
             return
+        FEED_MESSAGES.inc(("netlink",), len(messages))
         for mess in messages:
             try:
                 if mess["family"] == AF_BRIDGE and (mess["state"] & NUD_MASK):
@@ -89,6 +229,10 @@ class NetlinkFeed(object):
                 pass
         return execute
 
+    def provisioner(self):
+        '''Link provisioner sharing our IPRoute'''
+        return LinkProvisioner(self._ipr)
+
     def lookup_by_name(self, name):
         '''Lookup the index of an interface'''
         return self._ipr.link_lookup(ifname=name)[0]
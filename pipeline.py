@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+'''Declarative construction of the BESS pipelines of switch ports'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import logging
+import time
+from fanout import FanOut, report
+
+STAGES = ("ports", "modules", "commands", "links", "tasks")
+
+
+class PortPipeline(object):
+    '''The BESS ports, modules, commands and connections making up the
+       datapath of one switch port, described up front so that they can
+       be created stage by stage for many ports at once'''
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.ports = []
+        self.modules = []
+        self.commands = []
+        self.links = []
+        self.tasks = []
+        # task to worker, filled in by the builder
+        self.placed = []
+
+    def __repr__(self):
+        '''Official representation'''
+        return "Pipeline: {}".format(self.owner)
+
+    def port(self, driver, name, arg):
+        '''Add a port, returns its name'''
+        self.ports.append((driver, name, arg))
+        return name
+
+    def module(self, mclass, name, arg):
+        '''Add a module, returns its name'''
+        self.modules.append((mclass, name, arg))
+        return name
+
+    def command(self, name, cmd, arg_type, arg):
+        '''Add a module command to be run once the modules exist'''
+        self.commands.append((name, cmd, arg_type, arg))
+
+    def connect(self, src, dst, ogate=0, igate=0):
+        '''Add a connection between two modules'''
+        self.links.append((src, dst, ogate, igate))
+
+    def task(self, name, cores, weight=1):
+        '''Add a module task which may run on any of a list of cores.
+           The weight is what it adds to the load of its worker.'''
+        self.tasks.append((name, cores, weight))
+
+
+class Placement(object):
+    '''Spreads module tasks over BESS workers, one worker per core.
+       Each task goes to the least loaded of the cores it may run on, so
+       the queues of a port end up on different cores and no core gets
+       piled onto while another one idles.'''
+
+    def __init__(self):
+        # core to worker id and to the load placed on it
+        self.workers = {}
+        self._load = {}
+        self._created = set()
+        self._synced = False
+
+    def sync(self, bess):
+        '''Pick up the workers BESS already has, once. The load on them
+           is not known, they count as idle.'''
+        if self._synced:
+            return
+        self._synced = True
+        for worker in bess.list_workers().workers_status:
+            self.workers[worker.core] = worker.wid
+            self._created.add(worker.wid)
+
+    def load(self, core):
+        '''Load placed on a core'''
+        return self._load.get(core, 0)
+
+    def _worker(self, core):
+        '''Worker id of a core, a new one if it has none yet'''
+        if core not in self.workers:
+            used = set(self.workers.values())
+            self.workers[core] = min(set(range(len(used) + 1)) - used)
+        return self.workers[core]
+
+    def reserve(self, cores):
+        '''Have a worker on each of a list of cores without placing
+           anything on them'''
+        for core in cores:
+            self._worker(core)
+
+    def place(self, cores, weight=1):
+        '''Pick the worker for a task, returns its id'''
+        core = min(cores, key=lambda core: (self.load(core), core))
+        self._load[core] = self.load(core) + weight
+        return self._worker(core)
+
+    def create(self, bess):
+        '''Create the workers which do not exist yet'''
+        for (core, wid) in sorted(self.workers.items(), key=lambda item: item[1]):
+            if wid not in self._created:
+                logging.debug("Worker %d on core %d", wid, core)
+                bess.add_worker(wid, core)
+                self._created.add(wid)
+
+
+class PipelineBuilder(object):
+    '''Creates a set of PortPipelines in BESS. Each stage is done for
+       all pipelines before the next one starts, with the pipelines of
+       different ports handled concurrently. Tasks are placed on workers
+       by a Placement, which creates the workers before anything else.
+       The caller resumes BESS once when everything is in place.'''
+
+    def __init__(self, bess, fanout=None, placement=None):
+        self._bess = bess
+        if fanout is None:
+            fanout = FanOut(1)
+        self._fanout = fanout
+        if placement is None:
+            placement = Placement()
+        self.placement = placement
+        self.timings = {}
+
+    def _ports(self, pipe):
+        '''Create the ports of a pipeline'''
+        for (driver, name, arg) in pipe.ports:
+            logging.debug("Port %s %s for %s", driver, name, pipe.owner)
+            self._bess.create_port(driver, name, arg)
+
+    def _modules(self, pipe):
+        '''Create the modules of a pipeline'''
+        for (mclass, name, arg) in pipe.modules:
+            logging.debug("Module %s %s for %s", mclass, name, pipe.owner)
+            self._bess.create_module(mclass, name, arg)
+
+    def _commands(self, pipe):
+        '''Run the module commands of a pipeline'''
+        for (name, cmd, arg_type, arg) in pipe.commands:
+            self._bess.run_module_command(name, cmd, arg_type, arg)
+
+    def _links(self, pipe):
+        '''Wire up a pipeline'''
+        for (src, dst, ogate, igate) in pipe.links:
+            self._bess.connect_modules(src, dst, ogate=ogate, igate=igate)
+
+    def _tasks(self, pipe):
+        '''Attach the tasks of a pipeline to their workers'''
+        for (name, wid) in pipe.placed:
+            self._bess.attach_task(name, wid=wid)
+
+    def build(self, pipelines):
+        '''Create all pipelines, returns the time spent per stage. The
+           first failure is raised once its stage has completed for all
+           other pipelines.'''
+        pipelines = list(pipelines)
+        self.timings = {}
+        started = time.time()
+        self.placement.sync(self._bess)
+        for pipe in pipelines:
+            pipe.placed = [(name, self.placement.place(cores, weight))
+                           for (name, cores, weight) in pipe.tasks]
+        self.placement.create(self._bess)
+        for stage in STAGES:
+            start = time.time()
+            failures = self._fanout.run(pipelines, getattr(self, "_" + stage))
+            self.timings[stage] = time.time() - start
+            if failures:
+                report(failures, "Pipeline {}".format(stage))
+                raise list(failures.values())[0]
+        self.timings["total"] = time.time() - started
+        logging.info("Built %d port pipelines in %.3fs (%s)", len(pipelines),
+                     self.timings["total"], ", ".join(
+                         "{} {:.3f}s".format(stage, self.timings[stage]) for stage in STAGES))
+        return self.timings
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+'''In process provisioning of the linux side of the switch'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import errno
+import logging
+from pyroute2 import NetlinkError
+
+
+class LinkProvisioner(object):
+    '''Creates bridges, enslaves ports and sets link state over an
+       existing pyroute2 IPRoute instead of forking brctl and ip for
+       every interface. Interface indexes are resolved from a single
+       link dump which is only redone when a name is not found.'''
+
+    def __init__(self, ipr):
+        self._ipr = ipr
+        self._indexes = {}
+
+    def refresh(self):
+        '''Rebuild the name to index map with one link dump'''
+        self._indexes = {}
+        for iface in self._ipr.get_links():
+            for (attr, value) in iface["attrs"]:
+                if attr == 'IFLA_IFNAME':
+                    self._indexes[value] = iface["index"]
+                    break
+        return self._indexes
+
+    def index(self, name):
+        '''Index of an interface'''
+        try:
+            return self._indexes[name]
+        except KeyError:
+            return self.refresh()[name]
+
+    def resolve(self, names):
+        '''Indexes of a list of interfaces, dumps the links at most once'''
+        if any(name not in self._indexes for name in names):
+            self.refresh()
+        return dict((name, self._indexes[name]) for name in names)
+
+    def create_bridge(self, name):
+        '''Create a linux bridge, an existing one is reused'''
+        logging.debug("Creating Bridge %s", name)
+        try:
+            self._ipr.link("add", ifname=name, kind="bridge")
+        except NetlinkError as err:
+            if err.code != errno.EEXIST:
+                raise
+            logging.debug("Bridge %s already exists", name)
+
+    def enslave(self, bridge, names):
+        '''Add a list of interfaces to a bridge'''
+        indexes = self.resolve([bridge] + list(names))
+        for name in names:
+            logging.debug("Adding interface %s to Bridge %s", name, bridge)
+            self._ipr.link("set", index=indexes[name], master=indexes[bridge])
+
+    def set_isolated(self, names, isolated):
+        '''Make a list of bridge ports isolated, or not. Isolated ports
+           do not forward to each other, only to and from the bridge
+           itself and ports which are not isolated.'''
+        indexes = self.resolve(names)
+        flag = 1 if isolated else 0
+        for name in names:
+            logging.debug("Isolation of %s %s", name, "on" if isolated else "off")
+            self._ipr.brport("set", index=indexes[name], isolated=flag)
+
+    def set_querier(self, bridge, interval, response):
+        '''Make a bridge send IGMP general queries every interval
+           seconds, hosts answer within response seconds'''
+        index = self.index(bridge)
+        logging.debug("IGMP querier on %s every %ds", bridge, interval)
+        # intervals are in centiseconds
+        self._ipr.link("set", index=index, kind="bridge", br_mcast_snooping=1,
+                       br_mcast_querier=1, br_mcast_query_intvl=interval * 100,
+                       br_mcast_query_response_intvl=response * 100)
+
+    def set_state(self, names, state):
+        '''Set a list of interfaces up or down'''
+        indexes = self.resolve(names)
+        for name in names:
+            logging.debug("Link %s %s", name, state)
+            self._ipr.link("set", index=indexes[name], state=state)
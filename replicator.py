@@ -0,0 +1,218 @@
+#!/usr/bin/python
+
+'''Forwarder gate allocation and multicast replicator management'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import functools
+import logging
+
+
+class GateAllocator(object):
+    '''Hands out forwarder output gates. Released gates go on a free
+       list and are reused before new ones are taken, both O(1).'''
+
+    def __init__(self, first=1):
+        self._first = first
+        self._next = first
+        self._free = []
+
+    def alloc(self):
+        '''Get a free gate'''
+        if self._free:
+            return self._free.pop()
+        gate = self._next
+        self._next += 1
+        return gate
+
+    def release(self, gate):
+        '''Return a gate to the free list'''
+        self._free.append(gate)
+
+    @property
+    def in_use(self):
+        '''Number of gates handed out'''
+        return self._next - self._first - len(self._free)
+
+    def snapshot(self):
+        '''State for a warm restart'''
+        return [self._next, list(self._free)]
+
+    def restore(self, state):
+        '''Pick up the state saved by snapshot()'''
+        (self._next, self._free) = (state[0], list(state[1]))
+
+
+class ReplicatorManager(object):
+    '''The Replicate modules hanging off one forwarder, one per set of
+       destination ports. Each forwarder entry pointing at a replicator
+       holds a reference to it. When the last reference goes, the
+       replicator is disconnected and destroyed and its forwarder gate
+       is returned to the allocator.'''
+
+    def __init__(self, bess, owner, gates, port_gate, hout_port):
+        # pylint: disable=too-many-arguments
+        self._bess = bess
+        # the port owning the forwarder, only its names are used
+        self._owner = owner
+        self._gates = gates
+        # port name to the gate used for it on the forwarder and to its
+        # PortOut module, replicators reuse the forwarder gate numbering
+        self._port_gate = port_gate
+        self._hout_port = hout_port
+        self._replicators = {}
+
+    def __len__(self):
+        return len(self._replicators)
+
+    @property
+    def forwarders(self):
+        '''Names of the forwarders the replicators hang off, one per
+           receive queue of the port'''
+        return self._owner.forwarders
+
+    def name(self, gate):
+        '''Module name of the replicator behind a forwarder gate. Names
+           follow the gate rather than the port set as the set of a
+           replicator changes with group membership'''
+        return "rep{}g{}".format(self._owner.ifname, gate)
+
+    def gate(self, key):
+        '''Forwarder gate of an existing replicator or None'''
+        try:
+            return self._replicators[key]["gate"]
+        except KeyError:
+            return None
+
+    def exclusive(self, key):
+        '''Is the replicator for a key held by a single entry'''
+        try:
+            return self._replicators[key]["refs"] == 1
+        except KeyError:
+            return False
+
+    def _wire(self, name, port_names):
+        '''Connect a replicator to the PortOuts of a list of ports
+           using the same gate mapping as the L2Forwarder'''
+        for port_name in port_names:
+            hout = self._hout_port(port_name)
+            if hout is not None:
+                self._bess.connect_modules(name, hout, ogate=self._port_gate(port_name))
+
+    def _set_gates(self, name, port_names):
+        '''Tell a replicator which of its gates to copy packets to'''
+        gate_list = []
+        for port_name in port_names:
+            if self._hout_port(port_name) is not None:
+                gate_list.append(self._port_gate(port_name))
+        self._bess.run_module_command(
+            name, "set_gates", "ReplicateCommandSetGatesArg", {"gates":gate_list})
+
+    @staticmethod
+    def _run(calls, func, *args):
+        '''Make a BESS call now, or add it to calls if a list is given'''
+        if calls is None:
+            func(*args)
+        else:
+            calls.append(functools.partial(func, *args))
+
+    def _create(self, name, gate, port_names):
+        '''Create a replicator and wire it up'''
+        self._bess.create_module("Replicate", name, {"gates":[]})
+        self._wire(name, port_names)
+        self._set_gates(name, port_names)
+        logging.debug("Wiring %s to gate %d on port %s", name, gate, self._owner.ifname)
+        for forwarder in self.forwarders:
+            self._bess.connect_modules(forwarder, name, ogate=gate)
+
+    def _rewire(self, name, new_ports, port_names):
+        '''Connect the new ports of a replicator and replace its gates'''
+        self._wire(name, new_ports)
+        self._set_gates(name, port_names)
+
+    def acquire(self, key, port_names, calls=None):
+        '''Take a reference to the replicator for a set of ports, creating
+           it if needed. Returns the forwarder gate leading to it. With a
+           calls list the BESS side is left to the caller, who has to
+           run the calls before the rules pointing at the gate go in.'''
+        try:
+            rep = self._replicators[key]
+            rep["refs"] += 1
+            logging.debug("Reusing existing replicator for %s %s", self._owner.ifname, key)
+            return rep["gate"]
+        except KeyError:
+            pass
+        gate = self._gates.alloc()
+        logging.debug("Replicate  %s %s", self._owner.ifname, port_names)
+        self._run(calls, self._create, self.name(gate), gate, list(port_names))
+        self._replicators[key] = {"gate":gate, "refs":1, "wired":set(port_names)}
+        return gate
+
+    def rekey(self, old_key, new_key, port_names, calls=None):
+        '''Change the port set of a replicator in place. The gate list
+           is replaced with one set_gates, ports which left stay wired as
+           set_gates decides where copies go, so only ports never seen by
+           this replicator need connecting. The forwarder rules pointing
+           at the replicator stay as they are. calls as for acquire().'''
+        rep = self._replicators.pop(old_key)
+        name = self.name(rep["gate"])
+        logging.debug("Regroup %s %s -> %s", name, old_key, new_key)
+        new_ports = [port for port in port_names if port not in rep["wired"]]
+        self._replicators[new_key] = rep
+        self._run(calls, self._rewire, name, new_ports, list(port_names))
+        rep["wired"].update(new_ports)
+        return rep["gate"]
+
+    def modules(self):
+        '''Names of the replicator modules'''
+        return [self.name(rep["gate"]) for rep in self._replicators.values()]
+
+    def gates(self):
+        '''Forwarder gates leading to replicators'''
+        return [rep["gate"] for rep in self._replicators.values()]
+
+    def snapshot(self):
+        '''State for a warm restart, references are not saved as they
+           follow from the entries holding them'''
+        return dict((key, [rep["gate"], sorted(rep["wired"])])
+                    for (key, rep) in self._replicators.items())
+
+    def restore(self, state, refs):
+        '''Pick up replicators left in BESS by a previous run. refs maps
+           keys to the number of entries pointing at them, one nothing
+           points at is held once so that it can be released.'''
+        self._replicators = {}
+        for (key, (gate, wired)) in state.items():
+            self._replicators[key] = {"gate":gate, "refs":refs.get(key, 1), "wired":set(wired)}
+
+    def release(self, key):
+        '''Drop a reference to a replicator, tearing it down with the
+           last one'''
+        rep = self._replicators.get(key)
+        if rep is None:
+            logging.error("Release of unknown replicator %s on %s", key, self._owner.ifname)
+            return
+        rep["refs"] -= 1
+        if rep["refs"] > 0:
+            return
+        del self._replicators[key]
+        logging.debug("Destroying replicator %s on %s", key, self._owner.ifname)
+        try:
+            for forwarder in self.forwarders:
+                self._bess.disconnect_modules(forwarder, ogate=rep["gate"])
+        # the exceptions barfed by the grpc stack are anything but "well defined"
+        # pylint: disable=bare-except
+        except:
+            # still wired, do not hand the gate out again
+            logging.error("Failed to disconnect replicator %s on %s", key, self._owner.ifname)
+            return
+        try:
+            self._bess.destroy_module(self.name(rep["gate"]))
+        # pylint: disable=bare-except
+        except:
+            # the name goes with the gate, keep both out of circulation
+            logging.error("Failed to destroy replicator %s on %s", key, self._owner.ifname)
+            return
+        self._gates.release(rep["gate"])
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+'''asyncio runtime for a BESS switch'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import asyncio
+import functools
+import logging
+import signal
+import time
+from fanout import report
+from metrics import FLUSHES, PROGRAMMED
+
+# longest sleep between housekeeping passes
+IDLE_TIMEOUT = 0.5
+
+
+class AsyncRuntime(object):
+    '''Runs a Switch on an asyncio event loop instead of the epoll main
+       loop. Feeds are readers on the loop and rule batches go to BESS
+       on the fan-out thread pool, reading carries on while they are in
+       flight. Each forwarder has at most batcher.inflight batches on
+       their way, a forwarder which is slow to answer only holds up its
+       own rules. Batches in flight to a forwarder never share a MAC
+       so the order in which they land does not matter.'''
+
+    def __init__(self, switch):
+        self._switch = switch
+        self._batcher = switch.batcher
+        self._batcher.pipelined = True
+        self._loop = None
+        self._wakeup = None
+        self._idle = None
+        # port to the number of its batches in flight
+        self._busy = {}
+
+    @property
+    def inflight(self):
+        '''Batches in flight over all forwarders'''
+        return sum(self._busy.values())
+
+    def _ready(self, port):
+        '''Does a port have room for another batch in flight'''
+        return self._busy.get(port, 0) < self._batcher.inflight
+
+    def _readable(self, feed):
+        '''Reader callback of a feed'''
+        self._switch.read(feed, time.time())
+        if getattr(feed, "closed", False):
+            self._loop.remove_reader(feed.fileno())
+            self._switch.drop_feed(feed)
+        if self._batcher.due():
+            self.flush()
+        # the main task runs after the other feeds ready in this round
+        self._wakeup.set()
+
+    def _request_resync(self):
+        '''SIGUSR1 handler'''
+        self._switch.request_resync()
+        self._wakeup.set()
+
+    def flush(self):
+        '''Send the queued changes of every forwarder which has room for
+           another batch in flight. Does not wait for any of them.'''
+        (ports, stamps) = self._batcher.take(self._ready)
+        futures = []
+        for port in ports:
+            batch = port.take()
+            if batch is None:
+                continue
+            self._busy[port] = self._busy.get(port, 0) + 1
+            self._idle.clear()
+            future = self._loop.run_in_executor(
+                self._batcher.fanout.executor(), port.send, batch)
+            future.add_done_callback(functools.partial(self._settle, port, batch))
+            futures.append(future)
+        if futures:
+            FLUSHES.inc()
+            logging.debug("Sent rule batches for %d ports", len(futures))
+        if not stamps:
+            return
+
+        def programmed(_):
+            '''All batches carrying the events are in'''
+            done = time.time()
+            PROGRAMMED.observe_many([done - stamp for stamp in stamps])
+        if futures:
+            asyncio.gather(*futures, return_exceptions=True).add_done_callback(programmed)
+        else:
+            programmed(None)
+
+    def _settle(self, port, batch, future):
+        '''A batch is back from BESS'''
+        count = self._busy[port] - 1
+        if count:
+            self._busy[port] = count
+        else:
+            del self._busy[port]
+        try:
+            failed = future.result()
+        # the exceptions barfed by the grpc stack are anything but "well defined"
+        # pylint: disable=broad-except
+        except Exception as err:
+            port.settle(batch, None)
+            report({port:err}, "Rule update")
+        else:
+            port.settle(batch, failed)
+            if failed:
+                report({port:failed}, "Rule update")
+        if port.pending:
+            # changes held back while the batch was in flight
+            self._batcher.mark(port)
+        if not self._busy:
+            self._idle.set()
+        self._wakeup.set()
+
+    async def run(self, until=None):
+        '''Serve the feeds, after each wakeup until() is asked whether to
+           stop, without it the runtime runs forever'''
+        self._loop = asyncio.get_event_loop()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        feeds = self._switch.feeds
+        for feed in feeds:
+            feed.setblocking(0)
+            self._loop.add_reader(feed.fileno(), self._readable, feed)
+        try:
+            while True:
+                timeout = self._switch.timeout(IDLE_TIMEOUT, time.time())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                if self._switch.resync_requested:
+                    # the shadow tables have to be settled
+                    await self._idle.wait()
+                    self._switch.resync()
+                self._switch.housekeeping(time.time())
+                self.flush()
+                if until is not None and until():
+                    return
+        finally:
+            # less any feed dropped on the way
+            for feed in self._switch.feeds:
+                self._loop.remove_reader(feed.fileno())
+
+    def main_loop(self):
+        '''Sync the initial state and run forever'''
+        self._switch.start(register=False)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.add_signal_handler(signal.SIGUSR1, self._request_resync)
+        try:
+            loop.run_until_complete(self.run())
+        finally:
+            if self._idle is not None:
+                # let the batches in flight settle, the shadow tables
+                # are saved on the way out
+                loop.run_until_complete(self._idle.wait())
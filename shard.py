@@ -0,0 +1,297 @@
+#!/usr/bin/python
+
+'''Multi-process control plane, vlans sharded over worker processes'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import logging
+import multiprocessing
+import queue
+import threading
+from select import epoll
+from igmp_listener import IGMPFeed
+from netlink_listener import NetlinkFeed
+from pipeline import Placement
+from switch import Switch
+from vlan import Vlan
+
+# message batches handed out per worker feed iteration
+DEFAULT_BATCHES = 16
+# batches waiting for a worker before they are dropped
+SHARD_QUEUE = 1024
+READY = "ready"
+# in place of a batch, the worker reads the kernel FDB of its bridges
+RECONCILE = "reconcile"
+
+
+def assign(vlans, shards):
+    '''Split vlan configs into shards with about the same number of
+       ports each, the largest vlans are placed first'''
+    loads = [0] * shards
+    result = [[] for _ in range(shards)]
+    for vlan in sorted(vlans, key=lambda vlan: len(vlan["ports"]), reverse=True):
+        index = loads.index(min(loads))
+        result[index].append(vlan)
+        loads[index] += len(vlan["ports"])
+    return [vlans for vlans in result if vlans]
+
+
+def connect_bess():
+    '''Default BESS connection of a worker'''
+    # pylint: disable=import-outside-toplevel
+    from pybess.bess import BESS
+    bess = BESS()
+    bess.connect()
+    return bess
+
+
+def kernel_netlink():
+    '''Default kernel access of a worker - dumps, lookups and
+       provisioning only, updates come from the dispatcher'''
+    return NetlinkFeed(listen=False)
+
+
+class ShardFeed(object):
+    '''The netlink feed of a worker. Updates are the batches routed to
+       it by the dispatcher, everything else goes to the kernel through
+       a non-listening netlink feed of its own.'''
+
+    def __init__(self, conn, netlink, bridges, budget=DEFAULT_BATCHES):
+        self._conn = conn
+        self._nl = netlink
+        self._bridges = bridges
+        self.budget = budget
+
+    def fileno(self):
+        '''File descriptor for epoll loop'''
+        return self._conn.fileno()
+
+    def setblocking(self, arg):
+        '''Only ever read when there is something to read'''
+        pass
+
+    def _ours(self, messages):
+        '''The messages for our bridges'''
+        indexes = set(self._nl.provisioner().resolve(self._bridges).values())
+        return [mess for mess in messages if mess["bridge_name"] in indexes]
+
+    def initial_read(self):
+        '''The FDB state of our bridges at start'''
+        return self._ours(self._nl.initial_read())
+
+    def dump(self):
+        '''Read the FDB state while the feed is in use by the main loop'''
+        return self._nl.dump()
+
+    def iteration(self):
+        '''Handle the batches the dispatcher has sent. After updates
+           for us were dropped the dispatcher asks for a reconcile, the
+           kernel FDB of our bridges is then handed out as learns, which
+           only refresh what the FDB already has.'''
+        execute = []
+        for _ in range(self.budget):
+            if not self._conn.poll():
+                break
+            batch = self._conn.recv()
+            if batch == RECONCILE:
+                batch = self._ours(self._nl.dump())
+                logging.info("Reconciling %d kernel fdb entries", len(batch))
+            execute.extend(batch)
+        return execute
+
+    def provisioner(self):
+        '''Link provisioner for our bridges'''
+        return self._nl.provisioner()
+
+    def lookup_by_name(self, name):
+        '''Lookup the index of an interface'''
+        return self._nl.lookup_by_name(name)
+
+
+def _worker(index, config, conn, options):
+    '''Worker process main - a Switch for a subset of the vlans'''
+    if options.get("verbose"):
+        logging.getLogger().setLevel(logging.DEBUG)
+    IGMPFeed.use_scapy = options.get("igmp_scapy")
+    metrics = options.get("metrics")
+    if metrics is not None:
+        metrics = "{}.{}".format(metrics, index)
+    bridges = ["bvlan{}".format(vlan["vlan_id"]) for vlan in config["vlans"]]
+    feed = ShardFeed(conn, options["netlink_factory"](), bridges)
+    switch = Switch(options["bess_factory"](), metrics=metrics, netlink=feed)
+    switch.deserialize(config)
+    switch.initialize()
+    conn.send(READY)
+    logging.info("Shard %d serving %s", index, ", ".join(bridges))
+    if options.get("asyncio"):
+        # pylint: disable=import-outside-toplevel
+        from runtime import AsyncRuntime
+        AsyncRuntime(switch).main_loop()
+    else:
+        switch.main_loop()
+
+
+class _Shard(object):
+    '''Dispatcher side of a worker. Batches are sent from a thread of
+       their own so that a worker which falls behind only delays its
+       own vlans. Once SHARD_QUEUE batches are waiting further ones are
+       dropped and counted. When there is room again the worker is asked
+       to reconcile with the kernel FDB, which brings back lost learns.
+       Lost removals are left to aging, which checks with the kernel.'''
+
+    def __init__(self, index, config, options):
+        self.index = index
+        self.bridges = ["bvlan{}".format(vlan["vlan_id"]) for vlan in config["vlans"]]
+        (self.conn, child) = multiprocessing.Pipe()
+        # spawn, the workers must not inherit our grpc channel
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(
+            target=_worker, args=(index, config, child, options), name="shard{}".format(index))
+        self.process.daemon = True
+        self._queue = queue.Queue(SHARD_QUEUE)
+        self._overflow = False
+        # updates were dropped and no reconcile has been queued yet
+        self._lost = False
+        self.dropped = 0
+        self._sender = threading.Thread(target=self._send, name="send{}".format(index))
+        self._sender.daemon = True
+
+    def start(self):
+        '''Start the worker'''
+        self.process.start()
+        self._sender.start()
+
+    def wait(self):
+        '''Wait for the worker to have its pipelines built'''
+        try:
+            ready = self.conn.recv()
+        except EOFError:
+            # the worker died before saying anything
+            ready = None
+        if ready != READY:
+            raise IOError("Shard {} failed to start".format(self.index))
+
+    def send(self, batch):
+        '''Queue a batch for the worker'''
+        try:
+            if self._lost:
+                self._queue.put_nowait(RECONCILE)
+                self._lost = False
+            self._queue.put_nowait(batch)
+            self._overflow = False
+        except queue.Full:
+            if not self._overflow:
+                logging.error("Shard %d is not keeping up, dropping updates", self.index)
+                self._overflow = True
+            self._lost = True
+            self.dropped += len(batch)
+
+    def _send(self):
+        '''Sender thread'''
+        while True:
+            batch = self._queue.get()
+            try:
+                self.conn.send(batch)
+            except (IOError, OSError) as err:
+                logging.error("Shard %d is gone: %s", self.index, err)
+                return
+
+    def stop(self):
+        '''Stop the worker'''
+        self.process.terminate()
+        self.process.join()
+
+
+class Dispatcher(object):
+    '''Reads kernel FDB updates and routes them by bridge to the worker
+       processes, each of which runs a Switch for its own vlans with its
+       own BESS connection, FDB and snoop feeds'''
+
+    def __init__(self, bess, config, shards, options):
+        self._bess = bess
+        self._config = config
+        self._options = options
+        options.setdefault("bess_factory", connect_bess)
+        options.setdefault("netlink_factory", kernel_netlink)
+        self._shards = []
+        for (index, vlans) in enumerate(assign(config["vlans"], shards)):
+            shard_config = dict(config)
+            shard_config["vlans"] = vlans
+            # the shared snoop port is per worker
+            shard_config["snoop_name"] = "snoop{}".format(index)
+            self._shards.append(_Shard(index, shard_config, options))
+        self._nl = None
+        self._routes = {}
+        self.dropped = 0
+
+    def start(self, netlink=None):
+        '''Start the workers, wait for all pipelines to be built and
+           let traffic through'''
+        # subscribe before the workers take their initial dumps, updates
+        # wait in the socket until the routes are known
+        if netlink is None:
+            netlink = NetlinkFeed(raw=self._options.get("raw_netlink"))
+        self._nl = netlink
+        self._workers()
+        for shard in self._shards:
+            shard.start()
+        for shard in self._shards:
+            shard.wait()
+        provisioner = self._nl.provisioner()
+        for shard in self._shards:
+            for (name, index) in provisioner.resolve(shard.bridges).items():
+                logging.debug("Routing %s (%d) to shard %d", name, index, shard.index)
+                self._routes[index] = shard
+        self._bess.resume_all()
+
+    def _workers(self):
+        '''Create a BESS worker on every core a task of any shard may
+           run on. The shards build concurrently, each picking worker ids
+           from its own view of BESS, they would add the same id twice.
+           With the workers in place they only attach tasks to them.'''
+        placement = Placement()
+        placement.sync(self._bess)
+        for config in self._config["vlans"]:
+            for pipe in Vlan(self._bess, config).pipelines():
+                for (_, cores, _) in pipe.tasks:
+                    placement.reserve(cores)
+        placement.create(self._bess)
+
+    def dispatch(self, messages):
+        '''Route a list of netlink messages, one batch per worker'''
+        batches = {}
+        for mess in messages:
+            try:
+                batches.setdefault(self._routes[mess["bridge_name"]], []).append(mess)
+            except KeyError:
+                # a bridge which is not ours
+                self.dropped += 1
+        for (shard, batch) in batches.items():
+            shard.send(batch)
+
+    def check(self):
+        '''Raise IOError if a worker has died, its vlans would go on
+           without anybody programming them'''
+        for shard in self._shards:
+            if not shard.process.is_alive():
+                raise IOError("Shard {} exited with {}".format(
+                    shard.index, shard.process.exitcode))
+
+    def run(self):
+        '''Dispatch until interrupted or a worker dies'''
+        self._nl.setblocking(0)
+        epfd = epoll()
+        epfd.register(self._nl.fileno())
+        while True:
+            if epfd.poll(0.5):
+                messages = self._nl.iteration()
+                if messages:
+                    self.dispatch(messages)
+            self.check()
+
+    def stop(self):
+        '''Stop all workers'''
+        for shard in self._shards:
+            shard.stop()
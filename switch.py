@@ -6,121 +6,566 @@
 #
 # License: GPL2, see COPYING in source directory
 
+import gzip
 import logging
 import json
+import os
+import signal
+import sys
+import time
 from argparse import ArgumentParser
 from select import epoll
-from pybess.bess import BESS
-from fdb import FDB
+from pyroute2 import NetlinkError
+from batcher import Batcher
+from coalesce import Coalescer
+from fdb import FDB, FDBEntry, fdb_key
+from igmp_listener import IGMPFeed, SnoopMux, SNOOP_NAME, scapy
+from membership import Membership
+from metrics import EVENTS, FDB_SIZE, FWD_ENTRIES, FWD_CAPACITY, MetricsServer
 from netlink_listener import NetlinkFeed
+from pipeline import PipelineBuilder
 from vlan import Vlan
 
+# bumped whenever the layout of warm restart snapshots changes
+SNAPSHOT_VERSION = 1
+# seconds a kernel FDB dump is reused for checking aging candidates
+DEFAULT_DUMP_INTERVAL = 30
+
 class Switch(object):
     '''A python representation of a BESS vlan'''
 
-    def __init__(self, bess):
+    def __init__(self, bess, raw_netlink=False, metrics=None, netlink=None):
         self._vlans = {}
         self._ifindexes = {}
         self._initialized = False
         self._fdb = FDB()
+        self._membership = Membership(self._fdb, time.time())
+        # keys in the last kernel FDB dump and when it was taken
+        self._alive = None
+        self._alive_stamp = 0
+        self.dump_interval = DEFAULT_DUMP_INTERVAL
         self._epfd = epoll()
         self._feeds = {}
-        self._nl = NetlinkFeed()
+        if netlink is None:
+            netlink = NetlinkFeed(raw=raw_netlink)
+        self._nl = netlink
         self._feeds[self._nl.fileno()] = self._nl
         self._bess = bess
+        self._batcher = Batcher()
+        self._coalescer = Coalescer()
+        self._resync = False
+        # snapshot being restored until the warm start is done
+        self._warm = None
+        self._snoop = None
+        FDB_SIZE.read = lambda: len(self._fdb)
+        FWD_ENTRIES.read = lambda: self._per_port(lambda port: port.occupancy)
+        FWD_CAPACITY.read = lambda: self._per_port(lambda port: port.capacity)
+        if metrics is not None:
+            # served from the main loop like any other feed
+            server = MetricsServer(metrics)
+            self._feeds[server.fileno()] = server
 
     def deserialize(self, config):
         '''Digest data read from JSON'''
+        self._batcher.deserialize(config)
+        self._coalescer.deserialize(config)
+        self._fdb.max_age = config.get("fdb_age", self._fdb.max_age)
+        self.dump_interval = config.get("fdb_dump_interval", self.dump_interval)
+        if config.get("snoop") == "tee":
+            self._snoop = SnoopMux(config.get("snoop_name", SNOOP_NAME))
         for vlan_config in config["vlans"]:
-            vlan = Vlan(self._bess, vlan_config)
+            vlan = Vlan(self._bess, vlan_config, self._batcher)
             self._vlans[vlan.ifname] = vlan
+            if self._snoop is not None:
+                vlan.snoop = self._snoop
+                for port in vlan.ports:
+                    if port.fast_path:
+                        self._snoop.add(port, vlan)
 
-    def initialize(self):
-        '''Create underlying VLAN and BESS port'''
+    def initialize(self, snapshot=None):
+        '''Create underlying VLAN and BESS port. With a snapshot the
+           pipeline left in BESS by the run which saved it is reused.'''
         try:
             self._initialized = True
+            provisioner = self._nl.provisioner()
+            if snapshot is None:
+                # build the pipelines of all ports on all vlans in one go
+                pipelines = []
+                if self._snoop is not None:
+                    pipelines.append(self._snoop.pipeline())
+                for vlan in self._vlans.values():
+                    pipelines.extend(vlan.pipelines())
+                builder = PipelineBuilder(self._bess, self._batcher.fanout)
+                builder.build(pipelines)
+            names = []
             for vlan in self._vlans.values():
-                vlan.initialize()
-                self._ifindexes[self._nl.lookup_by_name(vlan.ifname)] = vlan
+                vlan.provisioner = provisioner
+                vlan.initialize(build=False)
+                names.append(vlan.ifname)
+                names.extend(vlan.port_names)
+            # one link dump for all interfaces
+            indexes = provisioner.resolve(names)
+            for vlan in self._vlans.values():
+                self._ifindexes[indexes[vlan.ifname]] = vlan
                 for port in vlan.ports:
-                    self._ifindexes[self._nl.lookup_by_name(port.ifname)] = port
-                    self._feeds[port.snoopfeed.fileno()] = port.snoopfeed
-        except IOError:
+                    self._ifindexes[indexes[port.ifname]] = port
+                    if port.snoopfeed is not None:
+                        self._feeds[port.snoopfeed.fileno()] = port.snoopfeed
+            if self._snoop is not None:
+                if snapshot is not None:
+                    # the tags BESS pushes are those of the saved run
+                    self._snoop.restore(snapshot["snoop"])
+                self._snoop.connect()
+                self._feeds[self._snoop.fileno()] = self._snoop
+            if snapshot is not None:
+                for vlan in self._vlans.values():
+                    state = snapshot["vlans"][vlan.ifname]
+                    vlan.restore(state["ports"], self._saved_entries(vlan, state))
+                self._warm = snapshot
+        # provisioning failures come back from the kernel as NetlinkError
+        except (IOError, NetlinkError) as err:
+            logging.error("Failed to initialize the switch: %s", err)
             self._initialized = False
 
+    def snapshot(self):
+        '''State for a warm restart. Per vlan the fdb entries, which
+           are stored once, and the state of its ports.'''
+        vlans = {}
+        for vlan in self._vlans.values():
+            unicast = []
+            groups = []
+            entries = []
+            for entry in self._fdb.entries(vlan):
+                if entry.is_broadcast:
+                    if entry.ports:
+                        groups.append([entry.mac, [port.ifname for port in entry.ports]])
+                        entries.append(entry)
+                elif entry.source is not None and entry.source.ifname in vlan.port_names:
+                    unicast.append([entry.mac, entry.source.ifname])
+                    entries.append(entry)
+            vlans[vlan.ifname] = {
+                "fdb":unicast, "groups":groups, "ports":vlan.snapshot(entries),
+                "flood":vlan.flood}
+        snoop = None
+        if self._snoop is not None:
+            snoop = self._snoop.snapshot()
+        return {"version":SNAPSHOT_VERSION, "saved":time.time(), "vlans":vlans, "snoop":snoop}
+
+    @staticmethod
+    def _saved_entries(vlan, state):
+        '''The fdb entries of a vlan as saved in a snapshot'''
+        entries = []
+        for (mac, name) in state["fdb"]:
+            entries.append(FDBEntry(mac, vlan, vlan.port_by_name(name)))
+        for (mac, names) in state["groups"]:
+            entries.append(FDBEntry(
+                mac, vlan, None, dst_ports=[vlan.port_by_name(name) for name in names]))
+        return entries
+
+    def save(self, path):
+        '''Flush and write a snapshot for a warm restart. It is written
+           aside and renamed into place, a crash while saving leaves no
+           half written snapshot behind.'''
+        self._batcher.flush()
+        start = time.time()
+        state = self.snapshot()
+        temp = path + ".tmp"
+        with gzip.open(temp, "wt") as out:
+            json.dump(state, out, separators=(",", ":"))
+        os.rename(temp, path)
+        logging.info("Saved warm restart snapshot to %s in %.3fs", path, time.time() - start)
+
+    def attachable(self, snapshot):
+        '''Can the pipeline in BESS be reused with a snapshot - the
+           vlans and ports have to be those it was saved with and all
+           of their modules must still be there'''
+        ours = dict((vlan.ifname, sorted(vlan.port_names)) for vlan in self._vlans.values())
+        saved = dict((name, sorted(state["ports"])) for (name, state) in snapshot["vlans"].items())
+        if ours != saved:
+            logging.warning("Snapshot was saved with different vlans or ports")
+            return False
+        for vlan in self._vlans.values():
+            if snapshot["vlans"][vlan.ifname].get("flood", False) != vlan.flood:
+                # the ports are wired for the other flooding mode
+                logging.warning("Flooding of %s changed since the snapshot", vlan.ifname)
+                return False
+        if (snapshot.get("snoop") is None) != (self._snoop is None):
+            logging.warning("Snoop transport changed since the snapshot")
+            return False
+        present = set(module.name for module in self._bess.list_modules().modules)
+        if self._snoop is not None:
+            missing = [name for name in self._snoop.modules() if name not in present]
+            if missing:
+                logging.warning("Modules missing from BESS: %s", ", ".join(missing))
+                return False
+        for vlan in self._vlans.values():
+            for port in vlan.ports:
+                state = snapshot["vlans"][vlan.ifname]["ports"][port.ifname]
+                missing = [name for name in port.modules(state) if name not in present]
+                if missing:
+                    logging.warning("Modules missing from BESS: %s", ", ".join(missing))
+                    return False
+        return True
+
+    def _per_port(self, value):
+        '''Gauge values of all ports'''
+        result = {}
+        for vlan in self._vlans.values():
+            for port in vlan.ports:
+                result[(port.ifname,)] = value(port)
+        return result
+
     def _by_index(self, number):
         '''Lookup ifindex from name'''
         return self._ifindexes[number]
 
-    def main_loop(self):
-        '''Main processing loop'''
+    def _kernel_alive(self, entries, now=None):
+        '''Keys of the entries which are still present in the kernel
+           FDB. Used to double check aging candidates - the kernel does
+           not tell us when it refreshes an entry, only when it drops
+           one, so we only expire what it no longer has. The kernel FDB
+           is dumped at most once per dump_interval, in between the last
+           dump is used. Anything the kernel drops or learns after it is
+           notified, so a dump younger than the FDB age is good enough.'''
+        if now is None:
+            now = time.time()
+        if self._alive is None or now - self._alive_stamp >= self.dump_interval:
+            alive = set()
+            for mess in self._nl.dump():
+                try:
+                    alive.add(fdb_key(mess["mac"], self._by_index(mess["bridge_name"])))
+                except (KeyError, ValueError):
+                    pass
+            (self._alive, self._alive_stamp) = (alive, now)
+            logging.debug("Dumped %d kernel fdb entries for aging", len(alive))
+        return set(entry.key for entry in entries if entry.key in self._alive)
+
+    def _read_initial(self):
+        '''Load the initial state of all feeds into the FDB. Returns the
+           new entries by vlan.'''
+        loaded = {}
         for feed in self._feeds.values():
             for mess in feed.initial_read():
                 logging.debug("Initial %s", mess)
-                if mess["type"] == "RTM_NEWNEIGH":
-                    self._fdb.learn(
-                        mess["mac"], self._ifindexes[mess["bridge"]], self._ifindexes[mess["port"]])
+                if mess["type"] != "RTM_NEWNEIGH":
+                    continue
+                try:
+                    vlan = self._by_index(mess["bridge_name"])
+                    entry = self._fdb.load(mess["mac"], vlan, self._by_index(mess["port_name"]))
+                except (KeyError, ValueError):
+                    logging.error("Message parsing failure: %s", mess)
+                    continue
+                if entry is not None:
+                    loaded.setdefault(vlan, []).append(entry)
+        return loaded
+
+    def cold_start(self):
+        '''Load the initial state of all feeds into the FDB and install
+           it into BESS in bulk - each forwarder gets its whole table in
+           a few large commands instead of one command per entry'''
+        start = time.time()
+        loaded = self._read_initial()
+        read = time.time()
+        for (vlan, entries) in loaded.items():
+            vlan.install(entries)
+        done = time.time()
+        stats = {"entries":sum(len(entries) for entries in loaded.values()),
+                 "read_s":read - start, "install_s":done - read, "total_s":done - start}
+        logging.info("Cold start sync of %d fdb entries took %.3fs (read %.3fs, install %.3fs)",
+                     stats["entries"], stats["total_s"], stats["read_s"], stats["install_s"])
+        return stats
+
+    def warm_start(self):
+        '''Pick up after a warm restart. Unicast entries are loaded from
+           the kernel as on a cold start, it knows best what is there now,
+           multicast groups come from the snapshot. Each forwarder is
+           then sent the difference between the fdb and its shadow table
+           as of the snapshot, the rules already in BESS keep forwarding
+           meanwhile. SIGUSR1 checks the tables themselves.'''
+        start = time.time()
+        self._read_initial()
+        for vlan in self._vlans.values():
+            for (mac, names) in self._warm["vlans"][vlan.ifname]["groups"]:
+                entry = self._fdb.load_mcast(
+                    mac, vlan, [vlan.port_by_name(name) for name in names])
+                if entry is not None:
+                    vlan.load(entry)
+                    # timers are not saved, the members get a full
+                    # interval to report again
+                    for port in entry.ports:
+                        self._membership.report(mac, vlan, port, start)
+        self._warm = None
+        read = time.time()
+        repaired = 0
+        for vlan in self._vlans.values():
+            repaired += vlan.resync(self._fdb.entries(vlan), verify=False)
+        done = time.time()
+        stats = {"entries":len(self._fdb), "repaired":repaired,
+                 "read_s":read - start, "install_s":done - read, "total_s":done - start}
+        logging.info("Warm start sync of %d fdb entries repaired %d and took %.3fs "
+                     "(read %.3fs, reconcile %.3fs)", stats["entries"], repaired,
+                     stats["total_s"], stats["read_s"], stats["install_s"])
+        return stats
+
+    def request_resync(self, *_):
+        '''Ask for a resync on the next wakeup, safe to use as a signal
+           handler'''
+        self._resync = True
+
+    def resync(self):
+        '''Check all forwarders against the FDB and repair any drift'''
+        self._resync = False
+        self._batcher.flush()
+        start = time.time()
+        repaired = 0
+        for vlan in self._vlans.values():
+            repaired += vlan.resync(self._fdb.entries(vlan))
+        logging.info("Resync repaired %d entries in %.3fs", repaired, time.time() - start)
+        return repaired
+
+    def add_feed(self, feed):
+        '''Add a source of events to the main loop'''
+        self._feeds[feed.fileno()] = feed
+
+    def drop_feed(self, feed):
+        '''Stop polling a feed which has gone away and close it'''
+        file_d = feed.fileno()
+        self._feeds.pop(file_d, None)
+        try:
+            self._epfd.unregister(file_d)
+        except OSError:
+            # never registered, the asyncio runtime polls on its own
+            pass
+        feed.close()
+
+    @property
+    def feeds(self):
+        '''All sources of events'''
+        return list(self._feeds.values())
+
+    @property
+    def batcher(self):
+        '''The rule batcher shared by all forwarders'''
+        return self._batcher
+
+    @property
+    def resync_requested(self):
+        '''Has a resync been asked for'''
+        return self._resync
+
+    def start(self, register=True):
+        '''Sync the initial state and start listening on all feeds.
+           Feeds are left alone if register is false, the caller polls
+           them its own way.'''
+        if self._warm is not None:
+            stats = self.warm_start()
+        else:
+            stats = self.cold_start()
+        signal.signal(signal.SIGUSR1, self.request_resync)
+        if not register:
+            return stats
+        for feed in self._feeds.values():
             feed.setblocking(0)
             logging.error("registering for epoll: %d", feed.fileno())
             self._epfd.register(feed.fileno())
-        while True:
-            events = self._epfd.poll(0.5)
-            for (file_d, mask) in events:
-                feed = self._feeds[file_d]
+        return stats
+
+    @property
+    def pending(self):
+        '''Updates held by the coalescer and ports with queued rules'''
+        return len(self._coalescer) + self._batcher.pending
+
+    def _apply(self, mess):
+        '''Apply an event to the FDB'''
+        self._batcher.event(mess["received"])
+        if mess["type"] == "RTM_NEWNEIGH":
+            self._fdb.learn(mess["mac"], mess["bridge"], mess["port"])
+        elif mess["type"] == "RTM_DELNEIGH":
+            self._fdb.expire(mess["mac"], mess["bridge"])
+        elif mess["type"] == "MCAST_JOIN":
+            self._fdb.add_mcast(mess["mac"], mess["bridge"], mess["port"])
+            self._membership.report(mess["mac"], mess["bridge"], mess["port"], mess["received"])
+        elif mess["type"] == "MCAST_LEAVE":
+            self._fdb.del_mcast(mess["mac"], mess["bridge"], mess["port"])
+            self._membership.leave(mess["mac"], mess["bridge"], mess["port"])
+        else:
+            logging.error("Unrecognized fdb message: %s", mess)
+        if self._batcher.due() and not self._batcher.pipelined:
+            self._batcher.flush()
+
+    def _charge(self, mess):
+        '''Does a learn change the FDB, refreshes are not rate limited'''
+        return self._fdb.source(mess["mac"], mess["bridge"]) is not mess["port"]
+
+    def read(self, feed, received):
+        '''Handle what a feed has to offer. Kernel FDB updates go
+           through the coalescer, multicast membership is applied as it
+           comes.'''
+        try:
+            for mess in feed.iteration():
+                EVENTS.inc((mess["type"],))
                 try:
-                    for mess in feed.iteration():
-                        try:
-                            if mess.get("bridge", None) is None:
-                                mess["bridge"] = self._by_index(mess["bridge_name"])
-                            if mess.get("port", None) is None:
-                                mess["port"] = self._by_index(mess["port_name"])
-                            if mess["type"] == "RTM_NEWNEIGH":
-                                self._fdb.learn(mess["mac"], mess["bridge"], mess["port"])
-                            elif mess["type"] == "RTM_DELNEIGH":
-                                self._fdb.expire(mess["mac"], mess["bridge"])
-                            elif mess["type"] == "MCAST_JOIN":
-                                self._fdb.add_mcast(mess["mac"], mess["bridge"], mess["port"])
-                            elif mess["type"] == "MCAST_LEAVE":
-                                self._fdb.del_mcast(mess["mac"], mess["bridge"], mess["port"])
-                            else:
-                                logging.error("Unrecognized fdb message: %s", mess)
-                        except KeyError:
-                            logging.error("Message parsing failure: %s", mess)
-                except TypeError:
-                    pass
+                    if mess.get("bridge", None) is None:
+                        mess["bridge"] = self._by_index(mess["bridge_name"])
+                    if mess.get("port", None) is None:
+                        mess["port"] = self._by_index(mess["port_name"])
+                    mess["received"] = received
+                    if mess["type"] in ("RTM_NEWNEIGH", "RTM_DELNEIGH"):
+                        self._coalescer.push(mess, received)
+                    else:
+                        self._apply(mess)
+                except KeyError:
+                    logging.error("Message parsing failure: %s", mess)
+        except TypeError:
+            pass
+
+    def timeout(self, timeout, now):
+        '''Time to wait for events without missing housekeeping'''
+        return self._coalescer.timeout(timeout, now)
+
+    def housekeeping(self, now):
+        '''Apply the coalesced updates whose window has closed, age
+           the FDB and expire multicast memberships'''
+        if self._coalescer.due(now):
+            for mess in self._coalescer.drain(now, self._charge):
+                if mess.get("cancels") and self._fdb.source(mess["mac"], mess["bridge"]) is None:
+                    # the learn it undoes never got to the FDB
+                    continue
+                self._apply(mess)
+        self._fdb.age(alive=self._kernel_alive)
+        self._membership.expire(now)
+
+    def poll(self, timeout=0.5):
+        '''Handle one main loop wakeup'''
+        if self._resync:
+            self.resync()
+        events = self._epfd.poll(self.timeout(timeout, time.time()))
+        for (file_d, _) in events:
+            feed = self._feeds[file_d]
+            self.read(feed, time.time())
+            if getattr(feed, "closed", False):
+                self.drop_feed(feed)
+        self.housekeeping(time.time())
+        # everything learned during this wakeup goes to BESS in one go
+        self._batcher.flush()
+
+    def main_loop(self):
+        '''Main processing loop'''
+        self.start()
+        while True:
+            self.poll()
+
+def load_snapshot(path):
+    '''Read a warm restart snapshot and remove it. A snapshot is only
+       good for the start right after it was saved, a run which dies
+       without saving must not leave an old one to be picked up. Returns
+       None if there is no usable snapshot.'''
+    try:
+        with gzip.open(path, "rt") as data:
+            state = json.load(data)
+    except (IOError, OSError, EOFError, ValueError) as err:
+        logging.info("No warm restart snapshot: %s", err)
+        return None
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    if state.get("version") != SNAPSHOT_VERSION:
+        logging.warning("Ignoring snapshot version %s", state.get("version"))
+        return None
+    return state
 
 def main():
     '''Main Subroutine'''
+    # pylint: disable=too-many-statements
     aparser = ArgumentParser(description=main.__doc__)
     aparser.add_argument(
         '--config',
         help='json formatted file containing switch config',
         type=str, required=True)
     aparser.add_argument('--verbose', help='verbosity level', type=int)
+    aparser.add_argument(
+        '--igmp-scapy', help='parse snooped IGMP with scapy (debug)', action='store_true')
+    aparser.add_argument(
+        '--raw-netlink', help='read FDB updates with the raw netlink decoder',
+        action='store_true')
+    aparser.add_argument(
+        '--metrics', help='unix socket to serve Prometheus metrics on', type=str)
+    aparser.add_argument(
+        '--asyncio', help='run on asyncio with pipelined BESS commands', action='store_true')
+    aparser.add_argument(
+        '--shards', help='worker processes to spread the vlans over', type=int, default=1)
+    aparser.add_argument(
+        '--snapshot', help='state file for warm restarts, written on exit', type=str)
     args = vars(aparser.parse_args())
     if args.get('verbose') is not None:
         logging.getLogger().setLevel(logging.DEBUG)
+    if args.get('igmp_scapy') and scapy is None:
+        aparser.error("--igmp-scapy needs scapy, which is not installed")
+    IGMPFeed.use_scapy = args.get('igmp_scapy')
+    # the benchmarks drive Switch without the bess python bindings
+    # pylint: disable=import-outside-toplevel
+    from pybess.bess import BESS
     config = json.load(open(args.get('config'), "r"))
     logging.debug("Config %s", config)
     bess = BESS()
     logging.debug("Connecting to bess")
     bess.connect()
-    logging.debug("Reset Pipeline")
-    bess.reset_all()
-    logging.debug("Reset Ports")
-    bess.reset_ports()
+    # SIGTERM exits through the same path as ^C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if args.get('shards') > 1:
+        if args.get('snapshot') is not None:
+            logging.warning("Warm restarts are not supported with shards")
+        bess.reset_all()
+        bess.reset_ports()
+        from shard import Dispatcher
+        dispatcher = Dispatcher(bess, config, args.get('shards'), {
+            "verbose":args.get('verbose'), "igmp_scapy":args.get('igmp_scapy'),
+            "raw_netlink":args.get('raw_netlink'), "metrics":args.get('metrics'),
+            "asyncio":args.get('asyncio')})
+        try:
+            dispatcher.start()
+            logging.debug("Fire at will")
+            dispatcher.run()
+        except KeyboardInterrupt:
+            dispatcher.stop()
+        except IOError as err:
+            # no restarting a single worker, its BESS modules are still
+            # there, leave it to whatever restarts the switch
+            logging.error("Giving up: %s", err)
+            dispatcher.stop()
+            sys.exit(1)
+        return
     logging.debug("Create Switch")
-    switch = Switch(bess)
+    switch = Switch(bess, raw_netlink=args.get('raw_netlink'), metrics=args.get('metrics'))
     logging.debug("Process Config")
     switch.deserialize(config)
+    snapshot = None
+    if args.get('snapshot') is not None:
+        snapshot = load_snapshot(args.get('snapshot'))
+        if snapshot is not None and not switch.attachable(snapshot):
+            logging.warning("Cannot reuse the BESS pipeline, cold start")
+            snapshot = None
+    if snapshot is None:
+        logging.debug("Reset Pipeline")
+        bess.reset_all()
+        logging.debug("Reset Ports")
+        bess.reset_ports()
     logging.debug("Initialize")
-    switch.initialize()
+    switch.initialize(snapshot)
     logging.debug("Fire at will")
     bess.resume_all()
     try:
-        switch.main_loop()
+        if args.get('asyncio'):
+            from runtime import AsyncRuntime
+            AsyncRuntime(switch).main_loop()
+        else:
+            switch.main_loop()
     except KeyboardInterrupt:
         pass
+    if args.get('snapshot') is not None:
+        switch.save(args.get('snapshot'))
 
 if __name__ == '__main__':
     main()
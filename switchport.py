@@ -6,29 +6,107 @@
 #
 # License: GPL2, see LICENSE in source directory
 
+import errno
+import functools
 import logging
 import re
-import copy
+import time
+from batcher import chunks
+from fanout import report
 from igmp_listener import IGMPFeed
+from metrics import BESS_CALLS, BESS_LATENCY, BATCH_ENTRIES, FWD_REBUILDS
+from pipeline import PortPipeline, PipelineBuilder
+from replicator import GateAllocator, ReplicatorManager
 
 PORT_RE = re.compile(r"bv(\d+)p(\d+)")
 
+# entries per L2Forward add command during bulk installs, keeps the grpc
+# message well under its default 4MB limit
+INSTALL_CHUNK = 32768
+
+# L2Forward hash table geometry. bessd wants powers of two and at most
+# four entries per bucket.
+DEFAULT_TABLE_SIZE = 1024
+MAX_BUCKET = 4
+# tables are sized to be half full with the expected MACs, buckets fill
+# up unevenly and inserts fail well before size * bucket
+TABLE_LOAD = 0.5
+# occupancy at which a forwarder is reported or grown, and below which
+# it has to drop before it is reported again
+TABLE_HIGH = 0.75
+TABLE_LOW = 0.6
+
+# 01:80:c2:00:00:00 to 0f - STP, LACP, LLDP, 802.1X...
+LINK_LOCAL = "ether[0:4] == 0x0180c200 and ether[4:2] & 0xfff0 == 0"
+# forwarder gate of the sink for traffic to MACs behind the port it came
+# in on, in flood vlans. Well clear of the gates handed out from 1 up.
+DROP_GATE = 8191
+
+
+def _pow2(number):
+    '''Smallest power of two not below number'''
+    result = 1
+    while result < number:
+        result <<= 1
+    return result
+
+
+def table_geometry(expected=None, size=None, bucket=None):
+    '''L2Forward size and bucket for a table expected to hold a number
+       of MACs, an explicitly configured size wins'''
+    if bucket is None:
+        bucket = MAX_BUCKET
+    bucket = min(_pow2(bucket), MAX_BUCKET)
+    if size is None:
+        size = DEFAULT_TABLE_SIZE
+        if expected:
+            size = max(size, int(expected / (bucket * TABLE_LOAD)))
+    return (_pow2(size), bucket)
+
+
 class SwitchPort(object):
     '''A python representation of a BESS switch port'''
 
     # I will have as many as I need thank ya
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, bess, vlan, args=None):
+    def __init__(self, bess, vlan, args=None, batcher=None):
         self._bess = bess
         self._vlan = vlan
         self._args = args
+        self._batcher = batcher
+        # queued rule changes, MAC to the gate it should have or None
+        # for no rule, and what the forwarder is known to hold
+        self._pending = {}
+        self._shadow = {}
+        # MACs on which the queue forwarders do not agree, the shadow
+        # has what at least one of them holds
+        self._split = set()
+        # MACs with changes on their way to the forwarder
+        self._inflight = set()
         self.snoopfeed = None
         logging.debug("Port Args are %s", args)
         self._phys_port = None
         self._logical_port = None
-        self._replicators = {}
         self._initialized = False
         self._pg_map = {}
+        self._gates = GateAllocator()
+        self._replicators = ReplicatorManager(
+            bess, self, self._gates, self._p_to_g, self._hout_port)
+        # multicast mac to the key of the replicator its rule points at
+        self._mcast = {}
+        self._retired = []
+        # forwarder generation, bumped each time it is rebuilt larger
+        self._generation = 0
+        # a size or MAC count given for the port replaces both of the vlan
+        sizing = self._args
+        if "expected_macs" not in sizing and "table_size" not in sizing:
+            sizing = self._vlan.table
+        (self._table_size, self._table_bucket) = table_geometry(
+            sizing.get("expected_macs"), sizing.get("table_size"),
+            self._table_arg("table_bucket"))
+        self._crowded = False
+        # a rebuild failed, no more tries until the table drains
+        self._rebuild_failed = False
 
     def __repr__(self):
         '''Official representation'''
@@ -59,63 +137,84 @@ class SwitchPort(object):
         except KeyError:
             return [0]
 
+    def _table_arg(self, key):
+        '''Forwarder table setting of this port, or of its vlan'''
+        try:
+            return self._args[key]
+        except KeyError:
+            return self._vlan.table.get(key)
+
     @property
     def ifname(self):
         '''Return assigned or build default port name'''
         return "bv{}p{}".format(self._vlan.vlan_no, self._args["port_no"])
 
+    @property
+    def fast_path(self):
+        '''Does the port have a BESS datapath, it is only a VPort if not'''
+        return self._pci_id is not None
 
-    def replicator(self, port_list_arg):
-        '''Add a list of replicators'''
-        port_list = []
-        for port in port_list_arg:
-            port_list.append(port.ifname)
-        try:
-            port_list.remove(self.ifname)
-        except ValueError:
-            pass
-        if not port_list:
-            return None
-        logging.debug("Stargate SG1 on %s %s", self.ifname, port_list)
-        hash_key = "-".join(sorted(port_list))
-        logging.debug("Hash key is %s", hash_key)
+    def _flood_targets(self):
+        '''PortOuts of the other ports of the vlan, where floods go'''
+        return ["hout{}".format(port.ifname)
+                for port in self._vlan.ports if port is not self and port.fast_path]
+
+    @property
+    def _cores(self):
+        '''Cores the tasks of this port may run on'''
         try:
-            if self._replicators[hash_key]:
-                logging.debug("Reusing existing replicator for %s %s", self.ifname, port_list)
-                return "rep{}-{}".format(self.ifname, hash_key)
+            return self._args["cores"]
         except KeyError:
-            logging.debug("New Replicator")
-            pass
-        logging.debug("Replicate  %s %s", self.ifname, port_list)
-        self._bess.create_module(
-            "Replicate", "rep{}-{}".format(self.ifname, hash_key), {"gates":[]})
-        self._replicators[hash_key] = True
-        self._bess.resume_all()
-
-        # run all args via the gate mapper and reuse the gate mapping
-        logging.debug("Dry run for  %s %s", self.ifname, port_list)
-        for port_name in port_list:
-            self._p_to_g(port_name)
-        gate_list = []
-        # wire all gates using the same gate mapping as the L2Forwarder
-        for port_name in port_list:
-            try:
-                hout = self._hout_port(port_name)
-                if hout is not None:
-                    self._bess.connect_modules(
-                        "rep{}-{}".format(
-                            self.ifname, hash_key), hout, ogate=self._pg_map[port_name])
-                    gate_list.append(self._pg_map[port_name])
-            except KeyError:
-                pass
-        # Set the gates as an arg
-        logging.debug("Gate address  %s %s", self.ifname, port_list)
-        self._bess.run_module_command(
-            "rep{}-{}".format(self.ifname, hash_key),
-            "set_gates",
-            "ReplicateCommandSetGatesArg",
-            {"gates":gate_list})
-        return "rep{}-{}".format(self.ifname, hash_key)
+            return self._cpu_set
+
+    @property
+    def _queues(self):
+        '''Receive queues, each has a forwarder of its own'''
+        if self._pci_id is None:
+            return 1
+        return self._inc_q
+
+    def _input_name(self, queue):
+        '''Name of the module reading a receive queue'''
+        if queue:
+            return "hin{}q{}".format(self.ifname, queue)
+        return "hin{}".format(self.ifname)
+
+    def _forwarder_names(self, generation):
+        '''Names of the L2Forward modules of a forwarder generation, one
+           per receive queue'''
+        names = []
+        for queue in range(self._queues):
+            name = "f{}".format(self.ifname)
+            if queue:
+                name += "q{}".format(queue)
+            if generation:
+                name += "r{}".format(generation)
+            names.append(name)
+        return names
+
+    @property
+    def forwarders(self):
+        '''Names of the L2Forward modules of this port. They all hold
+           the same rules.'''
+        return self._forwarder_names(self._generation)
+
+    @property
+    def forwarder(self):
+        '''Name of the L2Forward module of the first queue, the one
+           lookups go to'''
+        return self.forwarders[0]
+
+    @property
+    def capacity(self):
+        '''Entries the forwarder table has room for'''
+        return self._table_size * self._table_bucket
+
+    @property
+    def occupancy(self):
+        '''Entries in the forwarder table'''
+        return len(self._shadow)
+
 
     def _hout_port(self, port):
         '''Return the expected out port or None if it is not a BESS port'''
@@ -136,12 +235,12 @@ class SwitchPort(object):
         hout_port = self._hout_port(port)
         if hout_port is None:
             return None
-        maxgate = max(self._pg_map.values()) + 1
-        self._pg_map[port] = maxgate
-        logging.debug("Wiring %s to gate %d on port %s", port, maxgate, self.ifname)
-        self._bess.connect_modules(
-            "f{}".format(self.ifname), hout_port, ogate=maxgate)
-        return maxgate
+        gate = self._gates.alloc()
+        self._pg_map[port] = gate
+        logging.debug("Wiring %s to gate %d on port %s", port, gate, self.ifname)
+        for forwarder in self.forwarders:
+            self._bess.connect_modules(forwarder, hout_port, ogate=gate)
+        return gate
 
     def _p_to_g(self, port):
         '''Map VLAN port number to forwarding locally significant forwarding gate'''
@@ -152,38 +251,39 @@ class SwitchPort(object):
         except KeyError:
             return self._add_portgate(port)
 
-    def _add_mcastgate(self, replicator):
-        '''Add a new gate for the multicast replicator'''
-        if replicator is None:
-            return None
-        logging.debug("Gate list is %s", self._pg_map.values())
-        maxgate = max(self._pg_map.values()) + 1
-        self._pg_map[replicator] = maxgate
-        logging.debug("Wiring %s to gate %d on port %s", replicator, maxgate, self.ifname)
-        self._bess.connect_modules(
-            "f{}".format(self.ifname), replicator, ogate=maxgate)
-        return maxgate
-
-
-    def _m_to_g(self, ports_arg):
-        '''Map multicast group to forwarding locally significant forwarding gate'''
-        ports = copy.copy(ports_arg)
+    def _mcast_key(self, ports):
+        '''Replicator key for a multicast port list, None if there is
+           nowhere to replicate to from this port'''
         if ports is None:
             return None
-        try:
-            ports.remove(self.ifname)
-        except ValueError:
-            pass
-
-        if not ports:
+        port_list = sorted(port.ifname for port in ports if port.ifname != self.ifname)
+        if not port_list:
             return None
-
-        logging.debug("Mapping multicast gate on %s for %s", self.ifname, ports)
-
-        try:
-            return self._pg_map[self.replicator(ports)]
-        except KeyError:
-            return self._add_mcastgate(self.replicator(ports))
+        return "-".join(port_list)
+
+    def _m_to_g(self, mac, ports, calls=None):
+        '''Map multicast group to forwarding locally significant forwarding
+           gate. Takes a reference on the replicator, which is held until
+           the entry is deleted or moved. calls as for acquire().'''
+        key = self._mcast_key(ports)
+        if key is None:
+            self._release_mcast(mac)
+            return None
+        logging.debug("Mapping multicast gate on %s for %s", self.ifname, key)
+        gate = self._replicators.acquire(
+            key, [port.ifname for port in ports if port.ifname != self.ifname], calls)
+        self._release_mcast(mac)
+        self._mcast[mac] = key
+        return gate
+
+    def _release_mcast(self, mac):
+        '''Drop the replicator reference held by a multicast entry. The
+           release is deferred until the pending rule changes are in
+           BESS so that the gate is not reused while the old rule may
+           still point at it'''
+        key = self._mcast.pop(mac, None)
+        if key is not None:
+            self._retired.append(key)
 
     def serialize(self):
         '''Prep the port for json store'''
@@ -193,145 +293,709 @@ class SwitchPort(object):
         '''Digest data read from JSON'''
         self._args = args
 
-    def initialize(self):
-        '''Create underlying BESS port'''
-        self._initialized = True
+    def pipeline(self):
+        '''Describe the BESS ports, modules and wiring of this port'''
+        pipe = PortPipeline(self.ifname)
         # we are using only PCI Ids for now.
         if self._pci_id is not None:
-            logging.debug("Phys Port for %s", self.ifname)
-            self._phys_port = self._bess.create_port(
+            pipe.port(
                 "PMDPort", "h{}".format(self.ifname),
                 {"pci":self._pci_id, "num_inc_q":self._inc_q, "num_out_q":self._out_q})
-        if self.ifname is not None:
-            logging.debug("Logical Port for %s", self.ifname)
-            self._logical_port = self._bess.create_port(
-                "VPort", "v{}".format(self.ifname),
-                {"ifname":self.ifname, "rxq_cpus":self._cpu_set})
-
-
-        if self._phys_port is not None:
-            logging.debug("Pipeline for %s", self.ifname)
-
-
-            self._bess.create_port(
-                "UnixSocketPort", "pu{}".format(self.ifname),
-                {"path":"/var/tmp/bess-u{}".format(self.ifname)})
-
-            snoop_out = self._bess.create_module(
-                "PortOut", "uout{}".format(self.ifname), {"port": "pu{}".format(self.ifname)})
-            snoop_in = self._bess.create_module(
-                "PortInc", "uinc{}".format(self.ifname), {"port": "pu{}".format(self.ifname)})
-            b_in = self._bess.create_module(
-                "BPF", "bin{}".format(self.ifname),
-                {"filters":[{"priority": 1, "filter":"proto 2", "gate":1}]})
-
-            p_in = self._bess.create_module(
-                "PortInc", "hin{}".format(self.ifname), {"port": "h{}".format(self.ifname)})
-            p_out = self._bess.create_module(
-                "PortOut", "hout{}".format(self.ifname), {"port": "h{}".format(self.ifname)})
-
-            v_in = self._bess.create_module(
-                "PortInc", "vin{}".format(self.ifname), {"port": "v{}".format(self.ifname)})
-            v_out = self._bess.create_module(
-                "PortOut", "vout{}".format(self.ifname), {"port": "v{}".format(self.ifname)})
-
-            forwarder = self._bess.create_module(
-                "L2Forward", "f{}".format(self.ifname), {"source_check": True})
-
-            self._bess.run_module_command(
-                forwarder.name,
+        pipe.port(
+            "VPort", "v{}".format(self.ifname),
+            {"ifname":self.ifname, "rxq_cpus":self._cpu_set})
+
+        if self._pci_id is None:
+            return pipe
+
+        filters = [{"priority": 1, "filter":"proto 2", "gate":1}]
+        if self._vlan.flood:
+            filters.append({"priority": 2, "filter":LINK_LOCAL, "gate":2})
+        b_in = pipe.module("BPF", "bin{}".format(self.ifname), {"filters":filters})
+
+        p_out = pipe.module(
+            "PortOut", "hout{}".format(self.ifname), {"port": "h{}".format(self.ifname)})
+
+        v_in = pipe.module(
+            "PortInc", "vin{}".format(self.ifname), {"port": "v{}".format(self.ifname)})
+        v_out = pipe.module(
+            "PortOut", "vout{}".format(self.ifname), {"port": "v{}".format(self.ifname)})
+
+        sink = None
+        if self._vlan.flood:
+            # without a rule hairpin traffic would miss and be flooded
+            sink = pipe.module("Sink", "drop{}".format(self.ifname), {})
+
+        # a chain per receive queue, each placed on a worker of its own
+        # where there are enough cores
+        for (queue, name) in enumerate(self.forwarders):
+            if self._queues == 1:
+                p_in = pipe.module(
+                    "PortInc", self._input_name(queue), {"port": "h{}".format(self.ifname)})
+            else:
+                p_in = pipe.module(
+                    "QueueInc", self._input_name(queue),
+                    {"port": "h{}".format(self.ifname), "qid":queue})
+            pipe.task(p_in, self._cores)
+
+            forwarder = pipe.module(
+                "L2Forward", name,
+                {"source_check": True, "size":self._table_size, "bucket":self._table_bucket})
+
+            pipe.command(
+                forwarder,
                 "set_default_gate",
                 "L2ForwardCommandSetDefaultGateArg",
                 {"gate":0})
-            self._pg_map[-1] = 0 # default gate
 
             # all traffic to forwarder
-            self._bess.connect_modules(p_in.name, forwarder.name)
+            pipe.connect(p_in, forwarder)
 
             # make bpf "snoop" filter default output for forwarder (fast path bypasses it)
-            self._bess.connect_modules(forwarder.name, b_in.name, ogate=0)
-
+            pipe.connect(forwarder, b_in, ogate=0)
+            if sink is not None:
+                pipe.connect(forwarder, sink, ogate=DROP_GATE)
+
+        if self._vlan.flood:
+            # unknown unicast, broadcast and unregistered multicast are
+            # flooded here instead of by the linux bridge, which gets a
+            # copy to learn from and for the host itself. The replicator
+            # never sends back out of the port the packet came in on.
+            # Link local frames, which bridges do not forward, go to the
+            # kernel only.
+            pipe.connect(b_in, v_out, ogate=2)
+            targets = self._flood_targets()
+            flood = pipe.module(
+                "Replicate", "fl{}".format(self.ifname),
+                {"gates":list(range(len(targets) + 1))})
+            pipe.connect(b_in, flood, ogate=0)
+            pipe.connect(flood, v_out, ogate=0)
+            for (gate, hout) in enumerate(targets, 1):
+                pipe.connect(flood, hout, ogate=gate)
+            # the vports are isolated, IGMP has to be flooded here too
+            # to reach queriers and routers behind the other ports
+            onward = flood
+        else:
             # make bpf skip go to underlying linux bridge slow path
-            self._bess.connect_modules(b_in.name, v_out.name, ogate=0)
-
-            # make snoop output go to unix domain monitor port
-            self._bess.connect_modules(b_in.name, snoop_out.name, ogate=1)
+            pipe.connect(b_in, v_out, ogate=0)
+            onward = v_out
 
-            # make traffic returned via snoop to reappear on linux bridge
-            self._bess.connect_modules(snoop_in.name, v_out.name)
+        snoop = self._vlan.snoop
+        if snoop is None:
+            self._snoop_socket(pipe, b_in, onward)
+        else:
+            # tee - the packet goes on to the linux bridge right away and
+            # a copy tagged with our id goes to the shared snoop port
+            tee = pipe.module("Replicate", "tee{}".format(self.ifname), {"gates":[0, 1]})
+            tag = pipe.module("VLANPush", "tag{}".format(self.ifname), {"tci":snoop.tag(self)})
+            pipe.connect(b_in, tee, ogate=1)
+            pipe.connect(tee, onward, ogate=0)
+            pipe.connect(tee, tag, ogate=1)
+            pipe.connect(tag, snoop.out)
+
+        # simple default output - anything out of the underlying linux
+        # bridge just goes out of the door
+        pipe.connect(v_in, p_out)
+
+        # the slow path polls add no load worth balancing
+        pipe.task(v_in, self._cores, 0)
+        return pipe
+
+    def _snoop_socket(self, pipe, b_in, onward):
+        '''Snoop over a unix socket of our own, the snooped packets are
+           written back by the feed and go on to onward'''
+        pipe.port(
+            "UnixSocketPort", "pu{}".format(self.ifname),
+            {"path":"/var/tmp/bess-u{}".format(self.ifname)})
+
+        snoop_out = pipe.module(
+            "PortOut", "uout{}".format(self.ifname), {"port": "pu{}".format(self.ifname)})
+        snoop_in = pipe.module(
+            "PortInc", "uinc{}".format(self.ifname), {"port": "pu{}".format(self.ifname)})
+
+        # make snoop output go to unix domain monitor port
+        pipe.connect(b_in, snoop_out, ogate=1)
+
+        # make traffic returned via snoop to reappear on linux bridge
+        pipe.connect(snoop_in, onward)
+        pipe.task(snoop_in, self._cores, 0)
 
-            # simple default output - anything out of the underlying linux
-            # bridge just goes out of the door
-            self._bess.connect_modules(v_in.name, p_out.name)
+    def initialize(self):
+        '''Create underlying BESS port'''
+        PipelineBuilder(self._bess).build([self.pipeline()])
+        self.attach()
 
-            self.snoopfeed = IGMPFeed("/var/tmp/bess-u{}".format(self.ifname), self, self._vlan)
+    def attach(self):
+        '''Pick up the BESS side once our pipeline has been built'''
+        self._initialized = True
+        self._logical_port = "v{}".format(self.ifname)
+        if self._pci_id is not None:
+            logging.debug("Pipeline for %s", self.ifname)
+            self._phys_port = "h{}".format(self.ifname)
+            self._pg_map[-1] = 0 # default gate
+            if self._vlan.snoop is None:
+                self.snoopfeed = IGMPFeed(
+                    "/var/tmp/bess-u{}".format(self.ifname), self, self._vlan)
 
 
-    def _del_rules(self, mac_list):
+    def _rule_command(self, forwarder, command, arg_type, arg, count):
+        '''Run a forwarder rule command, accounting for it in the metrics'''
+        start = time.time()
+        try:
+            self._bess.run_module_command(forwarder, command, arg_type, arg)
+        # the exceptions barfed by the grpc stack are anything but "well defined"
+        # pylint: disable=bare-except
+        except:
+            BESS_CALLS.inc((command, "error"))
+            raise
+        finally:
+            BESS_LATENCY.observe(time.time() - start, (command,))
+        BESS_CALLS.inc((command, "ok"))
+        BATCH_ENTRIES.observe(count, (command,))
+
+    def _del_rules(self, forwarder, mac_list):
         '''Del MAC-GATE Rules'''
         if mac_list:
-            self._bess.run_module_command(
-                "f{}".format(self.ifname),
-                "delete",
-                "L2ForwardCommandDeleteArg",
-                {"addrs":mac_list})
+            self._rule_command(
+                forwarder, "delete", "L2ForwardCommandDeleteArg", {"addrs":mac_list}, len(mac_list))
 
-    def _add_rules(self, entries):
+    def _add_rules(self, forwarder, entries):
         '''Add MAC-GATE Rules'''
         if entries:
-            self._bess.run_module_command(
-                "f{}".format(self.ifname),
-                "add",
-                "L2ForwardCommandAddArg",
-                {"entries":entries})
-
-    def refresh(self, change):
-        '''As we do not have counters yet, a refresh is a pass'''
-        pass
+            self._rule_command(
+                forwarder, "add", "L2ForwardCommandAddArg", {"entries":entries}, len(entries))
 
-
-    def add(self, change):
-        '''Add a MAC route from fdb, fdb now splits them into
-           single entry commands so we do not do bulking any more'''
-        if change.source == self:
-            logging.debug("Skipping %s %s", self.ifname, change.mac)
+    @property
+    def pending(self):
+        '''Number of queued rule changes'''
+        return len(self._pending)
+
+    def _queue(self, mac, gate):
+        '''Queue the rule a MAC should have, None for no rule. Nothing
+           is queued if the forwarders already have it.'''
+        if mac not in self._inflight and mac not in self._split and \
+                self._shadow.get(mac) == gate:
+            # back to what the forwarder holds, drop anything queued
+            self._pending.pop(mac, None)
             return
-        to_add = []
-        p_g = None
-        if change.is_broadcast:
-            logging.debug("Add requested for %s %s %s", self.ifname, change.mac, change.ports)
-            p_g = self._m_to_g(change.ports)
+        self._pending[mac] = gate
+        self._commit()
+
+    def _commit(self):
+        '''Hand the queued changes to the batcher or push them now'''
+        if self._batcher is None:
+            failed = self.flush()
+            if failed:
+                report({self:failed}, "Rule update")
         else:
-            p_g = self._p_to_g(change.source.ifname)
-        if p_g is not None:
-            to_add.append({"addr":change.mac, "gate":p_g})
+            self._batcher.mark(self)
+
+    def flush(self, size=None):
+        '''Push queued changes to the forwarder. Returns the list of
+           changes which failed, the shadow keeps the old state for
+           those.'''
+        batch = self.take(size)
+        if batch is None:
+            return []
+        failed = self.send(batch)
+        self.settle(batch, failed)
+        return failed
+
+    def take(self, size=None):
+        '''Take the queued changes for sending in commands of at most
+           size entries. Only the differences from the shadow table go
+           out - all deletes first so that a MAC which changes gate ends
+           up with its new one. MACs with changes in flight stay queued,
+           batches in flight never share a MAC and need no ordering
+           between them. Returns None if there is nothing to do.'''
+        to_del = []
+        to_add = []
+        held = {}
+        for (mac, gate) in self._pending.items():
+            if mac in self._inflight:
+                held[mac] = gate
+                continue
+            current = self._shadow.get(mac)
+            if mac in self._split:
+                # whatever each forwarder has, a delete which may miss
+                # and an add bring them all in line
+                to_del.append(mac)
+                if gate is not None:
+                    to_add.append({"addr":mac, "gate":gate})
+                continue
+            if current == gate:
+                continue
+            if current is not None:
+                to_del.append(mac)
+            if gate is not None:
+                to_add.append({"addr":mac, "gate":gate})
+        self._pending = held
+        needed = len(self._shadow) + len(to_add) - len(to_del)
+        if needed >= TABLE_HIGH * self.capacity:
+            self._crowded_table(needed)
+        retired = []
+        if not held:
+            # nothing points at the retired replicators once this is in
+            retired = self._retired
+            self._retired = []
+        if not to_del and not to_add and not retired:
+            return None
+        self._inflight.update(to_del)
+        self._inflight.update(item["addr"] for item in to_add)
+        if size is None and self._batcher is not None:
+            size = self._batcher.max_entries
+        return (list(chunks(to_del, size)), list(chunks(to_add, size)), retired)
+
+    def _crowded_table(self, needed):
+        '''The forwarder is about to fill up, grow it if allowed and
+           nothing is in flight to it, else report it once. A rebuild
+           which failed is not tried again on every batch, only once the
+           table has been below TABLE_LOW.'''
+        if self._table_arg("table_grow") and not self._inflight and not self._rebuild_failed:
+            if self.rebuild(needed):
+                return
+        if not self._crowded:
+            logging.warning("Forwarder of %s is filling up, %d entries in %d (size %d bucket %d)",
+                            self.ifname, needed, self.capacity,
+                            self._table_size, self._table_bucket)
+            self._crowded = True
+
+    def _build_forwarder(self, name, size, bucket):
+        '''Create a forwarder wired like the current ones and fill it
+           from the shadow'''
+        self._bess.create_module(
+            "L2Forward", name, {"source_check": True, "size":size, "bucket":bucket})
+        self._bess.run_module_command(
+            name, "set_default_gate", "L2ForwardCommandSetDefaultGateArg", {"gate":0})
+        self._bess.connect_modules(name, "bin{}".format(self.ifname), ogate=0)
+        for (port, gate) in self._pg_map.items():
+            if gate:
+                self._bess.connect_modules(name, self._hout_port(port), ogate=gate)
+        for gate in self._replicators.gates():
+            self._bess.connect_modules(name, self._replicators.name(gate), ogate=gate)
+        if self._vlan.flood:
+            self._bess.connect_modules(name, "drop{}".format(self.ifname), ogate=DROP_GATE)
+        entries = [{"addr":mac, "gate":gate} for (mac, gate) in self._shadow.items()]
+        for chunk in chunks(entries, INSTALL_CHUNK):
+            self._bess.run_module_command(
+                name, "add", "L2ForwardCommandAddArg", {"entries":chunk})
+
+    def _swap_input(self, queue, old, new):
+        '''Point the input of a receive queue at another forwarder'''
+        self._bess.disconnect_modules(self._input_name(queue), ogate=0)
         try:
-            if to_add:
-                logging.debug("Adding on %s %s", self.ifname, to_add)
-                self._add_rules(to_add)
+            self._bess.connect_modules(self._input_name(queue), new)
+        # pylint: disable=bare-except
+        except:
+            self._bess.connect_modules(self._input_name(queue), old)
+            raise
+
+    def rebuild(self, expected):
+        '''Replace the forwarders with ones sized for expected entries.
+           The new ones are created, wired and filled from the shadow
+           next to the old ones, then swapped in on the queue inputs, so
+           traffic keeps being forwarded throughout. Returns whether it
+           worked, the old forwarders stay in use if not.'''
+        (size, bucket) = table_geometry(expected, bucket=self._table_bucket)
+        size = max(size, self._table_size * 2)
+        old = self.forwarders
+        new = self._forwarder_names(self._generation + 1)
+        logging.info("Rebuilding forwarders of %s with size %d bucket %d for %d entries",
+                     self.ifname, size, bucket, expected)
+        start = time.time()
+        created = []
+        swapped = []
+        try:
+            for name in new:
+                created.append(name)
+                self._build_forwarder(name, size, bucket)
+            for (queue, (was, name)) in enumerate(zip(old, new)):
+                self._swap_input(queue, was, name)
+                swapped.append(queue)
         # the exceptions barfed by the grpc stack are anything but "well defined"
         # pylint: disable=bare-except
         except:
-            logging.error("Add failed on %s %s", self.ifname, to_add)
+            logging.error("Failed to rebuild forwarders of %s after %.3fs, not retrying "
+                          "until it drains", self.ifname, time.time() - start)
+            self._rebuild_failed = True
+            try:
+                for queue in swapped:
+                    self._swap_input(queue, new[queue], old[queue])
+            # pylint: disable=bare-except
+            except:
+                logging.error("Failed to put the old forwarders of %s back", self.ifname)
+            for name in created:
+                try:
+                    self._bess.destroy_module(name)
+                # pylint: disable=bare-except
+                except:
+                    pass
+            return False
+        self._generation += 1
+        # the new forwarders were all filled from the shadow
+        self._split = set()
+        for name in old:
+            try:
+                self._bess.destroy_module(name)
+            # pylint: disable=bare-except
+            except:
+                logging.error("Failed to destroy old forwarder %s", name)
+        (self._table_size, self._table_bucket) = (size, bucket)
+        self._crowded = False
+        FWD_REBUILDS.inc()
+        logging.info("Rebuilt forwarders of %s in %.3fs", self.ifname, time.time() - start)
+        return True
+
+    def send(self, batch):
+        '''Push a batch from take() to every queue forwarder. Only
+           talks to BESS, it may run off the main loop thread. Returns
+           the changes which failed as (what, item, forwarder).'''
+        (deletes, adds, _) = batch
+        failed = []
+        for forwarder in self.forwarders:
+            result = []
+            for chunk in deletes:
+                result.extend(self._push(
+                    functools.partial(self._del_rules, forwarder), chunk, errno.ENOENT, "delete"))
+            for chunk in adds:
+                # the shadow says the MAC is not there, EEXIST is drift
+                # unless the rule turns out to be the one we wanted
+                result.extend(self._push(
+                    functools.partial(self._add_rules, forwarder), chunk, None, "add",
+                    functools.partial(self._holds, forwarder)))
+            failed.extend((what, item, forwarder) for (what, item) in result)
+        return failed
+
+    def settle(self, batch, failed):
+        '''Account for a sent batch, the shadow takes the changes which
+           made it in. None for failed means the batch never got to BESS.
+           A change which made it to some of the queue forwarders only
+           goes in the shadow and leaves the MAC split.'''
+        (deletes, adds, retired) = batch
+        forwarders = self.forwarders
+        if failed is None:
+            # the old rules may still point at the retired replicators
+            self._retired.extend(retired)
+            retired = []
+            failed = [("delete", mac, name) for chunk in deletes for mac in chunk
+                      for name in forwarders]
+            failed.extend(("add", item, name) for chunk in adds for item in chunk
+                          for name in forwarders)
+        lost = {}
+        for (what, item, forwarder) in failed:
+            key = (what, item if what == "delete" else item["addr"])
+            lost.setdefault(key, set()).add(forwarder)
+        for chunk in deletes:
+            for mac in chunk:
+                self._inflight.discard(mac)
+                where = lost.get(("delete", mac), ())
+                if not where:
+                    self._shadow.pop(mac, None)
+                    self._split.discard(mac)
+                elif len(where) < len(forwarders):
+                    self._split.add(mac)
+        for chunk in adds:
+            for item in chunk:
+                self._inflight.discard(item["addr"])
+                where = lost.get(("add", item["addr"]), ())
+                if len(where) < len(forwarders):
+                    self._shadow[item["addr"]] = item["gate"]
+                    if where:
+                        self._split.add(item["addr"])
+                    elif ("delete", item["addr"]) not in lost:
+                        self._split.discard(item["addr"])
+        for key in retired:
+            self._replicators.release(key)
+        if self._crowded and self.occupancy < TABLE_LOW * self.capacity:
+            self._crowded = False
+            self._rebuild_failed = False
+
+    def _push(self, command, chunk, benign, what, present=None):
+        '''Run a batched command. L2Forward stops at the first entry
+           which fails, so on failure retry entry by entry to get the
+           rest of the batch in. Returns the entries which failed, an
+           error with the benign errno counts as success, as does one
+           for which present(item, errno) says BESS holds the item.'''
+        def done(item, err):
+            '''Whether a failed item is in place all the same'''
+            code = getattr(err, "code", None)
+            if benign is not None and code == benign:
+                return True
+            return present is not None and present(item, code)
 
-    def delete(self, change):
-        '''Add a MAC route from fdb, fdb now splits them into
-           single entry commands so we do not do bulking any more'''
-        # we do not do not skip a deletion request even if the dest
-        # port is ourselves. The reason for this is that in case of a
-        # port move the new port may be ourselves, the old one is a
-        # different port for which we need to delete the routing entry
-        to_del = [change.mac]
         try:
-            logging.debug("Deleting on %s %s", self.ifname, to_del)
-            self._del_rules(to_del)
+            logging.debug("%s on %s %d entries", what, self.ifname, len(chunk))
+            command(chunk)
+            return []
         # the exceptions barfed by the grpc stack are anything but "well defined"
+        # pylint: disable=broad-except
+        except Exception as err:
+            if len(chunk) == 1:
+                return [] if done(chunk[0], err) else [(what, chunk[0])]
+            logging.debug("%s batch failed on %s, retrying one by one", what, self.ifname)
+        failed = []
+        for item in chunk:
+            try:
+                command([item])
+            # pylint: disable=broad-except
+            except Exception as err:
+                if not done(item, err):
+                    failed.append((what, item))
+        return failed
+
+    def _holds(self, forwarder, item, code):
+        '''Whether an add which failed with EEXIST found the rule it
+           wanted in place. The entries ahead of the one which failed a
+           batch made it in the first time and fail so on the retry.'''
+        if code != errno.EEXIST:
+            return False
+        result = {}
+        try:
+            self._lookup([item["addr"]], result, forwarder)
         # pylint: disable=bare-except
         except:
-            logging.error("Delete failed on %s %s", self.ifname, to_del)
+            return False
+        return result.get(item["addr"]) == item["gate"]
+
+    def _lookup(self, macs, result, forwarder=None):
+        '''Fill result with the gates a forwarder, by default the first,
+           has for a list of MACs, None for those it does not have. A
+           lookup fails as a whole on the first missing MAC, a failing
+           lookup is split in halves until the missing MACs have been
+           found.'''
+        if not macs:
+            return
+        if forwarder is None:
+            forwarder = self.forwarder
+        try:
+            response = self._bess.run_module_command(
+                forwarder, "lookup", "L2ForwardCommandLookupArg", {"addrs":macs})
+        # pylint: disable=broad-except
+        except Exception as err:
+            if getattr(err, "code", None) != errno.ENOENT:
+                raise
+            if len(macs) == 1:
+                result[macs[0]] = None
+                return
+            half = len(macs) // 2
+            self._lookup(macs[:half], result, forwarder)
+            self._lookup(macs[half:], result, forwarder)
+            return
+        result.update(zip(macs, response.gates))
+
+    def expected(self, entries):
+        '''The MAC to gate table this forwarder should hold for a list of
+           fdb entries'''
+        table = {}
+        for entry in entries:
+            if entry.is_broadcast:
+                gate = self._replicators.gate(self._mcast.get(entry.mac))
+            else:
+                gate = self._gate(entry)
+            if gate is not None:
+                table[entry.mac] = gate
+        return table
+
+    def _actual(self, macs, forwarder=None):
+        '''What a forwarder holds for a list of MACs'''
+        size = None
+        if self._batcher is not None:
+            size = self._batcher.max_entries
+        actual = {}
+        for chunk in chunks(macs, size):
+            self._lookup(chunk, actual, forwarder)
+        return actual
+
+    def diff(self, entries):
+        '''Compare the queue forwarders with the fdb entries they serve
+           and with the shadow table. Returns a dict of MAC to (expected
+           gate, actual gate) for every MAC where a forwarder is wrong,
+           with the gate of the first one which is, None meaning no
+           rule.'''
+        expected = self.expected(entries)
+        macs = list(set(expected) | set(self._shadow))
+        result = {}
+        for forwarder in self.forwarders:
+            actual = self._actual(macs, forwarder)
+            for mac in macs:
+                if mac not in result and expected.get(mac) != actual[mac]:
+                    result[mac] = (expected.get(mac), actual[mac])
+        return result
+
+    def resync(self, entries, verify=True):
+        '''Repair drift between the forwarder, its shadow table and the
+           fdb entries it serves without resetting anything. The shadow
+           is rebuilt from what the forwarder actually holds and the
+           differences are pushed. With verify false the shadow is
+           trusted and nothing is looked up. Returns the number of MACs
+           repaired.'''
+        expected = self.expected(entries)
+        macs = list(set(expected) | set(self._shadow))
+        if verify:
+            views = [self._actual(macs, forwarder) for forwarder in self.forwarders]
+            actual = views[0]
+            self._split = set(
+                mac for mac in macs if any(view[mac] != actual[mac] for view in views[1:]))
+            self._shadow = {}
+            for mac in macs:
+                gate = next((view[mac] for view in views if view[mac] is not None), None)
+                if gate is not None:
+                    self._shadow[mac] = gate
+        else:
+            actual = dict(self._shadow)
+        drift = 0
+        for mac in macs:
+            if mac in self._split or expected.get(mac) != actual.get(mac):
+                self._pending[mac] = expected.get(mac)
+                drift += 1
+        failed = self.flush()
+        if failed:
+            report({self:failed}, "Resync")
+        if drift:
+            logging.info("Repaired %d drifted entries on %s", drift, self.ifname)
+        return drift
+
+    def modules(self, state=None):
+        '''Names of the BESS modules of this port, with the replicators
+           of a snapshot if one is given'''
+        names = [name for (_, name, _) in self.pipeline().modules]
+        if state is None:
+            return names + self._replicators.modules()
+        forwarders = self.forwarders
+        names = [name for name in names if name not in forwarders]
+        names.extend(self._forwarder_names(state.get("generation", 0)))
+        return names + [self._replicators.name(gate) for (gate, _) in state["replicators"].values()]
+
+    def snapshot(self, entries):
+        '''State for a warm restart. The shadow is not saved as such,
+           only where it differs from what the fdb entries call for.'''
+        expected = self.expected(entries)
+        drift = {}
+        for mac in set(expected) | set(self._shadow):
+            if expected.get(mac) != self._shadow.get(mac):
+                drift[mac] = self._shadow.get(mac)
+        return {"pg_map":list(self._pg_map.items()), "gates":self._gates.snapshot(),
+                "replicators":self._replicators.snapshot(), "mcast":self._mcast, "drift":drift,
+                "generation":self._generation, "table":[self._table_size, self._table_bucket]}
+
+    def restore(self, state, entries):
+        '''Pick up where the run which saved state left off. entries are
+           the fdb entries the state was saved with, the shadow follows
+           from them.'''
+        self._pg_map = dict((port, gate) for (port, gate) in state["pg_map"])
+        self._generation = state.get("generation", 0)
+        if "table" in state:
+            (self._table_size, self._table_bucket) = state["table"]
+        self._gates.restore(state["gates"])
+        self._mcast = dict(state["mcast"])
+        refs = {}
+        for key in self._mcast.values():
+            refs[key] = refs.get(key, 0) + 1
+        self._replicators.restore(state["replicators"], refs)
+        for key in state["replicators"]:
+            if key not in refs:
+                # retired before the save, let the next flush drop it
+                self._retired.append(key)
+        self._shadow = self.expected(entries)
+        for (mac, gate) in state["drift"].items():
+            if gate is None:
+                self._shadow.pop(mac, None)
+            else:
+                self._shadow[mac] = gate
 
-    def replace(self, change):
-        '''Add a MAC route from fdb, fdb now splits them into
-           single entry commands so we do not do bulking any more'''
-        self.delete(change)
-        self.add(change)
+    def refresh(self, change):
+        '''As we do not have counters yet, a refresh is a pass'''
+        pass
+
+
+    def _gate(self, change):
+        '''Gate this forwarder should send a unicast fdb entry to or
+           None if it should not hold a rule for it. In flood vlans a MAC
+           behind this port is dropped, it would be flooded otherwise.'''
+        if change.source == self:
+            if self._vlan.flood:
+                return DROP_GATE
+            return None
+        return self._p_to_g(change.source.ifname)
+
+    def _acquire_gate(self, change):
+        '''Gate for a new rule, multicast ones take a replicator reference'''
+        if change.is_broadcast:
+            return self._m_to_g(change.mac, change.ports)
+        return self._gate(change)
+
+    def add(self, change):
+        '''Add a MAC route from fdb. The rule is queued and goes to
+           BESS with the rest of the batch'''
+        p_g = self._acquire_gate(change)
+        if p_g is None:
+            logging.debug("Skipping %s %s", self.ifname, change.mac)
+            return
+        logging.debug("Queue add on %s %s %s", self.ifname, change.mac, p_g)
+        self._queue(change.mac, p_g)
+
+    def delete(self, change):
+        '''Delete a MAC route from fdb. The rule is queued and goes to
+           BESS with the rest of the batch'''
+        # the shadow table tells whether we hold a rule for the MAC, a
+        # delete only goes to BESS if we do
+        logging.debug("Queue delete on %s %s", self.ifname, change.mac)
+        self._release_mcast(change.mac)
+        self._queue(change.mac, None)
+
+    def install(self, entries):
+        '''Install a list of entries straight into the forwarder, in
+           large chunks. Used to load the initial FDB, bypasses batching.
+           Returns the entries which failed.'''
+        for entry in entries:
+            gate = self._acquire_gate(entry)
+            if gate is not None and (self._shadow.get(entry.mac) != gate or
+                                     entry.mac in self._split):
+                self._pending[entry.mac] = gate
+        count = len(self._pending)
+        failed = self.flush(INSTALL_CHUNK)
+        logging.debug("Installed %d entries on %s", count, self.ifname)
+        return failed
+
+    def move(self, old, new):
+        '''Move a MAC to a new destination. Only the rule change this
+           forwarder actually needs is queued - nothing if the gate is
+           the same, an add or a delete if the forwarder gains or loses
+           the rule, a delete and add pair if the gate changes'''
+        if new.is_broadcast:
+            if self._mcast.get(old.mac) == self._mcast_key(new.ports):
+                logging.debug("Replicator unchanged on %s %s", self.ifname, new.mac)
+                return
+            gate = self._m_to_g(new.mac, new.ports)
+        else:
+            gate = self._gate(new)
+        logging.debug("Queue move on %s %s %s", self.ifname, new.mac, gate)
+        self._queue(new.mac, gate)
+
+    def regroup(self, mac, ports):
+        '''Follow a join or leave on a multicast group. If the group is
+           the only user of its replicator and no other replicator covers
+           the new port set, the replicator is changed in place and the
+           forwarder rule stays. Otherwise the rule is pointed at the
+           replicator for the new set. Only our state is changed, the
+           replicator calls this takes are returned for the caller to
+           run, before the queued rule is flushed.'''
+        calls = []
+        old_key = self._mcast.get(mac)
+        new_key = self._mcast_key(ports)
+        if old_key == new_key:
+            return calls
+        if old_key is not None and new_key is not None and \
+                self._replicators.exclusive(old_key) and \
+                self._replicators.gate(new_key) is None:
+            self._replicators.rekey(
+                old_key, new_key, [port.ifname for port in ports if port.ifname != self.ifname],
+                calls)
+            self._mcast[mac] = new_key
+            return calls
+        self._queue(mac, self._m_to_g(mac, ports, calls))
+        return calls
+
+    def replace(self, old, new):
+        '''Replace a MAC route from fdb'''
+        self.move(old, new)
@@ -0,0 +1,114 @@
+'''Timer wheel and FDB aging'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import unittest
+from aging import TimerWheel
+from fdb import FDB
+
+
+class Item(object):
+    '''Wheel item with a movable deadline'''
+    # pylint: disable=too-few-public-methods
+    def __init__(self, when):
+        self.when = when
+
+
+def deadline(item):
+    '''Deadline of an item, None once cancelled'''
+    return item.when
+
+
+class TestTimerWheel(unittest.TestCase):
+    '''Scheduling, refiling and cancelling'''
+
+    def test_fires_when_due(self):
+        wheel = TimerWheel(100, tick=1.0, slots=8)
+        item = Item(103.5)
+        wheel.schedule(item, item.when)
+        self.assertEqual(wheel.advance(103, deadline), [])
+        self.assertEqual(wheel.advance(104, deadline), [item])
+        self.assertEqual(len(wheel), 0)
+
+    def test_refresh_refiles(self):
+        wheel = TimerWheel(100, tick=1.0, slots=8)
+        item = Item(102)
+        wheel.schedule(item, item.when)
+        item.when = 105
+        self.assertEqual(wheel.advance(103, deadline), [])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(105, deadline), [item])
+
+    def test_cancelled_dropped(self):
+        wheel = TimerWheel(100, tick=1.0, slots=8)
+        item = Item(102)
+        wheel.schedule(item, item.when)
+        item.when = None
+        self.assertEqual(wheel.advance(110, deadline), [])
+        self.assertEqual(len(wheel), 0)
+
+    def test_beyond_one_revolution(self):
+        wheel = TimerWheel(100, tick=1.0, slots=8)
+        item = Item(120)
+        wheel.schedule(item, item.when)
+        # the slot comes up twice before the deadline
+        self.assertEqual(wheel.advance(119, deadline), [])
+        self.assertEqual(wheel.advance(121, deadline), [item])
+
+    def test_long_sleep(self):
+        wheel = TimerWheel(100, tick=1.0, slots=8)
+        items = [Item(101 + number) for number in range(6)]
+        for item in items:
+            wheel.schedule(item, item.when)
+        # away for many revolutions, every slot is visited once
+        self.assertEqual(sorted(wheel.advance(1000, deadline), key=deadline), items)
+
+    def test_past_deadline_next_tick(self):
+        wheel = TimerWheel(100, tick=1.0, slots=8)
+        item = Item(50)
+        wheel.schedule(item, item.when)
+        self.assertEqual(wheel.advance(101, deadline), [item])
+
+
+class FakeVlan(object):
+    '''Records the deletes the FDB pushes'''
+    # pylint: disable=too-few-public-methods
+    vlan_no = 3
+
+    def __init__(self):
+        self.deleted = []
+
+    def add(self, entry):
+        '''Entry added'''
+
+    def delete(self, entry):
+        '''Entry deleted'''
+        self.deleted.append(entry.mac)
+
+
+class TestFDBAging(unittest.TestCase):
+    '''Aging through the wheel with a kernel check'''
+
+    def test_age_out_and_keep_alive(self):
+        fdb = FDB(max_age=10)
+        vlan = FakeVlan()
+        fdb.learn("02:00:00:00:00:01", vlan, "p1")
+        fdb.learn("02:00:00:00:00:02", vlan, "p1")
+        now = fdb.get_entry("02:00:00:00:00:01", vlan).expiry + 1
+        keep = fdb.get_entry("02:00:00:00:00:02", vlan).key
+        checked = []
+
+        def alive(entries):
+            checked.extend(entries)
+            return set([keep])
+
+        self.assertEqual(fdb.age(now, alive), 1)
+        self.assertEqual(len(checked), 2)
+        self.assertEqual(vlan.deleted, ["02:00:00:00:00:01"])
+        self.assertEqual(len(fdb), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
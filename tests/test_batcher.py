@@ -0,0 +1,86 @@
+'''Rule batching against the fake BESS'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import unittest
+from unittest import mock
+from batcher import Batcher, chunks
+from fake_bess import FakeBESS
+from fanout import FanOut
+from fdb import FDB
+from test_switchport import fake_vlan, macs
+
+
+class TestBatcher(unittest.TestCase):
+    '''Changes wait for the size cap or the deadline'''
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.batcher = Batcher(max_entries=4, deadline=10, fanout=FanOut(1))
+        self.vlan = fake_vlan(self.bess, 2, self.batcher)
+        (self.port, self.peer) = list(self.vlan.ports)
+        self.fdb = FDB()
+
+    def tearDown(self):
+        self.batcher.fanout.shutdown()
+
+    def learn(self, count, base=0):
+        '''Learn MACs behind the peer, the port queues their rules'''
+        for mac in macs(count, base):
+            self.fdb.learn(mac, self.vlan, self.peer)
+
+    def table(self):
+        '''Rules in the forwarder of the port'''
+        return self.bess.tables[self.port.forwarders[0]]
+
+    def test_size_cap(self):
+        self.learn(3)
+        self.assertEqual(self.port.pending, 3)
+        self.assertEqual(self.table(), {})
+        self.assertEqual(self.batcher.pending, 1)
+        # the fourth change hits the cap and goes out in one command
+        self.learn(1, 3)
+        self.assertEqual(self.port.pending, 0)
+        self.assertEqual(sorted(self.table()), macs(4))
+        self.assertEqual(self.bess.calls["add"], 1)
+        self.assertEqual(self.batcher.pending, 0)
+
+    def test_size_cap_pipelined(self):
+        # the runtime sends the batch, the cap only makes it due
+        self.batcher.pipelined = True
+        self.learn(4)
+        self.assertEqual(self.port.pending, 4)
+        self.assertEqual(self.table(), {})
+        self.assertTrue(self.batcher.due())
+        (ports, _) = self.batcher.take(lambda port: True)
+        self.assertEqual(ports, [self.port])
+        self.assertFalse(self.batcher.due())
+
+    def test_deadline(self):
+        with mock.patch("batcher.time.time", return_value=100.0):
+            self.assertFalse(self.batcher.due())
+            self.learn(2)
+        with mock.patch("batcher.time.time", return_value=109.0):
+            self.assertFalse(self.batcher.due())
+        with mock.patch("batcher.time.time", return_value=110.0):
+            self.assertTrue(self.batcher.due())
+            self.assertEqual(self.batcher.flush(), {})
+        self.assertEqual(sorted(self.table()), macs(2))
+        self.assertEqual(self.bess.calls["add"], 1)
+        self.assertFalse(self.batcher.due())
+        self.assertEqual(self.batcher.pending, 0)
+
+    def test_flush_failure(self):
+        self.learn(2)
+        # a stale rule behind the back of the port makes its add fail
+        self.bess.tables[self.port.forwarders[0]][macs(1)[0]] = 2
+        failures = self.batcher.flush()
+        self.assertEqual(list(failures), [self.port])
+        self.assertEqual(sorted(self.table()), macs(2))
+
+    def test_chunks(self):
+        self.assertEqual(list(chunks([1, 2, 3, 4, 5], 2)), [[1, 2], [3, 4], [5]])
+        self.assertEqual(list(chunks([1, 2, 3], 0)), [[1, 2, 3]])
+        self.assertEqual(list(chunks([], 0)), [])
@@ -0,0 +1,120 @@
+'''Coalescing windows and the learn rate limit'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import unittest
+from coalesce import Coalescer, TokenBucket
+
+
+class Named(object):
+    '''Stands in for a vlan or a port'''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, name):
+        self.ifname = name
+        self.vlan_no = name
+
+
+def learn(mac, port, bridge="br"):
+    '''A kernel FDB learn'''
+    return {"type":"RTM_NEWNEIGH", "mac":mac, "port":port, "bridge":bridge}
+
+
+def remove(mac, bridge="br"):
+    '''A kernel FDB removal'''
+    return {"type":"RTM_DELNEIGH", "mac":mac, "port":None, "bridge":bridge}
+
+
+class TestTokenBucket(unittest.TestCase):
+    '''Rate and burst'''
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(10, 3, 0)
+        self.assertEqual([bucket.take(0) for _ in range(4)], [True, True, True, False])
+        # 0.2s at 10/s buys two tokens
+        self.assertTrue(bucket.take(0.2))
+        self.assertTrue(bucket.take(0.2))
+        self.assertFalse(bucket.take(0.2))
+
+    def test_burst_cap(self):
+        bucket = TokenBucket(10, 3, 0)
+        for _ in range(3):
+            bucket.take(0)
+        self.assertEqual(sum(bucket.take(100) for _ in range(5)), 3)
+
+
+class TestCoalescer(unittest.TestCase):
+    '''Windows, per port queues and removals'''
+
+    def setUp(self):
+        self.ports = [Named("p1"), Named("p2")]
+
+    def test_window(self):
+        coalescer = Coalescer(window=0.01)
+        self.assertFalse(coalescer.due(0))
+        self.assertEqual(coalescer.timeout(1, 0), 1)
+        coalescer.push(learn("m1", self.ports[0]), 0)
+        coalescer.push(learn("m1", self.ports[1]), 0.002)
+        coalescer.push(learn("m1", self.ports[0]), 0.004)
+        self.assertEqual(len(coalescer), 1)
+        self.assertAlmostEqual(coalescer.timeout(1, 0.004), 0.006)
+        self.assertFalse(coalescer.due(0.005))
+        self.assertTrue(coalescer.due(0.01))
+        ready = coalescer.drain(0.01, lambda mess: True)
+        self.assertEqual(len(ready), 1)
+        self.assertIs(ready[0]["port"], self.ports[0])
+        self.assertEqual(coalescer.flaps, {self.ports[1]:1, self.ports[0]:1})
+        self.assertFalse(coalescer.due(1))
+
+    def test_unlimited_by_default(self):
+        coalescer = Coalescer()
+        for index in range(100):
+            coalescer.push(learn(index, self.ports[0]), 0)
+        self.assertEqual(len(coalescer.drain(1, lambda mess: True)), 100)
+
+    def test_rate_limit_per_port(self):
+        coalescer = Coalescer(window=0.01, rate=10, burst=2)
+        for index in range(5):
+            coalescer.push(learn(index, self.ports[0]), 0)
+        coalescer.push(learn("other", self.ports[1]), 0)
+        ready = coalescer.drain(0.01, lambda mess: True)
+        # the storm on p1 does not hold up p2
+        self.assertEqual([mess["mac"] for mess in ready], [0, 1, "other"])
+        self.assertEqual(len(coalescer), 3)
+        # the window restarts for what is left
+        self.assertFalse(coalescer.due(0.015))
+        ready = coalescer.drain(0.11, lambda mess: True)
+        self.assertEqual([mess["mac"] for mess in ready], [2])
+
+    def test_refresh_is_free(self):
+        coalescer = Coalescer(window=0.01, rate=10, burst=1)
+        for index in range(5):
+            coalescer.push(learn(index, self.ports[0]), 0)
+        self.assertEqual(len(coalescer.drain(0.01, lambda mess: False)), 5)
+
+    def test_removal_not_limited(self):
+        coalescer = Coalescer(window=0.01, rate=10, burst=1)
+        coalescer.push(learn("m1", self.ports[0]), 0)
+        coalescer.push(learn("m2", self.ports[0]), 0)
+        coalescer.push(remove("m3"), 0)
+        ready = coalescer.drain(0.01, lambda mess: True)
+        self.assertEqual(sorted(mess["mac"] for mess in ready), ["m1", "m3"])
+
+    def test_removal_cancels_learn(self):
+        coalescer = Coalescer(window=0.01, rate=10, burst=1)
+        coalescer.push(learn("m1", self.ports[0]), 0)
+        coalescer.push(learn("m2", self.ports[0]), 0)
+        coalescer.drain(0.01, lambda mess: True)
+        # m2 is still held back when the kernel drops it
+        coalescer.push(remove("m2"), 0.012)
+        coalescer.push(remove("m1"), 0.012)
+        ready = dict((mess["mac"], mess) for mess in coalescer.drain(0.03, lambda mess: True))
+        self.assertTrue(ready["m2"].get("cancels"))
+        self.assertFalse(ready["m1"].get("cancels"))
+        self.assertEqual(len(coalescer), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+'''Fan-out of per forwarder work'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import errno
+import threading
+import unittest
+from fake_bess import FakeBESS
+from fanout import FanOut, report
+
+
+class TestFanOut(unittest.TestCase):
+    '''Every port gets its job and failures come back per port'''
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        for name in ("fwd1", "fwd2", "fwd3"):
+            self.bess.create_module("L2Forward", name, {"size":1, "bucket":1})
+
+    def work(self, name):
+        '''Add a rule, fails on fwd2 whose only slot is taken and
+           returns leftover entries on fwd3'''
+        self.bess.run_module_command(name, "add", "L2ForwardCommandAddArg", {
+            "entries":[{"addr":"02:00:00:00:00:01", "gate":1}]})
+        if name == "fwd3":
+            return ["02:00:00:00:00:02"]
+        return []
+
+    def check(self, fanout):
+        '''The failures of the same work on a fan-out'''
+        self.bess.tables["fwd2"]["02:00:00:00:00:03"] = 2
+        failures = fanout.run(["fwd1", "fwd2", "fwd3"], self.work)
+        self.assertEqual(sorted(failures), ["fwd2", "fwd3"])
+        self.assertIsInstance(failures["fwd2"], FakeBESS.Error)
+        self.assertEqual(failures["fwd2"].code, errno.ENOMEM)
+        self.assertEqual(failures["fwd3"], ["02:00:00:00:00:02"])
+        # the others ran to completion whatever failed
+        self.assertEqual(self.bess.tables["fwd1"], {"02:00:00:00:00:01":1})
+        self.assertEqual(self.bess.calls["add"], 3)
+
+    def test_sequential(self):
+        self.check(FanOut(1))
+
+    def test_pool(self):
+        fanout = FanOut(3)
+        try:
+            self.check(fanout)
+        finally:
+            fanout.shutdown()
+
+    def test_overlap(self):
+        # all jobs are in flight at once on the pool
+        fanout = FanOut(3)
+        barrier = threading.Barrier(3, timeout=5)
+
+        def meet(_):
+            barrier.wait()
+            return []
+
+        try:
+            self.assertEqual(fanout.run(["fwd1", "fwd2", "fwd3"], meet), {})
+        finally:
+            fanout.shutdown()
+
+    def test_report(self):
+        with self.assertLogs(level="ERROR") as logs:
+            report({"fwd1":["02:00:00:00:00:01", "02:00:00:00:00:02"],
+                    "fwd2":IOError("gone")}, "Rule update")
+        self.assertEqual(logs.output, [
+            "ERROR:root:Rule update failed on fwd1 for 2 entries, first 02:00:00:00:00:01",
+            "ERROR:root:Rule update failed on fwd2: gone"])
@@ -0,0 +1,146 @@
+'''Parsing of snooped IGMP'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import os
+import struct
+import unittest
+from fake_bess import FakeBESS
+from fake_feeds import FakeNetlinkFeed
+from igmp_listener import parse_igmp, convert_to_mac, record_event
+from switch import Switch
+
+SRC = "02:00:00:00:00:01"
+GROUP = b"\xef\x01\x02\x03"
+
+
+def packet(payload, tags=(), proto=2, ethertype=0x0800):
+    '''Ethernet, optional tags, IPv4 with router alert and a payload'''
+    eth = b"\x01\x00\x5e\x01\x02\x03" + b"\x02\x00\x00\x00\x00\x01"
+    for (tpid, tci) in tags:
+        eth += struct.pack("!HH", tpid, tci)
+    eth += struct.pack("!H", ethertype)
+    ip_hdr = struct.pack("!BBHHHBBH4s4s", 0x46, 0xc0, 24 + len(payload), 0, 0, 1, proto, 0,
+                         b"\x0a\x00\x00\x01", b"\xe0\x00\x00\x16")
+    return eth + ip_hdr + b"\x94\x04\x00\x00" + payload
+
+
+def v3_report(records):
+    '''IGMPv3 report from (type, sources) records for GROUP'''
+    body = b""
+    for (rtype, numsrc) in records:
+        body += struct.pack("!BBH4s", rtype, 0, numsrc, GROUP) + b"\x0a\x00\x00\x02" * numsrc
+    return struct.pack("!BxHxxH", 0x22, 0, len(records)) + body
+
+
+class TestParseIGMP(unittest.TestCase):
+    '''parse_igmp() on the wire formats we snoop'''
+
+    def test_v1_v2_reports(self):
+        for igmp_type in (0x12, 0x16):
+            self.assertEqual(
+                parse_igmp(packet(struct.pack("!BBH4s", igmp_type, 0, 0, GROUP))),
+                [("MCAST_JOIN", "239.1.2.3", SRC)])
+
+    def test_v2_leave(self):
+        self.assertEqual(parse_igmp(packet(struct.pack("!BBH4s", 0x17, 0, 0, GROUP))),
+                         [("MCAST_LEAVE", "239.1.2.3", SRC)])
+
+    def test_query_ignored(self):
+        self.assertEqual(parse_igmp(packet(struct.pack("!BBH4s", 0x11, 100, 0, GROUP))), [])
+
+    def test_v3_records(self):
+        # exclude, include of nothing, allow with a source, block
+        result = parse_igmp(packet(v3_report([(4, 0), (3, 0), (5, 1), (6, 1)])))
+        self.assertEqual([kind for (kind, _, _) in result],
+                         ["MCAST_JOIN", "MCAST_LEAVE", "MCAST_JOIN"])
+
+    def test_tagged(self):
+        leave = struct.pack("!BBH4s", 0x17, 0, 0, GROUP)
+        for tags in (((0x8100, 5),), ((0x88a8, 5), (0x8100, 7))):
+            self.assertEqual(parse_igmp(packet(leave, tags)),
+                             [("MCAST_LEAVE", "239.1.2.3", SRC)])
+
+    def test_not_igmp(self):
+        self.assertEqual(parse_igmp(packet(b"\x00" * 8, proto=17)), [])
+        self.assertEqual(parse_igmp(packet(b"\x00" * 8, ethertype=0x86dd)), [])
+
+    def test_truncated(self):
+        data = packet(v3_report([(4, 0), (2, 0)]))
+        # the second record is cut short, the first one is kept
+        self.assertEqual(parse_igmp(data[:-4]), [("MCAST_JOIN", "239.1.2.3", SRC)])
+        self.assertEqual(parse_igmp(data[:20]), [])
+        self.assertEqual(parse_igmp(b""), [])
+
+    def test_record_event(self):
+        self.assertEqual(record_event(1, 0), "MCAST_LEAVE")
+        self.assertEqual(record_event(1, 2), "MCAST_JOIN")
+        self.assertEqual(record_event(2, 0), "MCAST_JOIN")
+        self.assertIsNone(record_event(5, 0))
+        self.assertIsNone(record_event(6, 3))
+
+    def test_group_mac(self):
+        self.assertEqual(convert_to_mac("239.129.2.3"), "01:00:5e:01:02:03")
+
+
+class TestSnoopMux(unittest.TestCase):
+    '''Snooped packets of all ports come back apart by their tag'''
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.switch = Switch(self.bess, netlink=FakeNetlinkFeed())
+        self.switch.deserialize({"snoop":"tee", "snoop_name":"snoop{}".format(os.getpid()),
+                                 "vlans":[{"vlan_id":3, "ports":[
+                                     {"pci":"00:00.{}".format(number), "port_no":number}
+                                     for number in range(1, 4)]}]})
+        self.switch.initialize()
+        self.mux = self.switch._snoop
+        self.vlan = self.switch._vlans["bvlan3"]
+        listener = self.bess._sockets[self.mux.path]
+        (self.bess_end, _) = listener.accept()
+        self.addCleanup(os.unlink, self.mux.path)
+        self.addCleanup(listener.close)
+        self.addCleanup(self.bess_end.close)
+        self.addCleanup(self.mux.close)
+
+    def tag(self, port):
+        '''TCI pushed onto the copies snooped on a port'''
+        return self.bess.modules["tag" + port.ifname]["arg"]["tci"]
+
+    def test_wiring(self):
+        tags = [self.tag(port) for port in self.vlan.ports]
+        self.assertEqual(tags, [self.mux.tag(port) for port in self.vlan.ports])
+        self.assertEqual(len(set(tags)), 3)
+        for port in self.vlan.ports:
+            self.assertEqual(self.bess.links[("tee" + port.ifname, 1)],
+                             ("tag" + port.ifname, 0))
+            self.assertEqual(self.bess.links[("tag" + port.ifname, 0)], (self.mux.out, 0))
+
+    def test_demux(self):
+        report = struct.pack("!BBH4s", 0x16, 0, 0, GROUP)
+        leave = struct.pack("!BBH4s", 0x17, 0, 0, GROUP)
+        (first, second, third) = self.vlan.ports
+        self.bess_end.send(packet(report, ((0x8100, self.tag(second)),)))
+        self.bess_end.send(packet(leave, ((0x8100, self.tag(third)),)))
+        # untagged or with an unknown tag, there is no telling whose it is
+        with self.assertLogs(level="ERROR"):
+            self.bess_end.send(packet(report))
+            self.bess_end.send(packet(report, ((0x8100, 99),)))
+            self.bess_end.send(packet(report, ((0x8100, self.tag(first)),)))
+            events = self.mux.iteration()
+        self.assertEqual([(event["type"], event["port"], event["bridge"]) for event in events],
+                         [("MCAST_JOIN", second, self.vlan), ("MCAST_LEAVE", third, self.vlan),
+                          ("MCAST_JOIN", first, self.vlan)])
+        self.assertEqual(set(event["mac"] for event in events), set(["01:00:5e:01:02:03"]))
+        # nothing is written back to BESS
+        self.bess_end.setblocking(0)
+        with self.assertRaises(BlockingIOError):
+            self.bess_end.recv(2048)
+        self.assertEqual(self.mux.iface, self.mux.name)
+
+
+if __name__ == "__main__":
+    unittest.main()
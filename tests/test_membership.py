@@ -0,0 +1,28 @@
+'''IGMP membership settings'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import unittest
+from membership import igmp_settings, membership_interval
+
+
+class TestSettings(unittest.TestCase):
+    '''Defaults of the per vlan IGMP settings'''
+
+    def test_expiry_follows_querier(self):
+        self.assertFalse(igmp_settings({})["igmp_expiry"])
+        self.assertTrue(igmp_settings({"igmp_querier":True})["igmp_expiry"])
+
+    def test_expiry_explicit(self):
+        self.assertTrue(igmp_settings({"igmp_expiry":True})["igmp_expiry"])
+        self.assertFalse(
+            igmp_settings({"igmp_querier":True, "igmp_expiry":False})["igmp_expiry"])
+
+    def test_interval(self):
+        self.assertEqual(membership_interval(igmp_settings({})), 260)
+
+
+if __name__ == "__main__":
+    unittest.main()
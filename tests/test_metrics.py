@@ -0,0 +1,58 @@
+'''Metrics rendering and the scrape endpoint'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import os
+import socket
+import tempfile
+import time
+import unittest
+from metrics import MetricsServer, Registry
+
+
+class TestMetricsServer(unittest.TestCase):
+    '''Scrapes are answered without holding up the caller'''
+
+    def setUp(self):
+        self.registry = Registry()
+        self.counter = self.registry.counter("test_total", "Test counter")
+        self.path = os.path.join(tempfile.mkdtemp(), "metrics")
+        self.server = MetricsServer(self.path, self.registry)
+
+    def tearDown(self):
+        self.server.close()
+
+    def _connect(self):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.path)
+        return client
+
+    def test_scrape(self):
+        self.counter.inc(amount=3)
+        client = self._connect()
+        client.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        self.assertEqual(self.server.iteration(), [])
+        client.settimeout(5)
+        reply = b""
+        while True:
+            data = client.recv(4096)
+            if not data:
+                break
+            reply += data
+        client.close()
+        self.assertTrue(reply.startswith(b"HTTP/1.0 200 OK"))
+        self.assertIn(b"test_total 3\n", reply)
+
+    def test_silent_client(self):
+        # a client which never sends its request must not stall iteration
+        client = self._connect()
+        start = time.time()
+        self.server.iteration()
+        self.assertLess(time.time() - start, 0.25)
+        client.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
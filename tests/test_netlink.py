@@ -0,0 +1,83 @@
+'''Decoding of raw rtnetlink neighbour messages'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import struct
+import unittest
+from netlink_listener import (decode_neighbours, AF_BRIDGE, NDA_LLADDR, NDA_MASTER,
+                              NDMSG, NLMSG_HDR, NUD_PERMANENT, NUD_REACHABLE, NUD_STALE,
+                              RTATTR, RTM_DELNEIGH, RTM_NEWNEIGH)
+
+MAC = "02:00:00:00:01:02"
+NDA_VLAN = 5
+
+
+def attr(atype, payload):
+    '''An rtattr, padded to 4 bytes'''
+    data = RTATTR.pack(RTATTR.size + len(payload), atype) + payload
+    return data + b"\0" * (-len(data) % 4)
+
+
+def neigh(mtype, ifindex, attrs, family=AF_BRIDGE, state=NUD_REACHABLE):
+    '''A netlink message carrying an ndmsg'''
+    body = NDMSG.pack(family, ifindex, state, 0, 0) + b"".join(attrs)
+    return NLMSG_HDR.pack(NLMSG_HDR.size + len(body), mtype, 0, 0, 0) + body
+
+
+def fdb(mtype, mac=MAC, port=7, bridge=3, **kwargs):
+    '''A bridge FDB update'''
+    lladdr = bytes(int(octet, 16) for octet in mac.split(":"))
+    attrs = [attr(NDA_LLADDR, lladdr), attr(NDA_MASTER, struct.pack("=I", bridge))]
+    return neigh(mtype, port, attrs, **kwargs)
+
+
+def decode(buf):
+    '''Decode a buffer into a list'''
+    execute = []
+    decode_neighbours(memoryview(buf), execute)
+    return execute
+
+
+class TestDecode(unittest.TestCase):
+    '''Known messages'''
+
+    def test_new(self):
+        self.assertEqual(decode(fdb(RTM_NEWNEIGH)), [
+            {"type":"RTM_NEWNEIGH", "bridge_name":3, "mac":MAC, "port_name":7}])
+
+    def test_del(self):
+        self.assertEqual(decode(fdb(RTM_DELNEIGH, state=NUD_STALE)), [
+            {"type":"RTM_DELNEIGH", "bridge_name":3, "mac":MAC, "port_name":7}])
+
+    def test_unknown_attribute(self):
+        lladdr = bytes(range(2, 8))
+        buf = neigh(RTM_NEWNEIGH, 9, [attr(NDA_VLAN, b"\x01\x00"), attr(99, b"abcde"),
+                                      attr(NDA_LLADDR, lladdr),
+                                      attr(NDA_MASTER, struct.pack("=I", 4))])
+        self.assertEqual(decode(buf), [
+            {"type":"RTM_NEWNEIGH", "bridge_name":4, "mac":"02:03:04:05:06:07",
+             "port_name":9}])
+
+    def test_multiple(self):
+        buf = (fdb(RTM_NEWNEIGH, port=1) +
+               # not a bridge neighbour, an ARP entry
+               fdb(RTM_NEWNEIGH, family=2) +
+               # static entries are not ours to track
+               fdb(RTM_NEWNEIGH, state=NUD_PERMANENT) +
+               fdb(RTM_DELNEIGH, mac="02:00:00:00:00:ff", port=2))
+        self.assertEqual([(mess["type"], mess["mac"], mess["port_name"]) for mess in decode(buf)],
+                         [("RTM_NEWNEIGH", MAC, 1), ("RTM_DELNEIGH", "02:00:00:00:00:ff", 2)])
+
+    def test_missing_master(self):
+        buf = neigh(RTM_NEWNEIGH, 1, [attr(NDA_LLADDR, bytes(6))]) + fdb(RTM_NEWNEIGH)
+        self.assertEqual(len(decode(buf)), 1)
+
+    def test_truncated(self):
+        buf = fdb(RTM_NEWNEIGH)
+        self.assertEqual(decode(buf + buf[:10]), decode(buf))
+
+
+if __name__ == "__main__":
+    unittest.main()
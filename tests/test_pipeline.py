@@ -0,0 +1,118 @@
+'''Staged pipeline construction on the fake BESS'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import errno
+import unittest
+from unittest import mock
+from fake_bess import FakeBESS
+from fanout import FanOut
+from pipeline import STAGES, Placement, PipelineBuilder, PortPipeline
+
+# BESS calls made by each stage
+CALLS = {"add_worker":"workers", "create_port":"ports", "create_module":"modules",
+         "run_module_command":"commands", "connect_modules":"links", "attach_task":"tasks"}
+
+
+def pipeline(number):
+    '''A port with an input queue, a forwarder and an output'''
+    pipe = PortPipeline("p{}".format(number))
+    port = pipe.port("PMDPort", "p{}".format(number), {"port_id":number})
+    q_in = pipe.module("QueueInc", "in{}".format(number), {"port":port, "qid":0})
+    fwd = pipe.module("L2Forward", "fwd{}".format(number), {"size":16, "bucket":4})
+    out = pipe.module("PortOut", "out{}".format(number), {"port":port})
+    pipe.command(fwd, "set_default_gate", "L2ForwardCommandSetDefaultGateArg", {"gate":1})
+    pipe.connect(q_in, fwd)
+    pipe.connect(fwd, out, ogate=1)
+    pipe.task(q_in, [1, 2])
+    return pipe
+
+
+class TestPipelineBuilder(unittest.TestCase):
+    '''Each stage is done for all pipelines before the next one'''
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.stages = []
+        for (call, stage) in CALLS.items():
+            self._record(call, stage)
+
+    def _record(self, call, stage):
+        '''Note the stage of every call to a BESS method'''
+        method = getattr(self.bess, call)
+
+        def record(*args, **kwargs):
+            self.stages.append(stage)
+            return method(*args, **kwargs)
+
+        patcher = mock.patch.object(self.bess, call, side_effect=record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def check_order(self, fanout):
+        '''Build four pipelines and check the order of the calls'''
+        timings = PipelineBuilder(self.bess, fanout).build([pipeline(n) for n in range(4)])
+        self.assertEqual(sorted(timings), sorted(STAGES + ("total",)))
+        # the stages do not interleave and the workers come first
+        order = ("workers",) + STAGES
+        seen = [stage for (index, stage) in enumerate(self.stages)
+                if index == 0 or self.stages[index - 1] != stage]
+        self.assertEqual(tuple(seen), order)
+        counts = dict((stage, self.stages.count(stage)) for stage in order)
+        self.assertEqual(counts, {"workers":2, "ports":4, "modules":12, "commands":4,
+                                  "links":8, "tasks":4})
+        self.assertEqual(self.bess.links[("fwd2", 1)], ("out2", 0))
+        self.assertEqual(self.bess.modules["fwd3"]["default_gate"], 1)
+
+    def test_order(self):
+        self.check_order(FanOut(1))
+
+    def test_order_pool(self):
+        fanout = FanOut(4)
+        try:
+            self.check_order(fanout)
+        finally:
+            fanout.shutdown()
+
+    def test_failure(self):
+        # a module left over from an earlier run clashes
+        self.bess.modules["fwd1"] = {"mclass":"L2Forward", "arg":{}, "gates":{}}
+        self.bess.tables["fwd1"] = {}
+        with self.assertRaises(FakeBESS.Error) as err:
+            PipelineBuilder(self.bess).build([pipeline(n) for n in range(3)])
+        self.assertEqual(err.exception.code, errno.EEXIST)
+        # the stage went ahead for the other pipelines, the next one did not start
+        self.assertIn("fwd2", self.bess.modules)
+        self.assertIn("in1", self.bess.modules)
+        self.assertNotIn("out1", self.bess.modules)
+        self.assertNotIn("commands", self.stages)
+        self.assertEqual(self.bess.links, {})
+
+
+class TestPlacement(unittest.TestCase):
+    '''Tasks go to the least loaded of their cores'''
+
+    def test_spread(self):
+        placement = Placement()
+        wids = [placement.place([1, 2]) for _ in range(4)]
+        # alternate between the cores, one worker each
+        self.assertEqual(wids, [0, 1, 0, 1])
+        self.assertEqual(placement.workers, {1:0, 2:1})
+        self.assertEqual(placement.place([2, 3], weight=3), 2)
+        self.assertEqual(placement.place([2, 3]), 1)
+        self.assertEqual((placement.load(2), placement.load(3)), (3, 3))
+
+    def test_reserve_and_sync(self):
+        bess = FakeBESS()
+        bess.add_worker(0, 5)
+        placement = Placement()
+        placement.sync(bess)
+        placement.reserve([5, 6])
+        self.assertEqual(placement.workers, {5:0, 6:1})
+        self.assertEqual(placement.load(6), 0)
+        placement.create(bess)
+        self.assertEqual(bess.workers, {0:5, 1:6})
+        # the worker BESS already had is not added again
+        self.assertEqual(bess.calls["add_worker"], 2)
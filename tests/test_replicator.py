@@ -0,0 +1,126 @@
+'''Forwarder gates and replicator reference counting'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import unittest
+from fake_bess import FakeBESS
+from replicator import GateAllocator, ReplicatorManager
+
+PORTS = ("bv3p2", "bv3p3", "bv3p4")
+
+
+class Owner(object):
+    '''The port the replicators hang off'''
+    # pylint: disable=too-few-public-methods
+    ifname = "bv3p1"
+    forwarders = ["fbv3p1", "fbv3p1q1"]
+
+
+class TestGateAllocator(unittest.TestCase):
+    '''Allocation and reuse'''
+
+    def test_reuse(self):
+        gates = GateAllocator()
+        self.assertEqual([gates.alloc() for _ in range(3)], [1, 2, 3])
+        gates.release(2)
+        self.assertEqual(gates.in_use, 2)
+        self.assertEqual(gates.alloc(), 2)
+        self.assertEqual(gates.alloc(), 4)
+
+    def test_snapshot(self):
+        gates = GateAllocator()
+        for _ in range(3):
+            gates.alloc()
+        gates.release(1)
+        other = GateAllocator()
+        other.restore(gates.snapshot())
+        self.assertEqual((other.alloc(), other.alloc()), (1, 4))
+
+
+class TestReplicatorManager(unittest.TestCase):
+    '''acquire/release/rekey against the fake BESS'''
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        for name in Owner.forwarders:
+            self.bess.create_module("L2Forward", name, {})
+        for port in PORTS:
+            self.bess.create_module("PortOut", "hout" + port, {})
+        self.gates = GateAllocator()
+        port_gate = dict((port, number) for (number, port) in enumerate(PORTS, 10))
+        self.reps = ReplicatorManager(
+            self.bess, Owner(), self.gates, port_gate.get, lambda port: "hout" + port)
+
+    def test_shared_until_last_release(self):
+        gate = self.reps.acquire("a", PORTS[:2])
+        self.assertEqual(self.reps.acquire("a", PORTS[:2]), gate)
+        self.assertEqual(len(self.reps), 1)
+        name = self.reps.name(gate)
+        # wired to every queue forwarder
+        for forwarder in Owner.forwarders:
+            self.assertEqual(self.bess.links[(forwarder, gate)], (name, 0))
+        self.reps.release("a")
+        self.assertIn(name, self.bess.modules)
+        self.assertFalse(self.reps.exclusive("b"))
+        self.assertTrue(self.reps.exclusive("a"))
+        self.reps.release("a")
+        self.assertNotIn(name, self.bess.modules)
+        self.assertNotIn((Owner.forwarders[1], gate), self.bess.links)
+        # the gate goes back to the allocator
+        self.assertEqual(self.gates.alloc(), gate)
+
+    def test_distinct_sets(self):
+        first = self.reps.acquire("a", PORTS[:1])
+        second = self.reps.acquire("b", PORTS[1:])
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(self.reps.gates()), sorted([first, second]))
+
+    def test_rekey_in_place(self):
+        gate = self.reps.acquire("a", PORTS[:1])
+        name = self.reps.name(gate)
+        self.assertEqual(self.reps.rekey("a", "ab", PORTS[:2]), gate)
+        self.assertIsNone(self.reps.gate("a"))
+        self.assertEqual(self.reps.gate("ab"), gate)
+        self.assertEqual(self.bess.links[(name, 11)], ("hout" + PORTS[1], 0))
+        # a port which left stays wired, only the gate list changes
+        self.reps.rekey("ab", "b", PORTS[1:2])
+        self.assertIn((name, 10), self.bess.links)
+        self.reps.release("b")
+        self.assertNotIn(name, self.bess.modules)
+
+    def test_deferred_calls(self):
+        calls = []
+        gate = self.reps.acquire("a", PORTS[:1], calls)
+        name = self.reps.name(gate)
+        # the books are updated, BESS is not touched until the calls run
+        self.assertEqual(self.reps.gate("a"), gate)
+        self.assertNotIn(name, self.bess.modules)
+        for call in calls:
+            call()
+        self.assertIn(name, self.bess.modules)
+        calls = []
+        self.reps.rekey("a", "ab", PORTS[:2], calls)
+        self.assertEqual(self.reps.gate("ab"), gate)
+        self.assertNotIn((name, 11), self.bess.links)
+        for call in calls:
+            call()
+        self.assertEqual(self.bess.links[(name, 11)], ("hout" + PORTS[1], 0))
+
+    def test_unknown_release(self):
+        self.reps.release("nope")
+        self.assertEqual(len(self.reps), 0)
+
+    def test_restore_refs(self):
+        gate = self.reps.acquire("a", PORTS[:2])
+        state = self.reps.snapshot()
+        self.reps.restore(state, {"a":2})
+        self.reps.release("a")
+        self.assertIn(self.reps.name(gate), self.bess.modules)
+        self.reps.release("a")
+        self.assertNotIn(self.reps.name(gate), self.bess.modules)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+'''Cold and warm starts of the whole switch on the fake BESS'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from fake_bess import FakeBESS
+from fake_feeds import FakeNetlinkFeed
+from switch import Switch, load_snapshot
+
+PORTS = 3
+
+
+def config(ports=PORTS, flood=False):
+    '''A one vlan switch config'''
+    return {"vlans":[{"vlan_id":3, "flood":flood, "ports":[
+        {"pci":"00:00.{}".format(number), "port_no":number} for number in range(1, ports + 1)]}]}
+
+
+def learns(netlink, count, base=0):
+    '''Kernel FDB learns spread over the ports'''
+    provisioner = netlink.provisioner()
+    bridge = provisioner.index("bvlan3")
+    ports = [provisioner.index("bv3p{}".format(number)) for number in range(1, PORTS + 1)]
+    return [{"type":"RTM_NEWNEIGH", "mac":"02:00:00:00:{:02x}:{:02x}".format(
+        (base + i) >> 8, (base + i) & 0xff), "bridge_name":bridge, "port_name":ports[i % PORTS]}
+            for i in range(count)]
+
+
+class TestColdStart(unittest.TestCase):
+    '''The kernel FDB goes into BESS in bulk'''
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.netlink = FakeNetlinkFeed()
+        self.netlink.push(learns(self.netlink, 300))
+        self.netlink.iteration()
+
+    def test_bulk_install(self):
+        switch = Switch(self.bess, netlink=self.netlink)
+        switch.deserialize(config())
+        switch.initialize()
+        with mock.patch("switchport.INSTALL_CHUNK", 64):
+            switch.start(register=False)
+        self.assertEqual(len(switch._fdb), 300)
+        vlan = switch._vlans["bvlan3"]
+        for port in vlan.ports:
+            # every MAC behind another port, nothing left queued
+            others = set(entry.mac for entry in switch._fdb.entries(vlan) if entry.source != port)
+            self.assertEqual(len(others), 200)
+            self.assertEqual(set(port._shadow), others)
+            self.assertEqual(self.bess.tables[port.forwarder], port._shadow)
+            self.assertEqual(port.pending, 0)
+        self.assertEqual(switch.batcher.pending, 0)
+        # 200 rules per forwarder in chunks of 64 rather than one by one
+        self.assertEqual(self.bess.calls["add"], PORTS * 4)
+        self.assertEqual(switch.resync(), 0)
+
+
+class TestWarmRestart(unittest.TestCase):
+    '''Snapshot, then attach a new switch to what is in BESS'''
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.netlink = FakeNetlinkFeed()
+        # in the kernel before we start
+        self.netlink.push(learns(self.netlink, 40))
+        self.netlink.iteration()
+        self.path = os.path.join(tempfile.mkdtemp(), "snapshot.gz")
+
+    def _switch(self, conf=None, snapshot=None):
+        switch = Switch(self.bess, netlink=self.netlink)
+        switch.deserialize(conf or config())
+        switch.initialize(snapshot)
+        switch.start(register=False)
+        return switch
+
+    def _check_shadows(self, switch):
+        for port in switch._vlans["bvlan3"].ports:
+            for forwarder in port.forwarders:
+                self.assertEqual(self.bess.tables[forwarder], port._shadow)
+
+    def test_round_trip(self):
+        first = self._switch()
+        # the cold start loaded the kernel FDB in bulk
+        self.assertEqual(len(first._fdb), 40)
+        self._check_shadows(first)
+        # and something learned while running
+        self.netlink.push(learns(self.netlink, 10, 40))
+        now = time.time()
+        first.read(self.netlink, now)
+        first.housekeeping(now + 1)
+        first.batcher.flush()
+        first.save(self.path)
+        snapshot = load_snapshot(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+        calls = dict(self.bess.calls)
+        second = Switch(self.bess, netlink=self.netlink)
+        second.deserialize(config())
+        self.assertTrue(second.attachable(snapshot))
+        second.initialize(snapshot)
+        second.start(register=False)
+        # nothing rebuilt or reinstalled
+        self.assertEqual(self.bess.calls.get("create_module"), calls.get("create_module"))
+        self.assertEqual(self.bess.calls.get("add"), calls.get("add"))
+        self.assertEqual(len(second._fdb), 50)
+        self._check_shadows(second)
+        self.assertEqual(second.resync(), 0)
+
+    def test_changed_config(self):
+        first = self._switch()
+        first.save(self.path)
+        snapshot = load_snapshot(self.path)
+        for conf in (config(PORTS + 1), config(flood=True)):
+            other = Switch(self.bess, netlink=self.netlink)
+            other.deserialize(conf)
+            self.assertFalse(other.attachable(snapshot))
+
+    def test_missing_module(self):
+        first = self._switch()
+        first.save(self.path)
+        snapshot = load_snapshot(self.path)
+        self.bess.destroy_module("fbv3p1")
+        other = Switch(self.bess, netlink=self.netlink)
+        other.deserialize(config())
+        self.assertFalse(other.attachable(snapshot))
+
+
+if __name__ == "__main__":
+    unittest.main()
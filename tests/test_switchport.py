@@ -0,0 +1,300 @@
+'''Forwarder rule programming against the fake BESS'''
+
+# Copyright (c) 2019 Red Hat Inc
+#
+# License: GPL2, see COPYING in source directory
+
+import unittest
+from unittest import mock
+from batcher import Batcher
+from fake_bess import FakeBESS
+from fanout import FanOut
+from fdb import FDB
+from pipeline import PipelineBuilder
+from switchport import DROP_GATE
+from vlan import Vlan
+
+
+def fake_vlan(bess, ports, batcher, **table):
+    '''A vlan with its pipelines built on the fake BESS'''
+    config = {"vlan_id":3, "ports":[
+        {"pci":"00:00.{}".format(number), "port_no":number} for number in range(1, ports + 1)]}
+    config.update(table)
+    vlan = Vlan(bess, config, batcher)
+    PipelineBuilder(bess, batcher.fanout).build(vlan.pipelines())
+    for port in vlan.ports:
+        port.attach()
+    return vlan
+
+
+def macs(count, base=0):
+    '''Unicast MACs'''
+    return ["02:00:00:00:{:02x}:{:02x}".format((base + i) >> 8, (base + i) & 0xff)
+            for i in range(count)]
+
+
+class TestPartialFailure(unittest.TestCase):
+    '''The shadow has to match the forwarder whatever BESS refused'''
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.batcher = Batcher(fanout=FanOut(1))
+        self.vlan = fake_vlan(self.bess, 2, self.batcher, table_size=4, table_bucket=1)
+        self.ports = list(self.vlan.ports)
+        self.fdb = FDB()
+
+    def tearDown(self):
+        self.batcher.fanout.shutdown()
+
+    def test_bounded_table(self):
+        port = self.ports[0]
+        for mac in macs(6):
+            self.fdb.learn(mac, self.vlan, self.ports[1])
+        self.batcher.flush()
+        for forwarder in port.forwarders:
+            table = self.bess.tables[forwarder]
+            self.assertEqual(len(table), 4)
+            self.assertEqual(port._shadow, table)
+        self.assertEqual(port.diff(self.fdb.entries(self.vlan)).keys(),
+                         set(macs(6)) - set(port._shadow))
+
+
+
+class TestRebuild(unittest.TestCase):
+    '''Growing a crowded forwarder'''
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.batcher = Batcher(fanout=FanOut(1))
+        self.vlan = fake_vlan(self.bess, 2, self.batcher, table_size=8, table_bucket=1,
+                              table_grow=True)
+        self.ports = list(self.vlan.ports)
+        self.fdb = FDB()
+        self.tries = 0
+        self.create = self.bess.create_module
+        self.bess.create_module = self._create
+
+    def tearDown(self):
+        self.batcher.fanout.shutdown()
+
+    def _create(self, mclass, name, arg):
+        '''Refuse to create rebuilt forwarders'''
+        if mclass == "L2Forward":
+            self.tries += 1
+            raise self.bess.Error(12, "Not enough memory")
+        return self.create(mclass, name, arg)
+
+    def _learn(self, addrs):
+        for mac in addrs:
+            self.fdb.learn(mac, self.vlan, self.ports[1])
+        self.batcher.flush()
+
+    def test_failed_rebuild_latched(self):
+        port = self.ports[0]
+        self._learn(macs(7))
+        tries = self.tries
+        self.assertGreater(tries, 0)
+        self.assertEqual(port.forwarder, "f" + port.ifname)
+        # still crowded, the failed rebuild is not tried again
+        self._learn(macs(2, 7))
+        self.assertEqual(self.tries, tries)
+        for mac in macs(9):
+            self.fdb.expire(mac, self.vlan)
+        self.batcher.flush()
+        self.assertEqual(port.occupancy, 0)
+        # drained below TABLE_LOW, the next crowding tries again
+        self._learn(macs(7))
+        self.assertGreater(self.tries, tries)
+        self.bess.create_module = self.create
+        for mac in macs(7):
+            self.fdb.expire(mac, self.vlan)
+        self.batcher.flush()
+        self._learn(macs(7))
+        self.assertEqual(port.forwarder, "f{}r1".format(port.ifname))
+        self.assertEqual(port._shadow, self.bess.tables[port.forwarder])
+
+
+
+class TestQueueForwarders(unittest.TestCase):
+    '''Ports with a forwarder per receive queue'''
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.batcher = Batcher(fanout=FanOut(1))
+        self.vlan = Vlan(self.bess, {"vlan_id":3, "ports":[
+            {"pci":"00:00.{}".format(number), "port_no":number, "num_inc_q":2,
+             "cores":[1, 2]} for number in (1, 2)]}, self.batcher)
+        PipelineBuilder(self.bess, self.batcher.fanout).build(self.vlan.pipelines())
+        for port in self.vlan.ports:
+            port.attach()
+        self.ports = list(self.vlan.ports)
+        self.port = self.ports[0]
+        self.fdb = FDB()
+        self.refuse = None
+        self.command = self.bess.run_module_command
+        self.bess.run_module_command = self._command
+
+    def tearDown(self):
+        self.batcher.fanout.shutdown()
+
+    def _command(self, name, cmd, arg_type, arg):
+        '''Fail adds of the refused MAC on the second queue'''
+        if name == self.port.forwarders[1] and cmd == "add" and \
+                any(entry["addr"] == self.refuse for entry in arg["entries"]):
+            raise self.bess.Error(12, "Not enough space")
+        return self.command(name, cmd, arg_type, arg)
+
+    def test_split_add(self):
+        self.assertEqual(len(self.port.forwarders), 2)
+        addrs = macs(3)
+        self.refuse = addrs[1]
+        for mac in addrs:
+            self.fdb.learn(mac, self.vlan, self.ports[1])
+        failed = self.batcher.flush()[self.port]
+        self.assertEqual([(what, forwarder) for (what, _, forwarder) in failed],
+                         [("add", self.port.forwarders[1])])
+        # in the first forwarder, so in the shadow, but split
+        self.assertIn(addrs[1], self.port._shadow)
+        self.assertIn(addrs[1], self.bess.tables[self.port.forwarders[0]])
+        self.assertEqual(list(self.port.diff(self.fdb.entries(self.vlan))), [addrs[1]])
+        self.refuse = None
+
+    def test_split_requeued(self):
+        addrs = macs(2)
+        self.refuse = addrs[1]
+        for mac in addrs:
+            self.fdb.learn(mac, self.vlan, self.ports[1])
+        self.batcher.flush()
+        self.refuse = None
+        # the same rule again is not a no-op while the forwarders disagree
+        self.port._queue(addrs[1], self.port._shadow[addrs[1]])
+        self.batcher.flush()
+        for forwarder in self.port.forwarders:
+            self.assertEqual(self.bess.tables[forwarder], self.port._shadow)
+        self.assertEqual(self.port._split, set())
+
+    def test_split_resync(self):
+        addrs = macs(3)
+        self.refuse = addrs[1]
+        for mac in addrs:
+            self.fdb.learn(mac, self.vlan, self.ports[1])
+        self.batcher.flush()
+        self.refuse = None
+        self.assertEqual(self.port.resync(self.fdb.entries(self.vlan)), 1)
+        self.assertEqual(self.port.diff(self.fdb.entries(self.vlan)), {})
+        for forwarder in self.port.forwarders:
+            self.assertEqual(self.bess.tables[forwarder], self.port._shadow)
+
+    def test_split_delete(self):
+        addrs = macs(2)
+        self.refuse = addrs[0]
+        for mac in addrs:
+            self.fdb.learn(mac, self.vlan, self.ports[1])
+        self.batcher.flush()
+        self.fdb.expire(addrs[0], self.vlan)
+        self.batcher.flush()
+        # gone from both, the second never had it
+        for forwarder in self.port.forwarders:
+            self.assertNotIn(addrs[0], self.bess.tables[forwarder])
+        self.assertNotIn(addrs[0], self.port._shadow)
+        self.assertEqual(self.port.diff(self.fdb.entries(self.vlan)), {})
+
+
+
+class TestMove(unittest.TestCase):
+    '''A MAC moving between ports only touches the rules which change'''
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.batcher = Batcher(fanout=FanOut(1))
+        self.vlan = fake_vlan(self.bess, 3, self.batcher)
+        self.ports = list(self.vlan.ports)
+        self.fdb = FDB()
+        (self.mac,) = macs(1)
+        self.fdb.learn(self.mac, self.vlan, self.ports[1])
+        self.batcher.flush()
+
+    def tearDown(self):
+        self.batcher.fanout.shutdown()
+
+    def commands(self):
+        '''Flush and return the rule commands sent to each forwarder'''
+        sent = {}
+        command = self.bess.run_module_command
+
+        def record(name, cmd, arg_type, arg):
+            sent.setdefault(name, []).append(cmd)
+            return command(name, cmd, arg_type, arg)
+
+        with mock.patch.object(self.bess, "run_module_command", side_effect=record):
+            self.assertEqual(self.batcher.flush(), {})
+        return sent
+
+    def gates(self):
+        '''Gate of the MAC in the forwarder of each port, None for no rule'''
+        return [self.bess.tables[port.forwarder].get(self.mac) for port in self.ports]
+
+    def test_move(self):
+        (first, old, new) = self.ports
+        (before, _, _) = self.gates()
+        self.fdb.learn(self.mac, self.vlan, new)
+        sent = self.commands()
+        # the gate changes on the bystander, old gains and new loses the rule
+        self.assertEqual(sent, {first.forwarder:["delete", "add"],
+                                old.forwarder:["add"],
+                                new.forwarder:["delete"]})
+        self.assertEqual(self.gates(), [first._shadow[self.mac], old._shadow[self.mac], None])
+        self.assertNotEqual(self.gates()[0], before)
+        for port in self.ports:
+            self.assertEqual(port._shadow, self.bess.tables[port.forwarder])
+
+    def test_move_back(self):
+        (_, old, new) = self.ports
+        self.fdb.learn(self.mac, self.vlan, new)
+        self.fdb.learn(self.mac, self.vlan, old)
+        # moved back before the flush, nothing goes to BESS
+        self.assertEqual(self.commands(), {})
+        self.assertIsNone(self.gates()[1])
+
+
+class TestFlood(unittest.TestCase):
+    '''Flooding in BESS'''
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.bess = FakeBESS()
+        self.batcher = Batcher(fanout=FanOut(1))
+        self.vlan = fake_vlan(self.bess, 3, self.batcher, flood=True)
+        self.ports = list(self.vlan.ports)
+        self.fdb = FDB()
+
+    def tearDown(self):
+        self.batcher.fanout.shutdown()
+
+    def test_hairpin_dropped(self):
+        (mac,) = macs(1)
+        self.fdb.learn(mac, self.vlan, self.ports[0])
+        self.batcher.flush()
+        port = self.ports[0]
+        self.assertEqual(self.bess.tables[port.forwarder][mac], DROP_GATE)
+        self.assertEqual(self.bess.links[(port.forwarder, DROP_GATE)],
+                         ("drop" + port.ifname, 0))
+        self.assertNotEqual(self.bess.tables[self.ports[1].forwarder][mac], DROP_GATE)
+        # moving away points the rule at the new port
+        self.fdb.learn(mac, self.vlan, self.ports[1])
+        self.batcher.flush()
+        self.assertNotEqual(self.bess.tables[port.forwarder][mac], DROP_GATE)
+        self.assertEqual(self.bess.tables[self.ports[1].forwarder][mac], DROP_GATE)
+
+    def test_igmp_flooded(self):
+        # the snooped IGMP written back goes to the flood replicator
+        port = self.ports[0]
+        self.assertEqual(self.bess.links[("uinc" + port.ifname, 0)], ("fl" + port.ifname, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
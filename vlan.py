@@ -8,17 +8,37 @@
 
 import logging
 import subprocess
+from fanout import FanOut, report
+from membership import igmp_settings
+from pipeline import PipelineBuilder
 from switchport import SwitchPort
 
+# forwarder table settings which can be given per vlan or per port
+TABLE_KEYS = ("expected_macs", "table_size", "table_bucket", "table_grow")
+
 class Vlan(object):
     '''A python representation of a BESS vlan'''
 
-    def __init__(self, bess, config=None):
+    def __init__(self, bess, config=None, batcher=None):
         self.vlan_no = None
         self._bess = bess
+        self._batcher = batcher
+        # LinkProvisioner for the linux side, brctl/ip are used without one
+        self.provisioner = None
         self._p_by_name = {}
         self._initialized = False
-        # list of "port sets" which we use for group mappings
+        # multicast group index - each port owns a bit, a group maps to
+        # the bitset of its member ports
+        self._bits = {}
+        self._groups = {}
+        # forwarder table defaults for the ports
+        self.table = {}
+        # flood in BESS rather than in the linux bridge
+        self.flood = False
+        # SnoopMux shared by all ports, each port has a snoop socket of
+        # its own without one
+        self.snoop = None
+        self.igmp = igmp_settings({})
         if config is not None:
             self.deserialize(config)
 
@@ -51,37 +71,102 @@ class Vlan(object):
     def deserialize(self, ser_object):
         '''Digest data read from JSON'''
         self.vlan_no = ser_object["vlan_id"]
+        self.table = dict((key, ser_object[key]) for key in TABLE_KEYS if key in ser_object)
+        self.flood = ser_object.get("flood", False)
+        self.igmp = igmp_settings(ser_object)
         self._p_by_name = {}
+        self._bits = {}
+        self._groups = {}
         for serport in ser_object["ports"]:
-            port = SwitchPort(self._bess, self, serport)
+            port = SwitchPort(self._bess, self, serport, self._batcher)
             self._p_by_name[port.ifname] = port
+            self._bits[port] = 1 << len(self._bits)
 
     def _create(self):
         '''Create the underlying Linux Bridge'''
+        if self.provisioner is not None:
+            self.provisioner.create_bridge(self.ifname)
+            return
         logging.debug("Creatig Bridge %s", self.ifname)
         subprocess.call(["/sbin/brctl", "addbr", self.ifname])
 
-    def _add_if(self, ifname):
-        '''Create the underlying Linux Bridge'''
-        logging.debug("Adding interface %s to Bridge %s", ifname, self.ifname)
-        subprocess.call(["/sbin/brctl", "addif", self.ifname, ifname])
+    def _add_ifs(self, ifnames):
+        '''Add interfaces to the underlying Linux Bridge'''
+        if self.provisioner is not None:
+            self.provisioner.enslave(self.ifname, ifnames)
+            return
+        for ifname in ifnames:
+            logging.debug("Adding interface %s to Bridge %s", ifname, self.ifname)
+            subprocess.call(["/sbin/brctl", "addif", self.ifname, ifname])
+
+    def _isolate(self, ifnames):
+        '''Stop the underlying Linux Bridge from forwarding between
+           interfaces, what the host itself sends still goes out'''
+        if self.provisioner is not None:
+            self.provisioner.set_isolated(ifnames, True)
+            return
+        for ifname in ifnames:
+            logging.debug("Isolating %s on Bridge %s", ifname, self.ifname)
+            subprocess.call(["/sbin/bridge", "link", "set", "dev", ifname, "isolated", "on"])
+
+    def _querier(self):
+        '''Make the underlying Linux Bridge send IGMP general queries'''
+        interval = self.igmp["igmp_query_interval"]
+        response = self.igmp["igmp_response_interval"]
+        if self.provisioner is not None:
+            self.provisioner.set_querier(self.ifname, interval, response)
+            return
+        logging.debug("IGMP querier on Bridge %s every %ds", self.ifname, interval)
+        # the bridge takes its intervals in centiseconds
+        subprocess.call(["/sbin/ip", "link", "set", "dev", self.ifname, "type", "bridge",
+                         "mcast_snooping", "1", "mcast_querier", "1",
+                         "mcast_query_interval", str(interval * 100),
+                         "mcast_query_response_interval", str(response * 100)])
 
     def _link(self, status):
         '''Up/Down Link'''
+        if self.provisioner is not None:
+            self.provisioner.set_state([self.ifname], status)
+            return
         logging.debug("Linkf for VLAN %s %s", self.vlan_no, status)
         subprocess.call(["/sbin/ip", "link", "set", self.ifname, status])
 
-    def initialize(self):
-        '''Create underlying VLAN and BESS port'''
+    def pipelines(self):
+        '''Describe the BESS pipelines of all ports'''
+        return [port.pipeline() for port in self.ports]
+
+    def _fanout(self):
+        '''Fan-out pool to use for per port work'''
+        if self._batcher is not None:
+            return self._batcher.fanout
+        return FanOut(1)
+
+    def initialize(self, build=True):
+        '''Create underlying VLAN and BESS port. If build is False the
+           caller has already built the port pipelines.'''
         self._initialized = True
         logging.debug("Init VLAN %s", self.vlan_no)
         self._create()
         port_names = []
         for port in self.ports:
             port_names.append(port.ifname)
+        if build:
+            PipelineBuilder(self._bess, self._fanout()).build(self.pipelines())
         for port in self.ports:
-            port.initialize()
-            self._add_if(port.ifname)
+            port.attach()
+        # the vports only exist once BESS has created them, enslave them
+        # all in one go
+        self._add_ifs(port_names)
+        if self.flood:
+            # BESS floods between the ports with a datapath, the bridge
+            # flooding as well would send everything out twice. Turning
+            # bridge flooding off would also stop the broadcasts and
+            # unknown unicast of the host, isolated ports still get those.
+            self._isolate([port.ifname for port in self.ports if port.fast_path])
+        if self.igmp["igmp_querier"]:
+            # hosts only repeat their reports when asked, without a
+            # querier on the segment memberships would time out
+            self._querier()
         # add default replicator for broadcast/multicast to all
         self._link("up")
 
@@ -91,15 +176,113 @@ class Vlan(object):
 
     def delete(self, entry):
         '''Delete an entry'''
+        self._groups.pop(entry.mac, None)
         for port in self.ports:
             port.delete(entry)
 
-    def replace(self, entry):
-        '''Replace an entry'''
+    def move(self, old, new):
+        '''Move an entry to a new destination'''
         for port in self.ports:
-            port.replace(entry)
+            port.move(old, new)
+
+    def replace(self, old, new):
+        '''Replace an entry'''
+        self.move(old, new)
 
     def add(self, entry):
         '''Add an entry'''
+        if entry.is_broadcast and entry.ports:
+            self._groups[entry.mac] = self._to_bits(entry.ports)
         for port in self.ports:
             port.add(entry)
+
+    def _to_bits(self, ports):
+        '''Bitset of a list of ports'''
+        bits = 0
+        for port in ports:
+            bits |= self._bits.get(port, 0)
+        return bits
+
+    def _to_ports(self, bits):
+        '''Ports in a bitset'''
+        return [port for (port, bit) in self._bits.items() if bits & bit]
+
+    def group(self, mac):
+        '''Member ports of a multicast group'''
+        return self._to_ports(self._groups.get(mac, 0))
+
+    def _regroup(self, entry, bits):
+        '''Apply a new member bitset to a multicast group. Only the
+           forwarders whose view of the group changes are told about it -
+           a port joining or leaving does not replicate to itself so its
+           own forwarder is left alone'''
+        old = self._groups.get(entry.mac, 0)
+        changed = old ^ bits
+        if not changed:
+            return
+        if bits:
+            self._groups[entry.mac] = bits
+        else:
+            del self._groups[entry.mac]
+        members = self._to_ports(bits)
+        # the rule changes are queued here, only the replicator calls
+        # are spread over the fan-out pool
+        work = {}
+        for port in self.ports:
+            if self._bits[port] != changed:
+                calls = port.regroup(entry.mac, members)
+                if calls:
+                    work[port] = calls
+
+        def run(port):
+            for call in work[port]:
+                call()
+
+        failures = self._fanout().run(list(work), run)
+        report(failures, "Group update")
+
+    def join(self, entry, port):
+        '''A port joined a multicast group'''
+        self._regroup(entry, self._groups.get(entry.mac, 0) | self._bits.get(port, 0))
+
+    def leave(self, entry, port):
+        '''A port left a multicast group'''
+        self.prune(entry, [port])
+
+    def prune(self, entry, ports):
+        '''A list of ports left a multicast group at once'''
+        self._regroup(entry, self._groups.get(entry.mac, 0) & ~self._to_bits(ports))
+
+    def resync(self, entries, verify=True):
+        '''Check all forwarders against the fdb entries of this vlan and
+           repair any drift, against their shadow tables only unless
+           verify is set. Returns the number of MACs repaired.'''
+        repaired = {}
+
+        def work(port):
+            repaired[port] = port.resync(entries, verify)
+
+        failures = self._fanout().run(self.ports, work)
+        report(failures, "Resync")
+        return sum(repaired.values())
+
+    def snapshot(self, entries):
+        '''Port state for a warm restart, saved along with the fdb
+           entries of this vlan'''
+        return dict((port.ifname, port.snapshot(entries)) for port in self.ports)
+
+    def restore(self, state, entries):
+        '''Pick up the port state saved by snapshot() with entries'''
+        for port in self.ports:
+            port.restore(state[port.ifname], entries)
+
+    def load(self, entry):
+        '''Take note of an entry loaded into the fdb at start, the
+           forwarders are reconciled separately'''
+        if entry.is_broadcast and entry.ports:
+            self._groups[entry.mac] = self._to_bits(entry.ports)
+
+    def install(self, entries):
+        '''Bulk install a list of entries into all forwarders at once'''
+        failures = self._fanout().run(self.ports, lambda port: port.install(entries))
+        report(failures, "Bulk install")